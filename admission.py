@@ -0,0 +1,147 @@
+from typing import Any, Dict, Hashable, Optional, Tuple
+from collections import OrderedDict
+from contextlib import ExitStack
+import concurrent.futures
+import os
+import threading
+import time
+
+import metrics
+
+RATE_LIMIT_IP_PER_MINUTE = float(os.getenv('RATE_LIMIT_IP_PER_MINUTE', 30))
+RATE_LIMIT_IP_BURST = int(os.getenv('RATE_LIMIT_IP_BURST', 10))
+RATE_LIMIT_SESSION_PER_MINUTE = float(os.getenv('RATE_LIMIT_SESSION_PER_MINUTE', 12))
+RATE_LIMIT_SESSION_BURST = int(os.getenv('RATE_LIMIT_SESSION_BURST', 4))
+RATE_LIMIT_TRANSLATE_PER_MINUTE = float(os.getenv('RATE_LIMIT_TRANSLATE_PER_MINUTE', 60))
+RATE_LIMIT_TRANSLATE_BURST = int(os.getenv('RATE_LIMIT_TRANSLATE_BURST', 20))
+RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', 100000))
+
+RATE_LIMITED = metrics.Counter('vardovia_rate_limited_total', 'Requests rejected by a per-client rate limit', ('scope',))
+COALESCED = metrics.Counter('vardovia_coalesced_actions_total', 'Duplicate turns answered from one in flight')
+
+
+class RateLimited(Exception):
+    def __init__(self, scope: str, retry_after: float):
+        super().__init__(f"too many actions from this {scope}, please slow down")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """Token buckets keyed by client: `burst` turns at once, refilled at per_minute.
+
+    Buckets are kept in LRU order and the least recently used are dropped past
+    max_keys; a dropped bucket would have refilled by then anyway for any
+    realistic key churn. A per_minute of 0 disables the limiter.
+    """
+
+    def __init__(self, scope: str, per_minute: float, burst: int, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.scope = scope
+        self.rate = per_minute / 60.0
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def _tokens(self, key: Hashable, now: float) -> float:
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def _wait_time(self, key: Hashable, now: float) -> float:
+        if not self.enabled:
+            return 0.0
+        tokens = self._tokens(key, now)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def _take(self, key: Hashable, now: float):
+        if not self.enabled:
+            return
+        self._buckets[key] = (self._tokens(key, now) - 1, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+    def wait_time(self, key: Hashable) -> float:
+        """Seconds until key may take a token; 0 if it may now"""
+        with self._lock:
+            return self._wait_time(key, time.monotonic())
+
+    def take(self, key: Hashable):
+        with self._lock:
+            self._take(key, time.monotonic())
+
+    def stats(self) -> Dict[str, Any]:
+        return {"per_minute": round(self.rate * 60, 3), "burst": self.burst, "clients": len(self._buckets),
+                "limited": RATE_LIMITED.value(scope=self.scope)}
+
+
+def admit(*checks: Tuple[RateLimiter, Hashable]):
+    """Take one token from every (limiter, key) pair, or none and raise RateLimited.
+
+    Every limiter involved stays locked (in a fixed order) from the check to
+    the take, so concurrent requests can't both pass on the last token.
+    """
+    limiters = sorted({id(limiter): limiter for limiter, _ in checks}.values(), key=id)
+    with ExitStack() as stack:
+        for limiter in limiters:
+            stack.enter_context(limiter._lock)
+        now = time.monotonic()
+        for limiter, key in checks:
+            wait = limiter._wait_time(key, now)
+            if wait > 0:
+                RATE_LIMITED.inc(scope=limiter.scope)
+                raise RateLimited(limiter.scope, wait)
+        for limiter, key in checks:
+            limiter._take(key, now)
+
+
+class Coalescer:
+    """Lets identical requests that overlap in time share one result.
+
+    The first caller for a key becomes the leader and must resolve the
+    returned future and then call release(); callers arriving before that
+    get the same future to wait on instead of doing the work again.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key: Hashable) -> Tuple[bool, concurrent.futures.Future]:
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                COALESCED.inc()
+                return False, flight
+            flight = self._flights[key] = concurrent.futures.Future()
+            return True, flight
+
+    def release(self, key: Hashable, flight: concurrent.futures.Future):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        if not flight.done():
+            flight.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"in_flight": len(self._flights), "coalesced": COALESCED.value()}
+
+
+ip_limiter = RateLimiter('ip', RATE_LIMIT_IP_PER_MINUTE, RATE_LIMIT_IP_BURST)
+session_limiter = RateLimiter('session', RATE_LIMIT_SESSION_PER_MINUTE, RATE_LIMIT_SESSION_BURST)
+translate_limiter = RateLimiter('translate', RATE_LIMIT_TRANSLATE_PER_MINUTE, RATE_LIMIT_TRANSLATE_BURST)
+actions = Coalescer()
+
+
+def action_key(session_id: str, player_action: str, known_version: Optional[int]) -> Tuple[str, str, Optional[int]]:
+    """Same session, same action text up to case and spacing, same starting state"""
+    return session_id, " ".join(player_action.lower().split()), known_version
+
+
+def stats() -> Dict[str, Any]:
+    return {"ip": ip_limiter.stats(), "session": session_limiter.stats(), "translate": translate_limiter.stats(),
+            "coalescing": actions.stats()}
@@ -0,0 +1,202 @@
+"""Build the page's static bundles: run at startup by web_interface, or ahead of time with
+
+    python -m assets
+
+The inline <style> and <script> of templates/index.html are minified into
+content-hashed files under static/dist/ with gzip (and, when the brotli
+package is installed, brotli) copies beside them. The logo gets resized PNG
+and WebP variants. What remains of the page, pointing at those files, is
+kept in memory precompressed as well, so "/" is one small response and a
+returning player revalidates it with a single 304.
+"""
+from typing import Dict, List, Optional, Tuple
+import gzip
+import hashlib
+import io
+import os
+import re
+
+from PIL import Image
+
+import image_store
+import log_pipeline
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_PATH = os.path.join(ROOT, 'templates', 'index.html')
+LOGO_PATH = os.path.join(ROOT, 'static', 'assets', 'vardovia__logo.png')
+DIST_DIR = os.path.join(ROOT, 'static', 'dist')
+DIST_URL = '/static/dist/'
+HASH_LENGTH = 12
+LOGO_DISPLAY_SIZE = 360  # 2x the largest place it is shown (the 180px intro logo)
+LOGO_ICON_SIZES = {"favicon": 32, "touch": 180}
+COMPRESSIBLE = ('.css', '.js', '.html', '.svg')
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+log = log_pipeline.get_logger('assets')
+
+_STYLE = re.compile(r"<style>(.*?)</style>", re.S)
+_SCRIPT = re.compile(r"<script>(.*?)</script>", re.S)
+_LOGO_RULE = re.compile(r"background-image:\s*url\('/static/assets/vardovia__logo\.png'\);")
+_FAVICON = re.compile(r'<link rel="icon"[^>]*vardovia__logo\.png"\s*/?>')
+
+
+def minify_css(css: str) -> str:
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    css = re.sub(r":\s+", ":", css)
+    return css.replace(";}", "}").strip()
+
+
+def minify_js(js: str) -> str:
+    """Drop indentation, blank lines and whole-line comments; line breaks stay for ASI"""
+    lines = (line.strip() for line in js.splitlines())
+    return "\n".join(line for line in lines if line and not line.startswith("//"))
+
+
+def minify_html(html: str) -> str:
+    lines = (line.strip() for line in html.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def compress(data: bytes) -> Dict[str, bytes]:
+    """{content-coding: body} for the encodings available here"""
+    encoded = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        encoded["br"] = brotli.compress(data, quality=11)
+    return encoded
+
+
+def accepted_codings(accept_encoding: str) -> Dict[str, float]:
+    """{content-coding: q-value} from an Accept-Encoding header"""
+    codings = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+def choose_coding(accept_encoding: str, available: List[str]) -> Optional[str]:
+    """The coding in available the client rates highest (ties go to the earlier one); None if it takes none"""
+    accepted = accepted_codings(accept_encoding)
+    best, best_q = None, 0.0
+    for coding in available:
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+
+def write_asset(name: str, data: bytes, directory: str = DIST_DIR) -> str:
+    """Write data as <stem>.<hash><ext> (plus compressed copies) unless it exists; returns its URL"""
+    stem, ext = os.path.splitext(name)
+    filename = f"{stem}.{content_hash(data)}{ext}"
+    path = os.path.join(directory, filename)
+    if not os.path.exists(path):
+        if ext in COMPRESSIBLE:
+            encoded = compress(data)
+            for coding, suffix in ENCODINGS:
+                if coding in encoded:
+                    image_store.write_stream((encoded[coding],), path + suffix)
+        image_store.write_stream((data,), path)
+    return DIST_URL + filename
+
+
+def _image_bytes(image: Image.Image, format: str, **params) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format, **params)
+    return buffer.getvalue()
+
+
+def build_logo(directory: str = DIST_DIR) -> Dict[str, str]:
+    """URLs of the logo's display (PNG and WebP) and icon variants"""
+    with Image.open(LOGO_PATH) as source:
+        logo = source.convert('RGBA')
+    urls = {}
+    display = logo.resize((LOGO_DISPLAY_SIZE, LOGO_DISPLAY_SIZE), Image.LANCZOS)
+    urls["webp"] = write_asset("logo.webp", _image_bytes(display, 'WEBP', quality=image_store.WEBP_QUALITY,
+                                                         method=6), directory)
+    urls["png"] = write_asset("logo.png", _image_bytes(display, 'PNG', optimize=True), directory)
+    for name, size in LOGO_ICON_SIZES.items():
+        icon = logo.resize((size, size), Image.LANCZOS)
+        urls[name] = write_asset(f"{name}.png", _image_bytes(icon, 'PNG', optimize=True), directory)
+    return urls
+
+
+class Page:
+    """The built index page: body, precompressed copies and the ETag they share"""
+
+    def __init__(self, html: bytes):
+        self.body = html
+        self.encoded = compress(html)
+        self.etag = content_hash(html)
+
+    def negotiate(self, accept_encoding: str) -> Tuple[Optional[str], bytes]:
+        coding = choose_coding(accept_encoding, [coding for coding, _ in ENCODINGS if coding in self.encoded])
+        if coding is None:
+            return None, self.body
+        return coding, self.encoded[coding]
+
+
+def build(template_path: str = TEMPLATE_PATH, directory: str = DIST_DIR) -> Page:
+    os.makedirs(directory, exist_ok=True)
+    with open(template_path, encoding='utf-8') as f:
+        html = f.read()
+    logo = build_logo(directory)
+
+    style, script = _STYLE.search(html), _SCRIPT.search(html)
+    if style is None or script is None:
+        raise ValueError(f"{template_path} has no inline <style> or <script> to extract")
+    css = _LOGO_RULE.sub(
+        f"background-image: url('{logo['png']}'); "
+        f"background-image: image-set(url('{logo['webp']}') type('image/webp'), url('{logo['png']}') type('image/png'));",
+        style.group(1))
+    css_url = write_asset("app.css", minify_css(css).encode('utf-8'), directory)
+    js_url = write_asset("app.js", minify_js(script.group(1)).encode('utf-8'), directory)
+
+    html = html[:script.start()] + f'<script src="{js_url}"></script>' + html[script.end():]
+    html = html[:style.start()] + f'<link rel="stylesheet" href="{css_url}">' + html[style.end():]
+    html = _FAVICON.sub(f'<link rel="icon" type="image/png" href="{logo["favicon"]}">\n'
+                        f'<link rel="apple-touch-icon" href="{logo["touch"]}">\n'
+                        f'<link rel="preload" as="image" type="image/webp" href="{logo["webp"]}">', html)
+    page = Page(minify_html(html).encode('utf-8'))
+    log.info("Built page %s with %s and %s", page.etag, css_url, js_url)
+    return page
+
+
+def precompressed(filename: str, accept_encoding: str, static_root: str) -> Tuple[Optional[str], str]:
+    """(content-coding, filename to send) for a static file, preferring a compressed copy the client accepts"""
+    if filename.startswith('dist/') and filename.endswith(COMPRESSIBLE):
+        suffixes = {coding: suffix for coding, suffix in ENCODINGS
+                    if os.path.exists(os.path.join(static_root, filename + suffix))}
+        coding = choose_coding(accept_encoding, list(suffixes))
+        if coding is not None:
+            return coding, filename + suffixes[coding]
+    return None, filename
+
+
+if __name__ == '__main__':
+    log_pipeline.configure('assets.log')
+    built = build()
+    print(f"index: {len(built.body)} bytes, " + ", ".join(f"{coding}: {len(body)} bytes"
+                                                          for coding, body in built.encoded.items()))
@@ -0,0 +1,359 @@
+from typing import Any, Dict, Optional
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import urlsplit
+import asyncio
+import atexit
+import concurrent.futures
+import contextvars
+import json
+import os
+import threading
+import time
+
+import aiohttp
+import requests
+
+import metrics
+from upstream import (RETRY_STATUSES, UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_MAX_RETRIES, UPSTREAM_MAX_RETRY_AFTER,
+                      UPSTREAM_POOL_SIZE, backoff_delay, capped, expired, fits, retry_after_seconds, time_left)
+
+GROQ_CONCURRENCY = int(os.getenv('GROQ_CONCURRENCY', 16))
+GROQ_MAX_WAITING = int(os.getenv('GROQ_MAX_WAITING', 256))
+STABILITY_CONCURRENCY = int(os.getenv('STABILITY_CONCURRENCY', 4))
+STABILITY_MAX_WAITING = int(os.getenv('STABILITY_MAX_WAITING', 64))
+UPSTREAM_MAX_QUEUE_WAIT = float(os.getenv('UPSTREAM_MAX_QUEUE_WAIT', 10))
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv('UPSTREAM_MAX_CONCURRENCY', 32))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+UPSTREAM_IN_FLIGHT = metrics.Gauge('vardovia_upstream_in_flight', 'Async upstream calls holding a provider slot', ('provider',))
+UPSTREAM_WAITING = metrics.Gauge('vardovia_upstream_waiting', 'Async upstream calls queued for a provider slot', ('provider',))
+UPSTREAM_SHED = metrics.Counter('vardovia_upstream_shed_total', 'Upstream calls rejected before being sent', ('provider', 'reason'))
+
+
+class Overloaded(Exception):
+    """A provider's wait queue is full, or a slot did not free up in time"""
+
+    def __init__(self, provider: str, reason: str, retry_after: float = 1.0):
+        super().__init__(f"{provider} is busy ({reason}), please retry in a moment")
+        self.provider = provider
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class UpstreamCeiling:
+    """Process-wide cap on upstream calls in flight, across providers, threads and loops.
+
+    The provider limiters queue within their own budget; this is the hard
+    ceiling over all of them plus the synchronous LLM calls.
+    A call that finds it full is shed rather than queued. 0 disables it.
+    """
+
+    def __init__(self, limit: int = UPSTREAM_MAX_CONCURRENCY):
+        self.limit = limit
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, provider: str):
+        with self._lock:
+            if self.limit and self.in_flight >= self.limit:
+                full = True
+            else:
+                full = False
+                self.in_flight += 1
+        if full:
+            UPSTREAM_SHED.inc(provider=provider, reason='ceiling')
+            raise Overloaded(provider, 'ceiling')
+        UPSTREAM_IN_FLIGHT.set(self.in_flight, provider='all')
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            UPSTREAM_IN_FLIGHT.set(self.in_flight, provider='all')
+
+    def stats(self) -> Dict[str, int]:
+        return {"limit": self.limit, "in_flight": self.in_flight}
+
+
+ceiling = UpstreamCeiling()
+
+
+class ProviderLimiter:
+    """At most `concurrency` calls in flight per provider, with a bounded wait queue.
+
+    When max_waiting calls are already queued, new ones fail immediately with
+    Overloaded instead of piling up; queued calls give up after max_wait seconds,
+    or sooner when their deadline comes first.
+    """
+
+    def __init__(self, provider: str, concurrency: int, max_waiting: int, max_wait: float = UPSTREAM_MAX_QUEUE_WAIT):
+        self.provider = provider
+        self.concurrency = concurrency
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.waiting = 0
+        self._semaphore = None
+
+    @asynccontextmanager
+    async def slot(self, deadline: Optional[float] = None):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        if self._semaphore.locked():
+            if self.waiting >= self.max_waiting:
+                self._shed('queue_full')
+            self.waiting += 1
+            UPSTREAM_WAITING.set(self.waiting, provider=self.provider)
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), capped(self.max_wait, deadline))
+            except asyncio.TimeoutError:
+                self._shed('wait_timeout')
+            finally:
+                self.waiting -= 1
+                UPSTREAM_WAITING.set(self.waiting, provider=self.provider)
+        else:
+            await self._semaphore.acquire()
+        try:
+            with ceiling.hold(self.provider):
+                self.in_flight += 1
+                UPSTREAM_IN_FLIGHT.set(self.in_flight, provider=self.provider)
+                try:
+                    yield
+                finally:
+                    self.in_flight -= 1
+                    UPSTREAM_IN_FLIGHT.set(self.in_flight, provider=self.provider)
+        finally:
+            self._semaphore.release()
+
+    def _shed(self, reason: str):
+        UPSTREAM_SHED.inc(provider=self.provider, reason=reason)
+        raise Overloaded(self.provider, reason)
+
+    def stats(self) -> Dict[str, int]:
+        return {"concurrency": self.concurrency, "in_flight": self.in_flight, "waiting": self.waiting,
+                "max_waiting": self.max_waiting,
+                "shed": sum(UPSTREAM_SHED.value(provider=self.provider, reason=reason)
+                            for reason in ('queue_full', 'wait_timeout', 'ceiling'))}
+
+
+limiters = {
+    'groq': ProviderLimiter('groq', GROQ_CONCURRENCY, GROQ_MAX_WAITING),
+    'stability': ProviderLimiter('stability', STABILITY_CONCURRENCY, STABILITY_MAX_WAITING),
+}
+
+
+class EventLoopThread:
+    """One event loop on a daemon thread that every async upstream call runs on.
+
+    Sharing a loop lets all callers share the aiohttp connection pool and the
+    provider limiters, whichever thread or loop they come from. Work keeps the
+    caller's contextvars, so spans still land in the caller's trace.
+    """
+
+    def __init__(self, name: str = 'upstream-loop'):
+        self.name = name
+        self.loop = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name=self.name, daemon=True).start()
+                self.loop = loop
+            return self.loop
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        loop = self._ensure_started()
+        context = contextvars.copy_context()
+        future = concurrent.futures.Future()
+
+        def start():
+            task = loop.create_task(coro, context=context)
+            task.add_done_callback(lambda done: _copy_outcome(done, future))
+            future.add_done_callback(lambda f: f.cancelled() and loop.call_soon_threadsafe(task.cancel))
+
+        loop.call_soon_threadsafe(start)
+        return future
+
+    def run(self, coro, timeout: Optional[float] = None) -> Any:
+        """Block the calling thread until coro has run on the loop"""
+        return self.submit(coro).result(timeout)
+
+    async def call(self, coro) -> Any:
+        """Await coro from any other event loop"""
+        return await asyncio.wrap_future(self.submit(coro))
+
+
+def _copy_outcome(task: asyncio.Task, future: concurrent.futures.Future):
+    if future.done():
+        return
+    if task.cancelled():
+        future.cancel()
+    elif task.exception() is not None:
+        future.set_exception(task.exception())
+    else:
+        future.set_result(task.result())
+
+
+class AsyncResponse:
+    """The parts of a requests.Response the callers use, for a fully read aiohttp response.
+
+    saved_bytes is set instead of content when a successful body went to a file.
+    """
+
+    def __init__(self, url: str, status_code: int, headers, content: bytes, saved_bytes: Optional[int] = None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.saved_bytes = saved_bytes
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+
+class AsyncUpstreamClient:
+    """aiohttp counterpart of upstream.UpstreamClient with the same retry policy.
+
+    Errors are raised as the matching requests exceptions so callers handle
+    both clients alike. A provider's limiter slot is held across retries, and
+    a deadline bounds the queue wait, each attempt and the waits between them.
+    """
+
+    def __init__(self, pool_size: int = UPSTREAM_POOL_SIZE, max_retries: int = UPSTREAM_MAX_RETRIES,
+                 connect_timeout: float = UPSTREAM_CONNECT_TIMEOUT):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.connect_timeout = connect_timeout
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def request(self, method: str, url: str, read_timeout: float, provider: Optional[str] = None,
+                      max_retries: Optional[int] = None, deadline: Optional[float] = None,
+                      **kwargs) -> AsyncResponse:
+        limiter = limiters.get(provider)
+        if limiter is None:
+            with ceiling.hold(provider or urlsplit(url).netloc):
+                return await self._request(method, url, read_timeout, max_retries, deadline, **kwargs)
+        async with limiter.slot(deadline):
+            return await self._request(method, url, read_timeout, max_retries, deadline, **kwargs)
+
+    async def _request(self, method: str, url: str, read_timeout: float, max_retries: Optional[int],
+                       deadline: Optional[float] = None, save_to: Optional[str] = None, save_type: str = '',
+                       **kwargs) -> AsyncResponse:
+        """save_to streams a 2xx body whose Content-Type starts with save_type to that path rather than into memory.
+
+        save_to must be a temp file of the caller's own (such as the image
+        cache's), which it renames into place once the body is complete. Any
+        other body, an error or a JSON answer, is read into content as usual.
+        With a deadline, the whole attempt, body included, must finish before it.
+        """
+        retries = self.max_retries if max_retries is None else max_retries
+        host = urlsplit(url).netloc
+        session = self._get_session()
+        attempt = 0
+        while True:
+            if expired(deadline):
+                raise requests.exceptions.Timeout(f"deadline passed before calling {url}")
+            attempt_timeout = capped(read_timeout, deadline)
+            timeout = aiohttp.ClientTimeout(total=time_left(deadline), connect=capped(self.connect_timeout, deadline),
+                                            sock_read=attempt_timeout)
+            started = time.perf_counter()
+            error = None
+            try:
+                with metrics.span('upstream_request', host=host, attempt=attempt) as attrs:
+                    async with session.request(method, url, timeout=timeout, **kwargs) as raw:
+                        if save_to is not None and 200 <= raw.status < 300 and raw.content_type.startswith(save_type):
+                            response = AsyncResponse(url, raw.status, raw.headers, b'',
+                                                     await self._download(raw, save_to))
+                        else:
+                            response = AsyncResponse(url, raw.status, raw.headers, await raw.read())
+                    attrs['status'] = response.status_code
+            except aiohttp.ConnectionTimeoutError as e:
+                error = requests.exceptions.ConnectTimeout(str(e))
+            except asyncio.TimeoutError:
+                error = requests.exceptions.ReadTimeout(f"read timed out after {attempt_timeout:.3g}s: {url}")
+            except aiohttp.ClientConnectionError as e:
+                error = requests.exceptions.ConnectionError(str(e))
+            except aiohttp.ClientPayloadError as e:
+                error = requests.exceptions.ChunkedEncodingError(str(e))
+            except aiohttp.ClientError as e:
+                error = requests.exceptions.RequestException(str(e))
+            metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - started, host=host)
+            if error is not None:
+                metrics.UPSTREAM_RESPONSES.inc(host=host, status=type(error).__name__)
+                if not isinstance(error, requests.exceptions.ConnectionError) or attempt >= retries:
+                    raise error
+                delay = backoff_delay(attempt)
+                if not fits(deadline, delay):
+                    raise error
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            metrics.UPSTREAM_RESPONSES.inc(host=host, status=response.status_code)
+            if response.status_code not in RETRY_STATUSES or attempt >= retries:
+                return response
+            delay = retry_after_seconds(response)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            elif delay > UPSTREAM_MAX_RETRY_AFTER:
+                return response
+            if not fits(deadline, delay):
+                return response
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    async def _download(raw: aiohttp.ClientResponse, path: str) -> int:
+        written = 0
+        try:
+            with open(path, 'wb') as f:
+                async for chunk in raw.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    written += len(chunk)
+            os.chmod(path, 0o644)
+        except BaseException:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        return written
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def post(self, url: str, read_timeout: float, **kwargs) -> AsyncResponse:
+        return await self.request('POST', url, read_timeout, **kwargs)
+
+    async def get(self, url: str, read_timeout: float, **kwargs) -> AsyncResponse:
+        return await self.request('GET', url, read_timeout, **kwargs)
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    return dict({provider: limiter.stats() for provider, limiter in limiters.items()}, all=ceiling.stats())
+
+
+def shutdown():
+    """Close pooled connections; registered to run at exit"""
+    if engine.loop is not None and engine.loop.is_running():
+        engine.run(client.close(), timeout=5)
+
+
+engine = EventLoopThread()
+client = AsyncUpstreamClient()
+atexit.register(shutdown)
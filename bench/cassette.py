@@ -0,0 +1,163 @@
+"""Record and replay upstream HTTP exchanges for headless runs.
+
+A cassette is a JSON-lines file. Each upstream request gets one exchange line,
+tagged with the scenario that made it and its position in that scenario:
+
+    {"scenario": "s001", "seq": 0, "method": "POST", "url": "...",
+     "request_sha": "...", "status": 200, "headers": {...}, "body": "..."}
+
+Each finished turn gets a line with the state it produced, the reference
+that replays are checked against for state drift:
+
+    {"scenario": "s001", "turn": 0, "action": "...", "state": {...}}
+
+CassetteAdapter is mounted on upstream.client.session, which every
+synchronous Groq and Stability call goes through. When recording, it
+forwards each request to the real transport and keeps a copy of the
+exchange. When replaying, it never opens a socket. A request gets the
+scenario's unused exchange with the same method, path and body. Failing
+that, it gets the next unused exchange with the same method and path (a
+prompt change, say), and those are counted as request drift. Hosts are
+ignored, so a cassette recorded against the mock replays against any URL
+configuration.
+"""
+import base64
+import hashlib
+import io
+import json
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+KEPT_HEADERS = ('content-type', 'retry-after', 'finish-reason')
+
+
+class CassetteMiss(requests.exceptions.RequestException):
+    """Replay asked for an exchange the cassette doesn't have"""
+
+
+def request_sha(request: requests.PreparedRequest) -> str:
+    body = request.body or b''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return hashlib.sha256(request.method.encode() + b' ' + urlsplit(request.url).path.encode() + b'\n' + body).hexdigest()
+
+
+def build_response(request: requests.PreparedRequest, status: int, headers, body: bytes) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(headers)
+    response.raw = io.BytesIO(body)
+    response.url = request.url
+    response.request = request
+    response.reason = 'OK' if status < 400 else 'Error'
+    response.encoding = get_encoding_from_headers(response.headers)
+    return response
+
+
+def encode_body(body: bytes, entry: dict):
+    try:
+        entry['body'] = body.decode('utf-8')
+    except UnicodeDecodeError:
+        entry['body_b64'] = base64.b64encode(body).decode('ascii')
+
+
+def decode_body(entry: dict) -> bytes:
+    if 'body_b64' in entry:
+        return base64.b64decode(entry['body_b64'])
+    return entry.get('body', '').encode('utf-8')
+
+
+class CassetteAdapter(HTTPAdapter):
+    """Transport adapter that records exchanges, or replays them without a network"""
+
+    def __init__(self, replay=None):
+        super().__init__(max_retries=0)
+        self.replaying = replay is not None
+        self._tapes = {}
+        for entry in replay or []:
+            if 'seq' in entry:
+                self._tapes.setdefault(entry['scenario'], []).append(entry)
+        for tape in self._tapes.values():
+            tape.sort(key=lambda entry: entry['seq'])
+        self._local = threading.local()
+        self.recorded = []
+        self.request_drift = 0
+        self.misses = 0
+
+    def start(self, scenario: str):
+        """Begin a scenario in the current thread; its requests are numbered from 0"""
+        self._local.scenario = scenario
+        self._local.seq = 0
+        self._local.used = set()
+
+    def _next_seq(self):
+        seq = self._local.seq
+        self._local.seq += 1
+        return self._local.scenario, seq
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        scenario, seq = self._next_seq()
+        sha = request_sha(request)
+        if self.replaying:
+            return self._replay(request, scenario, seq, sha)
+        entry = {"scenario": scenario, "seq": seq, "method": request.method, "url": request.url, "request_sha": sha}
+        try:
+            response = super().send(request, stream=stream, timeout=timeout, verify=verify, cert=cert, proxies=proxies)
+            body = response.content
+        except requests.exceptions.RequestException as e:
+            entry["error"] = type(e).__name__
+            entry["message"] = str(e)
+            self.recorded.append(entry)
+            raise
+        headers = {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers}
+        entry.update(status=response.status_code, headers=headers)
+        encode_body(body, entry)
+        self.recorded.append(entry)
+        return build_response(request, response.status_code, headers, body)
+
+    def _replay(self, request, scenario, seq, sha):
+        tape = self._tapes.get(scenario, [])
+        used = self._local.used
+        path = urlsplit(request.url).path
+        unused = [i for i in range(len(tape)) if i not in used]
+        match = next((i for i in unused if tape[i]['request_sha'] == sha), None)
+        if match is None:
+            match = next((i for i in unused if tape[i]['method'] == request.method
+                          and urlsplit(tape[i]['url']).path == path), None)
+            if match is None:
+                self.misses += 1
+                raise CassetteMiss(f"no recorded exchange for request {seq} of scenario {scenario}: "
+                                   f"{request.method} {path}")
+            self.request_drift += 1
+        used.add(match)
+        entry = tape[match]
+        if 'error' in entry:
+            error = getattr(requests.exceptions, entry['error'], requests.exceptions.ConnectionError)
+            raise error(entry.get('message', 'recorded failure'))
+        return build_response(request, entry['status'], entry.get('headers', {}), decode_body(entry))
+
+
+def load(path: str):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def expected_states(entries):
+    """{scenario: {turn: state}} from a cassette's turn lines"""
+    expected = {}
+    for entry in entries:
+        if 'turn' in entry:
+            expected.setdefault(entry['scenario'], {})[entry['turn']] = entry['state']
+    return expected
+
+
+def save(path: str, entries):
+    with open(path, 'w', encoding='utf-8') as f:
+        for entry in sorted(entries, key=lambda entry: (entry['scenario'], 'turn' in entry,
+                                                        entry.get('seq', entry.get('turn')))):
+            f.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + "\n")
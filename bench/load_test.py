@@ -0,0 +1,240 @@
+"""Load-test /api/action with many concurrent simulated players.
+
+By default the game runs in-process against bench.mock_upstream, so no paid
+API is touched:
+
+    python -m bench.load_test --players 50 --turns 5 --output results.json
+
+Use --url to drive an already running server instead (point that server at
+the mock with GROQ_API_URL/STABILITY_API_URL). The report is JSON so runs can
+be diffed across commits.
+"""
+from contextlib import redirect_stdout
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from bench.mock_upstream import MockConfig, start_mock_server, urls_for
+
+ACTIONS = [
+    "search the room", "try the door", "talk to the guard", "hide under the bed",
+    "look through the keyhole", "ask Viktor about the warden", "examine the crumpled note",
+]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def latency_summary(values):
+    if not values:
+        return {}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 2),
+        "p50": round(percentile(values, 50), 2),
+        "p95": round(percentile(values, 95), 2),
+        "p99": round(percentile(values, 99), 2),
+        "max": round(max(values), 2),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class InProcessClient:
+    """One player's cookie jar against the Flask app itself"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, path, payload):
+        response = self.client.post(path, json=payload)
+        return response.status_code, response.get_data()
+
+    def get(self, path):
+        response = self.client.get(path)
+        return response.status_code, response.get_data()
+
+
+class HttpClient:
+    """One player's keep-alive session against a running server"""
+
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+
+    def post(self, path, payload):
+        response = self.session.post(self.base_url + path, json=payload, timeout=120)
+        return response.status_code, response.content
+
+    def get(self, path):
+        response = self.session.get(self.base_url + path, timeout=120)
+        return response.status_code, response.content
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.turn_ms = []
+        self.image_ms = []
+        self.statuses = {}
+        self.errors = 0
+        self.image_failures = 0
+
+    def record_turn(self, status, elapsed_ms, ok):
+        with self.lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if ok:
+                self.turn_ms.append(elapsed_ms)
+            else:
+                self.errors += 1
+
+    def record_image(self, elapsed_ms, ok):
+        with self.lock:
+            if ok:
+                self.image_ms.append(elapsed_ms)
+            else:
+                self.image_failures += 1
+
+
+def wait_for_image(client, job_id, results, started):
+    while True:
+        status, body = client.get(f'/api/image/{job_id}?wait=25')
+        if status != 200:
+            results.record_image(0, False)
+            return
+        job = json.loads(body)
+        if job['status'] == 'done':
+            results.record_image((time.perf_counter() - started) * 1000, True)
+            return
+        if job['status'] in ('failed', 'cancelled'):
+            results.record_image(0, False)
+            return
+
+
+def play(client, turns, stream, images, think_time, results, rng):
+    path = '/api/action/stream' if stream else '/api/action'
+    for _ in range(turns):
+        payload = {"action": rng.choice(ACTIONS), "image_generation_enabled": images}
+        started = time.perf_counter()
+        try:
+            status, body = client.post(path, payload)
+        except Exception:
+            results.record_turn('exception', (time.perf_counter() - started) * 1000, False)
+            continue
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        ok = status == 200 and (not stream or b'event: done' in body)
+        results.record_turn(status, elapsed_ms, ok)
+        if ok and images and not stream:
+            job_id = json.loads(body).get('image_job_id')
+            if job_id:
+                wait_for_image(client, job_id, results, started)
+        if think_time:
+            time.sleep(rng.uniform(0, think_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent-player load test for /api/action")
+    parser.add_argument('--players', type=int, default=20)
+    parser.add_argument('--turns', type=int, default=5, help="turns per player")
+    parser.add_argument('--url', help="drive a running server instead of the in-process app")
+    parser.add_argument('--stream', action='store_true', help="use /api/action/stream")
+    parser.add_argument('--images', action='store_true', help="request scene images and wait for them")
+    parser.add_argument('--think-time', type=float, default=0.0, help="max random pause between turns")
+    parser.add_argument('--mock-latency', type=float, default=0.5)
+    parser.add_argument('--mock-jitter', type=float, default=0.2)
+    parser.add_argument('--mock-image-latency', type=float, default=2.0)
+    parser.add_argument('--mock-token-delay', type=float, default=0.005)
+    parser.add_argument('--mock-error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--label', default=None, help="free-form tag stored in the report")
+    parser.add_argument('--output', help="write the JSON report to this file as well")
+    parser.add_argument('--verbose', action='store_true', help="keep the server's own output")
+    args = parser.parse_args()
+
+    mock = None
+    if args.url:
+        make_client = lambda: HttpClient(args.url)
+    else:
+        config = MockConfig(args.mock_latency, args.mock_jitter, args.mock_error_rate,
+                            args.mock_token_delay, args.mock_image_latency, args.seed)
+        mock, base_url = start_mock_server(config=config)
+        os.environ.update(urls_for(base_url))
+        os.environ.setdefault('GROQ_API_KEY', 'mock')
+        os.environ.setdefault('STABILITY_API_KEY', 'mock')
+        os.environ.setdefault('IMAGE_CACHE_DIR', tempfile.mkdtemp(prefix='vardovia-bench-images-'))
+        # every simulated player shares one IP and plays back to back
+        os.environ.setdefault('RATE_LIMIT_IP_PER_MINUTE', '0')
+        os.environ.setdefault('RATE_LIMIT_SESSION_PER_MINUTE', '0')
+        with redirect_stdout(sys.stderr):
+            import web_interface
+        make_client = lambda: InProcessClient(web_interface.app)
+
+    results = Results()
+    rng = random.Random(args.seed)
+    players = [threading.Thread(target=play, args=(make_client(), args.turns, args.stream, args.images,
+                                                   args.think_time, results, random.Random(rng.random())))
+               for _ in range(args.players)]
+
+    sink = sys.stderr if args.verbose else open(os.devnull, 'w')
+    started = time.perf_counter()
+    with redirect_stdout(sink):
+        for player in players:
+            player.start()
+        for player in players:
+            player.join()
+    wall = time.perf_counter() - started
+
+    total = len(results.turn_ms) + results.errors
+    report = {
+        "label": args.label,
+        "commit": git_commit(),
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "target": args.url or "in-process",
+        "config": {"players": args.players, "turns": args.turns, "stream": args.stream, "images": args.images,
+                   "think_time": args.think_time, "mock_latency": args.mock_latency,
+                   "mock_image_latency": args.mock_image_latency, "mock_error_rate": args.mock_error_rate},
+        "wall_seconds": round(wall, 3),
+        "turns": total,
+        "errors": results.errors,
+        "error_rate": round(results.errors / total, 4) if total else 0.0,
+        "throughput_turns_per_s": round(len(results.turn_ms) / wall, 2) if wall else 0.0,
+        "turn_latency_ms": latency_summary(results.turn_ms),
+        "image_latency_ms": latency_summary(results.image_ms),
+        "image_failures": results.image_failures,
+        "status_counts": {str(status): count for status, count in sorted(results.statuses.items(), key=str)},
+    }
+    if mock is not None:
+        report["upstream_requests"] = dict(mock.RequestHandlerClass.config.counts)
+        mock.shutdown()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""Local stand-ins for the Groq chat-completions and Stability text-to-image APIs.
+
+    python -m bench.mock_upstream --port 8089 --latency 0.8 --error-rate 0.02
+
+then point the game at it:
+
+    GROQ_API_URL=http://127.0.0.1:8089/openai/v1/chat/completions
+    STABILITY_API_URL=http://127.0.0.1:8089/v1/generation/mock/text-to-image
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import base64
+import io
+import json
+import random
+import re
+import threading
+import time
+
+from PIL import Image
+
+CHAT_PATH = '/openai/v1/chat/completions'
+IMAGE_PATH_PATTERN = re.compile(r'^/v1/generation/[^/]+/text-to-image$')
+
+NARRATIONS = [
+    "The bulb above you flickers. Somewhere down the corridor a door slams and boots echo on wet concrete.",
+    "A guard mutters in Vardovian as he passes, keys jangling at his belt. The smell of boiled cabbage drifts in.",
+    "You press your ear to the cold wall. Two voices argue about a transfer scheduled before dawn.",
+    "Dust falls from the ceiling as a truck rumbles past outside. The radio in the guard room crackles with static.",
+]
+
+
+class MockConfig:
+    def __init__(self, latency=0.5, jitter=0.2, error_rate=0.0, token_delay=0.01, image_latency=2.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.token_delay = token_delay
+        self.image_latency = image_latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {"chat": 0, "chat_stream": 0, "image": 0, "errors": 0}
+
+    def delay(self, base):
+        with self.lock:
+            return max(0.0, base + self.random.uniform(-self.jitter, self.jitter))
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+
+_png_cache = {}
+_png_lock = threading.Lock()
+
+
+def mock_png(width, height):
+    with _png_lock:
+        if (width, height) not in _png_cache:
+            buffer = io.BytesIO()
+            Image.new('RGB', (width, height), (40, 44, 38)).save(buffer, 'PNG')
+            _png_cache[width, height] = buffer.getvalue()
+        return _png_cache[width, height]
+
+
+def mock_completion(messages, rng, structured=False):
+    """Build a reply from the request's own state, in the text protocol or as a structured-output object"""
+    previous = None
+    for message in messages:
+        content = message.get('content', '')
+        if content.startswith('PREVIOUS_STATE_JSON:'):
+            try:
+                previous = json.loads(content[len('PREVIOUS_STATE_JSON:'):].strip())
+            except ValueError:
+                previous = None
+    if previous is None:
+        return "The prisoner was held in the basement and is looking for a way out."
+    state = dict(previous)
+    state.setdefault('player_name', 'Arsen Dvorak')
+    state.setdefault('location', 'Basement')
+    state.setdefault('inventory', [])
+    state.setdefault('health', 90)
+    state['danger'] = min(10, max(1, int(state.get('danger', 1) or 1) + rng.choice((-1, 0, 1))))
+    if not re.match(r'^\d{2}:\d{2}$', str(state.get('time', ''))):
+        state['time'] = '21:40'
+    narration = rng.choice(NARRATIONS)
+    image_prompt = f"dim prison corridor in {state['location']}, 1989, bare bulb, concrete walls"
+    if structured:
+        return json.dumps({"state": state, "narration": narration, "image_prompt": image_prompt})
+    return (f"GAME_STATE_JSON: {json.dumps(state, separators=(',', ':'))}\n\n{narration}\n\n"
+            f"[IMAGE_PROMPT: {image_prompt}]")
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config = MockConfig()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _send(self, status, body, content_type='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _fail(self):
+        self.config.count("errors")
+        if self.config.random.random() < 0.5:
+            self._send(429, {"error": {"message": "rate limited (mock)"}}, headers={'Retry-After': '1'})
+        else:
+            self._send(503, {"message": "upstream unavailable (mock)"})
+
+    def do_POST(self):
+        payload = self._read_json()
+        if self.path == CHAT_PATH:
+            self._chat(payload)
+        elif IMAGE_PATH_PATTERN.match(self.path):
+            self._image(payload)
+        else:
+            self._send(404, {"message": "not found"})
+
+    def _chat(self, payload):
+        time.sleep(self.config.delay(self.config.latency))
+        if self.config.should_fail():
+            return self._fail()
+        with self.config.lock:
+            content = mock_completion(payload.get('messages', []), self.config.random,
+                                      structured=bool(payload.get('response_format')))
+        usage = {"prompt_tokens": sum(len(m.get('content', '')) for m in payload.get('messages', [])) // 4,
+                 "completion_tokens": len(content) // 4}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if not payload.get('stream'):
+            self.config.count("chat")
+            return self._send(200, {
+                "id": "mock-chat", "object": "chat.completion", "model": payload.get('model'),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        self.config.count("chat_stream")
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        for token in re.findall(r'\S+\s*|\s+', content):
+            chunk = {"choices": [{"index": 0, "delta": {"content": token}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+            if self.config.token_delay:
+                time.sleep(self.config.token_delay)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def _image(self, payload):
+        time.sleep(self.config.delay(self.config.image_latency))
+        if self.config.should_fail():
+            return self._fail()
+        self.config.count("image")
+        png = mock_png(int(payload.get('width', 1024)), int(payload.get('height', 1024)))
+        if self.headers.get('Accept', '').startswith('image/'):
+            return self._send(200, png, content_type='image/png')
+        self._send(200, {"artifacts": [{"base64": base64.b64encode(png).decode('ascii'),
+                                        "seed": payload.get('seed', 0), "finishReason": "SUCCESS"}]})
+
+
+def start_mock_server(host='127.0.0.1', port=0, config=None):
+    """Start the mock server on a background thread and return (server, base_url)"""
+    handler = type('ConfiguredMockHandler', (MockHandler,), {"config": config or MockConfig()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-upstream", daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+
+def urls_for(base_url):
+    return {
+        "GROQ_API_URL": base_url + CHAT_PATH,
+        "STABILITY_API_URL": base_url + "/v1/generation/mock/text-to-image",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Groq and Stability endpoints for local testing")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.5, help="chat completion latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.2, help="uniform +/- jitter applied to every latency")
+    parser.add_argument('--token-delay', type=float, default=0.01, help="delay between streamed tokens")
+    parser.add_argument('--image-latency', type=float, default=2.0, help="text-to-image latency in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with 429/503")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    config = MockConfig(args.latency, args.jitter, args.error_rate, args.token_delay, args.image_latency, args.seed)
+    server, base_url = start_mock_server(args.host, args.port, config)
+    for name, url in urls_for(base_url).items():
+        print(f"{name}={url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
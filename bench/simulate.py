@@ -0,0 +1,253 @@
+"""Play scripted games headlessly across a process pool, recording or replaying upstream traffic.
+
+Each scenario is a list of player actions played from the CLI's starting state
+through the same turn pipeline as the game (main.take_turn: prompt, model call,
+parse, repair, sanity check, clock). Scenarios come from a JSON file
+([{"name": ..., "actions": [...]}, ...]) or are generated from --seed.
+
+    python -m bench.simulate --mock --count 40 --turns 8 --record runs/base.jsonl
+    python -m bench.simulate --replay runs/base.jsonl --output report.json
+
+--record saves every Groq/Stability exchange and every turn's resulting state
+to a cassette (see bench.cassette). --replay plays the cassette's scenarios
+again with no network, so turn time is the local pipeline alone. It then
+reports the turns whose state now differs from the recording (state drift)
+and the requests whose body changed (request drift, e.g. after editing
+SYSTEM_PROMPT). Without either flag the run goes to whatever GROQ_API_URL /
+STABILITY_API_URL point at, or to the mock with --mock.
+"""
+from collections import Counter
+from itertools import repeat
+import argparse
+import concurrent.futures
+import copy
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from bench import cassette
+from bench.load_test import ACTIONS, git_commit, latency_summary
+from bench.mock_upstream import MockConfig, start_mock_server, urls_for
+
+SCRIPT_ACTIONS = ACTIONS + ["inventory", "what time is it"]
+STORY_LOG_LIMIT = 8  # what the CLI keeps
+
+_adapter = None
+
+
+def init_worker(env, replay, quiet):
+    """Process pool initializer: configure the game and route its HTTP through the cassette"""
+    global _adapter
+    os.environ.update(env)
+    if quiet:
+        logging.getLogger('vardovia').setLevel(logging.ERROR)
+    import upstream
+    _adapter = cassette.CassetteAdapter(replay)
+    upstream.client.session.mount('http://', _adapter)
+    upstream.client.session.mount('https://', _adapter)
+
+
+def stage_spans(trace, stage):
+    return [span for span in trace.to_dict()['spans'] if span['stage'] == stage]
+
+
+def play_scenario(scenario, images):
+    """Play one scenario in this worker; returns its per-turn records and recorded exchanges"""
+    import requests
+    import local_commands
+    import main
+    import metrics
+    import state_repair
+    from prompt_builder import SUMMARY_KEEP_RECENT, StorySummarizer, compact_story, needs_compaction
+
+    summarizer = StorySummarizer(main.call_groq_summary)
+    _adapter.start(scenario['name'])
+    drift, misses = _adapter.request_drift, _adapter.misses
+    state = copy.deepcopy(main.BOOTSTRAP_STATE)
+    story = {"story_log": [], "story_summary": ""}
+    turns = []
+    for index, action in enumerate(scenario['actions']):
+        reply = local_commands.route(action, state)
+        if reply is not None:
+            turns.append({"turn": index, "action": action, "outcome": "local", "state": state})
+            continue
+
+        trace, token = metrics.start_trace()
+        started = time.perf_counter()
+        turn, outcome = None, 'ok'
+        try:
+            turn = main.take_turn(state, list(story['story_log']), story['story_summary'], action,
+                                  main.generate_image if images else None)
+        except state_repair.StateRepairError:
+            outcome = 'failed'
+        except requests.exceptions.RequestException:
+            outcome = 'upstream_error'
+        except main.DeadlineExceeded:
+            outcome = 'deadline'
+        finally:
+            metrics.end_trace(token)
+        parse, sanity = stage_spans(trace, 'parse'), stage_spans(trace, 'sanity_check')
+        record = {
+            "turn": index,
+            "action": action,
+            "outcome": outcome,
+            "ms": round((time.perf_counter() - started) * 1000, 3),
+            "pipeline_ms": round(sum(span['ms'] for span in parse + sanity), 3),
+            "parse_failures": sum(1 for span in parse if span.get('error')),
+            "sanity_failures": sum(1 for span in sanity if span.get('ok') is False),
+            "attempts": len(turn['responses']) if turn else None,
+            "repairs": turn['repairs'] if turn else [],
+        }
+        if turn is not None:
+            state = turn['state']
+            story_log = story['story_log']
+            story_log.append(turn['narration'])
+            del story_log[:-STORY_LOG_LIMIT]
+            if needs_compaction(story_log, turn['prompt_stats']):
+                narrations = story_log[:max(0, len(story_log) - SUMMARY_KEEP_RECENT)]
+                if narrations:
+                    compact_story(story, narrations, summarizer.summarize_now(story['story_summary'], narrations))
+        record["state"] = state
+        turns.append(record)
+        flags = state.get('flags') or {}
+        if flags.get('escaped') or flags.get('dead'):
+            break
+
+    exchanges, _adapter.recorded = _adapter.recorded, []
+    return {"name": scenario['name'], "turns": turns, "exchanges": exchanges,
+            "request_drift": _adapter.request_drift - drift, "misses": _adapter.misses - misses}
+
+
+def generate_scenarios(count, turns, seed):
+    rng = random.Random(seed)
+    return [{"name": f"s{i:03d}", "actions": [rng.choice(SCRIPT_ACTIONS) for _ in range(turns)]}
+            for i in range(count)]
+
+
+def scenarios_from_cassette(entries):
+    actions = {}
+    for entry in entries:
+        if 'turn' in entry:
+            actions.setdefault(entry['scenario'], {})[entry['turn']] = entry['action']
+    return [{"name": name, "actions": [by_turn[turn] for turn in sorted(by_turn)]}
+            for name, by_turn in sorted(actions.items())]
+
+
+def state_drift(results, expected):
+    """Turns whose state differs from the recorded one, and which top-level fields differ"""
+    compared, drifted, fields = 0, 0, Counter()
+    for result in results:
+        reference = expected.get(result['name'], {})
+        for turn in result['turns']:
+            if turn['turn'] not in reference:
+                continue
+            compared += 1
+            old, new = reference[turn['turn']], turn['state']
+            changed = [key for key in set(old) | set(new) if old.get(key) != new.get(key)]
+            if changed:
+                drifted += 1
+                fields.update(changed)
+    return {"compared": compared, "drifted": drifted, "fields": dict(fields.most_common())}
+
+
+def build_report(args, mode, results, wall, expected):
+    turns = [turn for result in results for turn in result['turns'] if turn['outcome'] != 'local']
+    completed = [turn for turn in turns if turn['outcome'] == 'ok']
+    report = {
+        "label": args.label,
+        "commit": git_commit(),
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "mode": mode,
+        "cassette": args.record or args.replay,
+        "config": {"scenarios": len(results), "workers": args.workers, "images": args.images},
+        "wall_seconds": round(wall, 3),
+        "turns": len(turns),
+        "local_turns": sum(1 for result in results for turn in result['turns'] if turn['outcome'] == 'local'),
+        "turns_per_s": round(len(turns) / wall, 2) if wall else 0.0,
+        "outcomes": dict(Counter(turn['outcome'] for turn in turns)),
+        "parse_failures": sum(turn['parse_failures'] for turn in turns),
+        "sanity_failures": sum(turn['sanity_failures'] for turn in turns),
+        "reprompts": sum(1 for turn in turns if (turn['attempts'] or 0) > 1),
+        "repairs": dict(Counter(repair for turn in turns for repair in turn['repairs']).most_common()),
+        "turn_ms": latency_summary([turn['ms'] for turn in completed]),
+        "pipeline_ms": latency_summary([turn['pipeline_ms'] for turn in completed]),
+    }
+    if mode == 'replay':
+        report["state_drift"] = state_drift(results, expected)
+        report["request_drift"] = sum(result['request_drift'] for result in results)
+        report["cassette_misses"] = sum(result['misses'] for result in results)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless batch simulation with upstream record/replay")
+    parser.add_argument('--scenarios', help="JSON file of scenarios; default: generated from --seed")
+    parser.add_argument('--count', type=int, default=20, help="scenarios to generate")
+    parser.add_argument('--turns', type=int, default=6, help="actions per generated scenario")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--record', metavar='CASSETTE', help="save upstream exchanges and turn states here")
+    mode.add_argument('--replay', metavar='CASSETTE', help="answer upstream requests from this cassette")
+    parser.add_argument('--mock', action='store_true', help="play against bench.mock_upstream")
+    parser.add_argument('--mock-latency', type=float, default=0.05)
+    parser.add_argument('--images', action='store_true', help="generate scene images too")
+    parser.add_argument('--label', default=None, help="free-form tag stored in the report")
+    parser.add_argument('--output', help="write the JSON report to this file as well")
+    parser.add_argument('--verbose', action='store_true', help="keep the game's warnings")
+    args = parser.parse_args()
+
+    env = {"LLM_HEDGE": "0", "IMAGE_CACHE_DIR": tempfile.mkdtemp(prefix='vardovia-sim-images-')}
+    mock = None
+    if args.mock and not args.replay:
+        mock, base_url = start_mock_server(config=MockConfig(args.mock_latency, 0.0, 0.0, 0.0, args.mock_latency,
+                                                             args.seed))
+        env.update(urls_for(base_url))
+    env.setdefault('GROQ_API_KEY', os.getenv('GROQ_API_KEY') or 'offline')
+    env.setdefault('STABILITY_API_KEY', os.getenv('STABILITY_API_KEY') or 'offline')
+
+    replay, expected = None, {}
+    if args.replay:
+        replay = cassette.load(args.replay)
+        expected = cassette.expected_states(replay)
+    if args.scenarios:
+        with open(args.scenarios, encoding='utf-8') as f:
+            scenarios = json.load(f)
+    elif replay is not None:
+        scenarios = scenarios_from_cassette(replay)
+    else:
+        scenarios = generate_scenarios(args.count, args.turns, args.seed)
+
+    started = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                                initargs=(env, replay, not args.verbose)) as pool:
+        results = list(pool.map(play_scenario, scenarios, repeat(args.images)))
+    wall = time.perf_counter() - started
+    if mock is not None:
+        mock.shutdown()
+
+    if args.record:
+        entries = [exchange for result in results for exchange in result['exchanges']]
+        entries += [{"scenario": result['name'], "turn": turn['turn'], "action": turn['action'], "state": turn['state']}
+                    for result in results for turn in result['turns']]
+        cassette.save(args.record, entries)
+
+    report = build_report(args, 'replay' if args.replay else 'record' if args.record else 'live', results, wall,
+                          expected)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Microbenchmark of the per-turn state handling: validation, clock and serialization.
+
+    python -m bench.state_bench --turns 20000 --output state.json
+
+"dict" replays what a turn did with a loose state dict: json.dumps for the
+prompt, a field-by-field sanity check, an "HH:MM" re-parse to advance the
+clock, then json.dumps again for the HTTP response and for the journal
+entry. "typed" does the same work through game_state.GameState: one
+validating from_dict, an integer clock, one to_json() whose bytes are spliced
+into the response and journal entry, and the next turn's prompt reusing them.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from bench.load_test import git_commit
+from game_state import GameState, splice
+
+SAMPLE_STATE = {
+    "player_name": "Arsen Dvorak",
+    "location": "Boiler Room",
+    "inventory": ["wristwatch", "crumpled note", "rusty key", "guard's lighter"],
+    "health": 72,
+    "danger": 6,
+    "time": "23:55",
+    "flags": {"initialized": True, "door_open": True, "met_elena": True, "alarm": False},
+    "npcs": [{"name": "Elena Petrov", "attitude": "wary", "trust": 4, "state": "changing bandages"},
+             {"name": "Viktor", "attitude": "friendly", "trust": 7}],
+    "objectives": ["Find the service tunnel", "Get the warden's ledger to Elena"],
+}
+NARRATION = ("The boiler hisses as you slip between the pipes. Elena glances at the door, then back at you, "
+             "and presses a folded map into your hand without a word.")
+
+
+def legacy_sanity_check(state):
+    if not isinstance(state, dict):
+        return False, "state not a dict"
+    if 'player_name' not in state or not isinstance(state.get('player_name'), str):
+        return False, "missing or invalid player_name"
+    if 'location' not in state or not isinstance(state.get('location'), str):
+        return False, "missing or invalid location"
+    if 'inventory' not in state or not isinstance(state.get('inventory'), list):
+        return False, "missing or invalid inventory"
+    if 'health' not in state or not isinstance(state.get('health'), (int, float)):
+        return False, "missing or invalid health"
+    if 'danger' not in state or not isinstance(state.get('danger'), (int, float)):
+        return False, "missing or invalid danger"
+    if state['health'] < 0 or state['health'] > 1000:
+        return False, "health out of bounds"
+    if state['danger'] < 0 or state['danger'] > 100:
+        return False, "danger out of bounds"
+    if 'time' not in state or not isinstance(state.get('time'), str):
+        return False, "missing or invalid time"
+    return True, "ok"
+
+
+def legacy_advance_time(time_str, minutes):
+    h, m = map(int, time_str.split(":"))
+    total = (h * 60 + m + minutes) % (24 * 60)
+    return f"{total // 60:02d}:{total % 60:02d}"
+
+
+def response_payload():
+    return {"narration": NARRATION, "state_version": 12, "image_url": None, "image_job_id": None}
+
+
+def journal_entry():
+    return {"state_version": 12, "action": "search the room", "narration": NARRATION, "repairs": []}
+
+
+def dict_turn(previous, model_state):
+    prompt = json.dumps(previous, separators=(',', ':'))
+    ok, _ = legacy_sanity_check(model_state)
+    state = dict(model_state, time=legacy_advance_time(model_state["time"], 5))
+    body = json.dumps(dict(response_payload(), state=state), separators=(',', ':')).encode('utf-8')
+    line = json.dumps(dict(journal_entry(), state=state), separators=(',', ':')).encode('utf-8')
+    return state, len(prompt) + len(body) + len(line)
+
+
+def typed_turn(previous, model_state):
+    prompt = previous.json_text()
+    state = GameState.from_dict(model_state).advanced(5)
+    raw = state.to_json()
+    body = splice(response_payload(), 'state', raw)
+    line = splice(journal_entry(), 'state', raw)
+    return state, len(prompt) + len(body) + len(line)
+
+
+def measure(turn, previous, model_state, turns):
+    started = time.perf_counter()
+    for _ in range(turns):
+        previous, _ = turn(previous, model_state)
+    return (time.perf_counter() - started) / turns * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-turn state validation and serialization cost")
+    parser.add_argument('--turns', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5, help="runs per variant; the fastest is reported")
+    parser.add_argument('--label', default=None, help="free-form tag stored in the report")
+    parser.add_argument('--output', help="write the JSON report to this file as well")
+    args = parser.parse_args()
+
+    results = {}
+    for name, turn, previous in (("dict", dict_turn, dict(SAMPLE_STATE)),
+                                 ("typed", typed_turn, GameState.from_dict(SAMPLE_STATE))):
+        results[name] = round(min(measure(turn, previous, SAMPLE_STATE, args.turns) for _ in range(args.repeat)), 3)
+    report = {
+        "label": args.label,
+        "commit": git_commit(),
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "turns": args.turns,
+        "state_bytes": len(GameState.from_dict(SAMPLE_STATE).to_json()),
+        "us_per_turn": results,
+        "speedup": round(results["dict"] / results["typed"], 2) if results["typed"] else None,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
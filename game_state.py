@@ -0,0 +1,226 @@
+from typing import Any, Dict, Hashable, Optional, Tuple, Union
+from collections import OrderedDict
+import json
+import threading
+
+MINUTES_PER_DAY = 24 * 60
+HEALTH_BOUNDS = (0, 1000)
+DANGER_BOUNDS = (0, 100)
+STATE_CACHE_SIZE = 10000
+
+
+class InvalidState(ValueError):
+    pass
+
+
+def parse_clock(value: Any) -> int:
+    """Minutes past midnight for an "HH:MM" string"""
+    if not isinstance(value, str) or len(value) != 5 or value[2] != ':':
+        raise InvalidState("missing or invalid time")
+    try:
+        hours, minutes = int(value[:2]), int(value[3:])
+    except ValueError:
+        raise InvalidState("missing or invalid time") from None
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise InvalidState("missing or invalid time")
+    return hours * 60 + minutes
+
+
+def format_clock(minutes: int) -> str:
+    minutes %= MINUTES_PER_DAY
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def _number(value: Any, key: str, bounds: Tuple[int, int]) -> Union[int, float]:
+    """value itself, once checked to be a number within bounds; floats are kept as the model wrote them"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise InvalidState(f"missing or invalid {key}")
+    if not bounds[0] <= value <= bounds[1]:
+        raise InvalidState(f"{key} out of bounds")
+    return value
+
+
+class NPC:
+    """One character in the scene; fields the model adds beyond these are kept in extra.
+
+    A bare name string, or a dict without a name, is kept as raw and written
+    back exactly as the model sent it.
+    """
+
+    __slots__ = ('name', 'attitude', 'trust', 'extra', 'raw')
+
+    def __init__(self, name: str, attitude: Optional[str] = None, trust: Any = None,
+                 extra: Optional[Dict[str, Any]] = None, raw: Any = None):
+        self.name = name
+        self.attitude = attitude
+        self.trust = trust
+        self.extra = extra or {}
+        self.raw = raw
+
+    @classmethod
+    def from_value(cls, value: Any) -> 'NPC':
+        if isinstance(value, str):
+            return cls(value, raw=value)
+        if not isinstance(value, dict):
+            raise InvalidState("invalid npc")
+        name = value.get('name')
+        extra = {key: item for key, item in value.items() if key not in ('name', 'attitude', 'trust')}
+        if not isinstance(name, str) or not name:
+            return cls('', value.get('attitude'), value.get('trust'), extra, raw=dict(value))
+        return cls(name, value.get('attitude'), value.get('trust'), extra)
+
+    def to_value(self) -> Any:
+        if self.raw is not None:
+            return dict(self.raw) if isinstance(self.raw, dict) else self.raw
+        value = {"name": self.name}
+        if self.attitude is not None:
+            value["attitude"] = self.attitude
+        if self.trust is not None:
+            value["trust"] = self.trust
+        value.update(self.extra)
+        return value
+
+
+class GameState:
+    """One turn's game state, validated once and serialized at most once.
+
+    Instances are treated as immutable: inventory, npcs and objectives are
+    tuples and advanced() returns a new state, so to_json() can cache its
+    bytes and hand the same ones to the prompt, the HTTP response and the
+    journal. The clock is kept as minutes past midnight; "time" only exists
+    in the dict and JSON forms. Keys the model adds beyond these are kept in
+    extra and written back after them.
+    """
+
+    __slots__ = ('player_name', 'location', 'inventory', 'health', 'danger', 'minutes', 'flags', 'npcs',
+                 'objectives', 'extra', '_json')
+
+    FIELDS = ('player_name', 'location', 'inventory', 'health', 'danger', 'time', 'flags', 'npcs', 'objectives')
+
+    def __init__(self, player_name: str, location: str, inventory: Tuple[Any, ...], health: Union[int, float],
+                 danger: Union[int, float],
+                 minutes: int, flags: Dict[str, Any], npcs: Optional[Tuple[NPC, ...]] = None,
+                 objectives: Optional[Tuple[Any, ...]] = None, extra: Optional[Dict[str, Any]] = None):
+        self.player_name = player_name
+        self.location = location
+        self.inventory = inventory
+        self.health = health
+        self.danger = danger
+        self.minutes = minutes
+        self.flags = flags
+        self.npcs = npcs
+        self.objectives = objectives
+        self.extra = extra or {}
+        self._json = None
+
+    @classmethod
+    def from_dict(cls, data: Any) -> 'GameState':
+        """Validate a state dict in one pass; raises InvalidState naming the first bad field"""
+        if not isinstance(data, dict):
+            raise InvalidState("state not a dict")
+        player_name, location = data.get('player_name'), data.get('location')
+        if not isinstance(player_name, str):
+            raise InvalidState("missing or invalid player_name")
+        if not isinstance(location, str):
+            raise InvalidState("missing or invalid location")
+        inventory = data.get('inventory')
+        if not isinstance(inventory, list):
+            raise InvalidState("missing or invalid inventory")
+        health = _number(data.get('health'), 'health', HEALTH_BOUNDS)
+        danger = _number(data.get('danger'), 'danger', DANGER_BOUNDS)
+        minutes = parse_clock(data.get('time'))
+        flags = data.get('flags')
+        if flags is None:
+            flags = {}
+        elif not isinstance(flags, dict):
+            raise InvalidState("invalid flags")
+        npcs, objectives = data.get('npcs'), data.get('objectives')
+        if npcs is not None:
+            if not isinstance(npcs, list):
+                raise InvalidState("invalid npcs")
+            npcs = tuple(NPC.from_value(npc) for npc in npcs)
+        if objectives is not None:
+            if not isinstance(objectives, list):
+                raise InvalidState("invalid objectives")
+            objectives = tuple(objectives)
+        extra = {key: value for key, value in data.items() if key not in cls.FIELDS}
+        return cls(player_name, location, tuple(inventory), health, danger, minutes, dict(flags), npcs,
+                   objectives, extra)
+
+    @property
+    def time(self) -> str:
+        return format_clock(self.minutes)
+
+    def advanced(self, minutes: int) -> 'GameState':
+        return GameState(self.player_name, self.location, self.inventory, self.health, self.danger,
+                         (self.minutes + minutes) % MINUTES_PER_DAY, dict(self.flags), self.npcs, self.objectives,
+                         dict(self.extra))
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {
+            "player_name": self.player_name,
+            "location": self.location,
+            "inventory": list(self.inventory),
+            "health": self.health,
+            "danger": self.danger,
+            "time": self.time,
+            "flags": dict(self.flags),
+        }
+        if self.npcs is not None:
+            data["npcs"] = [npc.to_value() for npc in self.npcs]
+        if self.objectives is not None:
+            data["objectives"] = list(self.objectives)
+        data.update(self.extra)
+        return data
+
+    def to_json(self) -> bytes:
+        if self._json is None:
+            self._json = json.dumps(self.to_dict(), separators=(',', ':')).encode('utf-8')
+        return self._json
+
+    def json_text(self) -> str:
+        return self.to_json().decode('utf-8')
+
+
+def splice(payload: Dict[str, Any], key: str, raw: bytes) -> bytes:
+    """payload as compact JSON bytes with raw (already encoded JSON) as the value of key"""
+    head = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return head[:-1] + (b',' if payload else b'') + json.dumps(key).encode('utf-8') + b':' + raw + b'}'
+
+
+class StateCache:
+    """The latest GameState per session, so the next turn's prompt reuses its bytes.
+
+    Entries are tagged with the session's state_version; a lookup with any
+    other version (another worker played a turn, a save was loaded) misses
+    and the state is rebuilt from the session dict.
+    """
+
+    def __init__(self, max_entries: int = STATE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, key: Hashable, version: int, state: GameState):
+        with self._lock:
+            self._entries[key] = (version, state)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get(self, key: Hashable, version: int, data: Dict[str, Any]) -> Optional[GameState]:
+        """The cached state for this version, else one built from data; None if data is invalid"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        try:
+            state = GameState.from_dict(data)
+        except InvalidState:
+            return None
+        self.put(key, version, state)
+        return state
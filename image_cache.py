@@ -0,0 +1,249 @@
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from collections import OrderedDict
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+import log_pipeline
+
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'cache'))
+IMAGE_CACHE_URL = '/static/cache'
+IMAGE_CACHE_MAX_ENTRIES = int(os.getenv('IMAGE_CACHE_MAX_ENTRIES', 500))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+IMAGE_RETENTION_DAYS = float(os.getenv('IMAGE_RETENTION_DAYS', 30))
+SWEEP_INTERVAL = 10 * 60
+
+log = log_pipeline.get_logger('image_cache')
+
+
+def cache_key(url: str, body: Dict[str, Any]) -> str:
+    """Content address for an image request: the endpoint plus every generation parameter"""
+    canonical = json.dumps({"url": url, "body": body}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class ImageCache:
+    """Content-addressed, LRU-bounded cache of generated images on disk.
+
+    Generation is deterministic for a fixed seed, so an image is stored under
+    the hash of its request and served again for identical requests.
+    Concurrent misses for the same key share a single upstream call.
+
+    Each key owns its original file plus any variants produced by the
+    variants hook (all named "<key>.<suffix>"); the quota, LRU eviction and
+    the max_age retention policy always act on the whole group.
+    """
+
+    def __init__(self, directory: str = IMAGE_CACHE_DIR, url_prefix: str = IMAGE_CACHE_URL,
+                 max_entries: int = IMAGE_CACHE_MAX_ENTRIES, max_bytes: int = IMAGE_CACHE_MAX_BYTES,
+                 extension: str = '.png', max_age: float = IMAGE_RETENTION_DAYS * 24 * 60 * 60,
+                 variants: Optional[Callable[[str], List[str]]] = None):
+        self.directory = directory
+        self.url_prefix = url_prefix
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.extension = extension
+        self.max_age = max_age
+        self.variants = variants
+        self._last_sweep = time.monotonic()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "upstream_calls": 0,
+                         "upstream_failures": 0, "evictions": 0, "expired": 0}
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        sizes = {}
+        mtimes = {}
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.name.endswith('.tmp'):
+                continue
+            key = entry.name.split('.', 1)[0]
+            st = entry.stat()
+            sizes[key] = sizes.get(key, 0) + st.st_size
+            if entry.name == key + self.extension:
+                mtimes[key] = st.st_mtime
+        for key in sizes:
+            if key not in mtimes:
+                self._remove_files(key)
+        for _, key in sorted((mtime, key) for key, mtime in mtimes.items()):
+            self._entries[key] = sizes[key]
+            self._bytes += sizes[key]
+        self.expire()
+        self._evict()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.extension)
+
+    def files_for(self, key: str) -> List[str]:
+        prefix = key + '.'
+        return [entry.path for entry in os.scandir(self.directory) if entry.name.startswith(prefix)]
+
+    def url_for(self, key: str) -> str:
+        return f"{self.url_prefix}/{key}{self.extension}"
+
+    def get_or_create(self, key: str, produce: Callable[[str], Tuple[bool, str]]) -> Tuple[bool, str]:
+        """Return (True, web_path) for key, calling produce(path) to create it on a miss"""
+        outcome, value = self._claim(key)
+        if outcome == 'hit':
+            return value
+        if outcome == 'follow':
+            value.done.wait()
+            return value.result
+        flight, tmp_path = value
+        try:
+            try:
+                success, message = produce(tmp_path)
+            except Exception as e:
+                success, message = False, f"Error: {str(e)}"
+            self._store(key, flight, tmp_path, success, message)
+        finally:
+            self._release(key, flight)
+        return flight.result
+
+    async def get_or_create_async(self, key: str, produce: Callable[[str], Awaitable[Tuple[bool, str]]]) -> Tuple[bool, str]:
+        """Like get_or_create, for a coroutine produce(path); disk and transcode work runs in a thread"""
+        outcome, value = self._claim(key)
+        if outcome == 'hit':
+            return value
+        if outcome == 'follow':
+            await asyncio.to_thread(value.done.wait)
+            return value.result
+        flight, tmp_path = value
+        try:
+            try:
+                success, message = await produce(tmp_path)
+            except Exception as e:
+                success, message = False, f"Error: {str(e)}"
+            await asyncio.to_thread(self._store, key, flight, tmp_path, success, message)
+        finally:
+            self._release(key, flight)
+        return flight.result
+
+    def _claim(self, key: str):
+        """('hit', result), ('follow', in-flight entry) or ('lead', (in-flight entry, tmp path))"""
+        self._maybe_sweep()
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.counters["hits"] += 1
+                hit = True
+            else:
+                hit = False
+                flight = self._in_flight.get(key)
+                if flight is not None:
+                    self.counters["coalesced"] += 1
+                    return 'follow', flight
+                flight = self._in_flight[key] = _InFlight()
+                self.counters["misses"] += 1
+                self.counters["upstream_calls"] += 1
+        if hit:
+            try:
+                os.utime(self.path_for(key))
+            except FileNotFoundError:
+                with self._lock:
+                    self._forget(key)
+                return self._claim(key)
+            return 'hit', (True, self.url_for(key))
+        return 'lead', (flight, f"{self.path_for(key)}.{uuid.uuid4().hex}.tmp")
+
+    def _store(self, key: str, flight: _InFlight, tmp_path: str, success: bool, message: str):
+        path = self.path_for(key)
+        if success:
+            try:
+                os.replace(tmp_path, path)
+            except OSError as e:
+                success, message = False, f"Error: {str(e)}"
+        if not success:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            with self._lock:
+                self.counters["upstream_failures"] += 1
+            flight.result = (False, message)
+            return
+        if self.variants is not None:
+            try:
+                self.variants(path)
+            except Exception as e:
+                log.warning("Could not create variants for %s: %s", key, e)
+        size = sum(os.path.getsize(file_path) for file_path in self.files_for(key))
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = size
+            self._bytes += self._entries[key]
+            self._evict()
+        flight.result = (True, self.url_for(key))
+
+    def _release(self, key: str, flight: _InFlight):
+        if flight.result is None:
+            flight.result = (False, "Image generation failed")
+        with self._lock:
+            self._in_flight.pop(key, None)
+        flight.done.set()
+
+    def _forget(self, key: str):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self._bytes -= size
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            key, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.counters["evictions"] += 1
+            self._remove_files(key)
+
+    def _remove_files(self, key: str):
+        for file_path in self.files_for(key):
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+    def expire(self) -> int:
+        """Drop every image group whose original has not been used within max_age"""
+        if not self.max_age:
+            return 0
+        cutoff = time.time() - self.max_age
+        expired = []
+        with self._lock:
+            for key in list(self._entries):
+                try:
+                    mtime = os.path.getmtime(self.path_for(key))
+                except FileNotFoundError:
+                    mtime = 0
+                if mtime >= cutoff:
+                    break
+                self._forget(key)
+                expired.append(key)
+            self.counters["expired"] += len(expired)
+        for key in expired:
+            self._remove_files(key)
+        return len(expired)
+
+    def _maybe_sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        self.expire()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["misses"] + self.counters["coalesced"]
+            saved = self.counters["hits"] + self.counters["coalesced"]
+            return dict(self.counters, entries=len(self._entries), bytes=self._bytes,
+                        hit_rate=round(saved / lookups, 3) if lookups else 0.0)
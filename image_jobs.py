@@ -0,0 +1,161 @@
+from typing import Callable, Dict, Optional, Tuple
+import contextvars
+import os
+import queue
+import threading
+import time
+import uuid
+
+from turn_budget import DEADLINE_OVERRUNS, STAGES_SKIPPED, TURN_IMAGE_MIN_BUDGET
+
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', 4))
+IMAGE_QUEUE_SIZE = int(os.getenv('IMAGE_QUEUE_SIZE', 64))
+IMAGE_JOB_TTL = int(os.getenv('IMAGE_JOB_TTL', 15 * 60))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class ImageJob:
+    """One scene image request and its outcome; deadline is the turn's, in time.monotonic() seconds"""
+
+    def __init__(self, session_id: str, prompt: str, deadline: Optional[float] = None):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.prompt = prompt
+        self.deadline = deadline
+        self.status = QUEUED
+        self.image_url = None
+        self.error = None
+        self.created = time.monotonic()
+        self.finished = None
+        self.done = threading.Event()
+        self.context = contextvars.copy_context()
+        self._lock = threading.Lock()
+
+    def start(self) -> bool:
+        """Mark the job running; False if it was already cancelled"""
+        with self._lock:
+            if self.done.is_set():
+                return False
+            self.status = RUNNING
+            return True
+
+    def finish(self, status: str, image_url: Optional[str] = None, error: Optional[str] = None):
+        with self._lock:
+            if self.done.is_set():
+                return
+            self.status = status
+            self.image_url = image_url
+            self.error = error
+            self.finished = time.monotonic()
+            self.done.set()
+
+    def to_dict(self) -> Dict[str, Optional[str]]:
+        return {"id": self.id, "status": self.status, "image_url": self.image_url, "error": self.error}
+
+
+class ImageJobQueue:
+    """Bounded queue of image jobs served by a pool of background worker threads.
+
+    Each session has at most one live job: submitting a new scene cancels the
+    previous one, so workers never spend upstream calls on scenes the player
+    has already left. A job with a deadline is abandoned if it waited in the
+    queue until less than min_budget seconds of it were left, and otherwise
+    generated with deadline= that deadline.
+    """
+
+    def __init__(self, generate: Callable[..., Tuple[bool, str]], workers: int = IMAGE_WORKERS,
+                 max_queue: int = IMAGE_QUEUE_SIZE, job_ttl: int = IMAGE_JOB_TTL,
+                 min_budget: float = TURN_IMAGE_MIN_BUDGET):
+        self.generate = generate
+        self.job_ttl = job_ttl
+        self.min_budget = min_budget
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._jobs = {}
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._workers = [threading.Thread(target=self._work, name=f"image-worker-{i}", daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, session_id: str, prompt: str, deadline: Optional[float] = None) -> ImageJob:
+        job = ImageJob(session_id, prompt, deadline)
+        with self._lock:
+            self._prune()
+            self._cancel_latest(session_id)
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                raise QueueFull("image queue is full")
+            self._jobs[job.id] = job
+            self._latest[session_id] = job.id
+        return job
+
+    def cancel_session(self, session_id: str):
+        with self._lock:
+            self._cancel_latest(session_id)
+
+    def _cancel_latest(self, session_id: str):
+        previous = self._jobs.get(self._latest.pop(session_id, None))
+        if previous is not None:
+            previous.finish(CANCELLED, error="superseded by a newer scene")
+
+    def get(self, job_id: str) -> Optional[ImageJob]:
+        return self._jobs.get(job_id)
+
+    def wait(self, job_id: str, timeout: float) -> Optional[ImageJob]:
+        job = self.get(job_id)
+        if job is not None:
+            job.done.wait(timeout)
+        return job
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        counts = {"queued": self._queue.qsize(), "jobs": len(jobs)}
+        for job in jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return counts
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.job_ttl
+        for job_id, job in list(self._jobs.items()):
+            if job.finished is not None and job.finished < cutoff:
+                del self._jobs[job_id]
+                if self._latest.get(job.session_id) == job_id:
+                    del self._latest[job.session_id]
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job.done.is_set():
+                    continue
+                if job.deadline is not None and job.deadline - time.monotonic() < self.min_budget:
+                    STAGES_SKIPPED.inc(stage='image', reason='expired')
+                    job.finish(CANCELLED, error="turn deadline too close to start the image")
+                    continue
+                if not job.start():
+                    continue
+                try:
+                    success, result = job.context.run(self.generate, job.prompt, deadline=job.deadline)
+                except Exception as e:
+                    success, result = False, f"Error: {str(e)}"
+                if job.deadline is not None and time.monotonic() > job.deadline:
+                    DEADLINE_OVERRUNS.inc(stage='image')
+                if success and result:
+                    job.finish(DONE, image_url=result)
+                else:
+                    job.finish(FAILED, error=result or "Image generation failed")
+            finally:
+                self._queue.task_done()
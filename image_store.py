@@ -0,0 +1,116 @@
+from typing import Dict, Iterable, List, Optional
+import glob
+import os
+import time
+import uuid
+
+from PIL import Image
+
+import metrics
+
+WEBP_QUALITY = int(os.getenv('IMAGE_WEBP_QUALITY', 80))
+JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', 82))
+THUMB_SIZE = int(os.getenv('IMAGE_THUMB_SIZE', 640))
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+STATIC_MAX_AGE = int(os.getenv('STATIC_MAX_AGE', 24 * 60 * 60))
+
+VARIANT_SUFFIXES = {
+    "webp": ".webp",
+    "jpeg": ".jpg",
+    "thumb": ".thumb.webp",
+}
+
+
+def part_path(path: str) -> str:
+    """A temp name next to path that no other thread or process will pick"""
+    return f"{path}.{uuid.uuid4().hex}.tmp"
+
+
+def _save_atomic(image: Image.Image, path: str, format: str, **params):
+    tmp_path = part_path(path)
+    image.save(tmp_path, format, **params)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+def write_chunks(chunks: Iterable[bytes], path: str) -> int:
+    """Write chunks straight to path, which must be a temp file the caller renames into place itself"""
+    written = 0
+    with open(path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+            written += len(chunk)
+    os.chmod(path, 0o644)
+    return written
+
+
+def write_stream(chunks: Iterable[bytes], path: str) -> int:
+    """Write chunks to a temp file and rename it to path; readers never see a partial file"""
+    tmp_path = part_path(path)
+    try:
+        written = write_chunks(chunks, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return written
+
+
+def make_variants(path: str) -> List[str]:
+    """Transcode a generated PNG into WebP and JPEG copies plus a small WebP thumbnail"""
+    with metrics.span('image_transcode'):
+        return _make_variants(path)
+
+
+def _make_variants(path: str) -> List[str]:
+    base = os.path.splitext(path)[0]
+    written = []
+    with Image.open(path) as source:
+        image = source.convert('RGB')
+    _save_atomic(image, base + VARIANT_SUFFIXES["webp"], 'WEBP', quality=WEBP_QUALITY, method=4)
+    written.append(base + VARIANT_SUFFIXES["webp"])
+    _save_atomic(image, base + VARIANT_SUFFIXES["jpeg"], 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    written.append(base + VARIANT_SUFFIXES["jpeg"])
+    image.thumbnail((THUMB_SIZE, THUMB_SIZE))
+    _save_atomic(image, base + VARIANT_SUFFIXES["thumb"], 'WEBP', quality=WEBP_QUALITY, method=4)
+    written.append(base + VARIANT_SUFFIXES["thumb"])
+    return written
+
+
+def variant_urls(image_url: str, static_root: str) -> Dict[str, Optional[str]]:
+    """Map an original image URL to the URLs of its variants that exist on disk"""
+    base_url = os.path.splitext(image_url)[0]
+    relative = base_url[len('/static/'):] if base_url.startswith('/static/') else base_url.lstrip('/')
+    base_path = os.path.join(static_root, relative)
+    urls = {"original": image_url}
+    for name, suffix in VARIANT_SUFFIXES.items():
+        urls[name] = base_url + suffix if os.path.exists(base_path + suffix) else None
+    return urls
+
+
+def is_content_addressed(filename: str) -> bool:
+    """Files under cache/ and the bundles under dist/ are named by the hash of their content and never change"""
+    return filename.startswith(('cache/', 'dist/'))
+
+
+def cache_headers(response, filename: str):
+    if is_content_addressed(filename):
+        response.headers['Cache-Control'] = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+    else:
+        response.headers['Cache-Control'] = f"public, max-age={STATIC_MAX_AGE}"
+    return response
+
+
+def remove_legacy_outputs(static_root: str, max_age: float) -> int:
+    """Delete output_<timestamp>.png files left behind by older versions"""
+    cutoff = time.time() - max_age
+    removed = 0
+    for path in glob.glob(os.path.join(static_root, 'output_*.png')):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
@@ -0,0 +1,334 @@
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from collections import deque
+from contextlib import ExitStack, contextmanager
+import asyncio
+import concurrent.futures
+import contextvars
+import json
+import os
+import time
+
+import requests
+
+import async_upstream
+import log_pipeline
+import metrics
+import upstream
+from async_upstream import Overloaded
+from upstream import CircuitBreaker, CircuitOpen, expired, fits, is_backend_failure
+
+LLM_BACKENDS = os.getenv('LLM_BACKENDS', '')
+LLM_HEDGE = os.getenv('LLM_HEDGE', '0').lower() in ('1', 'true', 'yes')
+LLM_HEDGE_QUANTILE = float(os.getenv('LLM_HEDGE_QUANTILE', 0.95))
+LLM_HEDGE_MIN_DELAY = float(os.getenv('LLM_HEDGE_MIN_DELAY', 1.5))
+LLM_HEDGE_MIN_SAMPLES = 20
+LLM_LATENCY_WINDOW = 200
+
+LLM_REQUESTS = metrics.Counter('vardovia_llm_requests_total', 'Chat completion attempts by backend and outcome',
+                               ('backend', 'outcome'))
+LLM_HEDGES = metrics.Counter('vardovia_llm_hedges_total', 'Hedged chat completions by which request answered',
+                             ('winner',))
+
+log = log_pipeline.get_logger('llm_router')
+
+_hedge_pool = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix='llm-hedge')
+
+
+class LLMBackend:
+    """One OpenAI-compatible chat completions endpoint and model.
+
+    Keeps a circuit breaker and a window of recent successful latencies, from
+    which the router picks its order and the hedging delay.
+    """
+
+    def __init__(self, name: str, url: str, model: str, api_key_env: str = 'GROQ_API_KEY', timeout: float = 20,
+                 provider: Optional[str] = None):
+        self.name = name
+        self.url = url
+        self.model = model
+        self.api_key_env = api_key_env
+        self.timeout = timeout
+        self.provider = provider or name
+        self.breaker = CircuitBreaker(f"llm:{name}")
+        self.latencies = deque(maxlen=LLM_LATENCY_WINDOW)
+
+    def headers(self, api_key: Optional[str] = None) -> Dict[str, str]:
+        """api_key, when given, stands in for the key read from GROQ_API_KEY"""
+        if not (api_key and self.api_key_env == 'GROQ_API_KEY'):
+            api_key = os.getenv(self.api_key_env) if self.api_key_env else None
+        headers = {"Content-Type": "application/json"}
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+        return headers
+
+    def payload(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return dict(payload, model=self.model)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self.latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def succeeded(self, seconds: float):
+        self.latencies.append(seconds)
+        self.breaker.record_success()
+        LLM_REQUESTS.inc(backend=self.name, outcome='ok')
+
+    def failed(self, error: BaseException):
+        """Count a failed attempt against the breaker only if it says the backend is unhealthy.
+
+        Connection errors, timeouts, broken bodies, 429 and 5xx do; calls refused locally and
+        deterministic rejections of the request itself (other 4xx, such as an
+        unsupported response_format) don't, and count as 'rejected' instead.
+        """
+        if isinstance(error, Overloaded):
+            LLM_REQUESTS.inc(backend=self.name, outcome='shed')
+        elif isinstance(error, CircuitOpen):
+            LLM_REQUESTS.inc(backend=self.name, outcome='circuit_open')
+        elif is_backend_failure(error):
+            self.breaker.record_failure()
+            LLM_REQUESTS.inc(backend=self.name, outcome='error')
+        else:
+            LLM_REQUESTS.inc(backend=self.name, outcome='rejected')
+
+    def stats(self) -> Dict[str, Any]:
+        p50, p95 = self.quantile(0.5), self.quantile(0.95)
+        return {"url": self.url, "model": self.model, "breaker": self.breaker.stats(),
+                "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+                "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+                "ok": LLM_REQUESTS.value(backend=self.name, outcome='ok'),
+                "errors": LLM_REQUESTS.value(backend=self.name, outcome='error')}
+
+
+class LLMRouter:
+    """Sends chat completions to the first healthy backend, falling back down the list.
+
+    Backends with an open breaker are tried last until it half opens. With
+    hedging on, a request still unanswered after the primary's p95 latency (at
+    least hedge_min_delay) is also sent to the next backend and whichever
+    answers first wins; the loser is cancelled where the transport allows it.
+    With a deadline (a time.monotonic() value), no fallback or hedge is
+    started once it has passed, and each call's timeouts and retries fit
+    within it.
+    """
+
+    def __init__(self, backends: List[LLMBackend], hedge: bool = LLM_HEDGE, hedge_quantile: float = LLM_HEDGE_QUANTILE,
+                 hedge_min_delay: float = LLM_HEDGE_MIN_DELAY):
+        if not backends:
+            raise ValueError("at least one LLM backend is required")
+        self.backends = backends
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+
+    def candidates(self) -> List[LLMBackend]:
+        """Backends in configured order, those that would refuse a call right now moved last"""
+        return sorted(self.backends, key=lambda backend: not backend.breaker.available())
+
+    def hedge_delay(self, backend: LLMBackend) -> float:
+        return max(self.hedge_min_delay, backend.quantile(self.hedge_quantile) or 0.0)
+
+    def _next_delay(self, candidates: List[LLMBackend], started: int, running: int,
+                    deadline: Optional[float] = None) -> Optional[float]:
+        """How long to wait before hedging the one running request, or None to just wait for it"""
+        if not self.hedge or running != 1 or started >= len(candidates):
+            return None
+        if not candidates[started].breaker.available():
+            return None
+        delay = self.hedge_delay(candidates[started - 1])
+        return delay if fits(deadline, delay) else None
+
+    def _attempt(self, backend: LLMBackend, payload: Dict[str, Any], api_key: Optional[str],
+                 stage: str = 'llm', deadline: Optional[float] = None) -> Dict[str, Any]:
+        backend.breaker.check()
+        started = time.perf_counter()
+        try:
+            with async_upstream.ceiling.hold(backend.provider), \
+                    metrics.span(stage, model=backend.model, backend=backend.name) as attrs:
+                resp = upstream.client.post(backend.url, backend.timeout, deadline=deadline,
+                                            headers=backend.headers(api_key), json=backend.payload(payload))
+                attrs['status'] = resp.status_code
+                resp.raise_for_status()
+                data = resp.json()
+        except Exception as e:
+            backend.failed(e)
+            raise
+        backend.succeeded(time.perf_counter() - started)
+        return data
+
+    async def _attempt_async(self, backend: LLMBackend, payload: Dict[str, Any], api_key: Optional[str],
+                             stage: str = 'llm', deadline: Optional[float] = None) -> Dict[str, Any]:
+        backend.breaker.check()
+        started = time.perf_counter()
+        try:
+            with metrics.span(stage, model=backend.model, backend=backend.name) as attrs:
+                resp = await async_upstream.client.post(backend.url, backend.timeout, deadline=deadline,
+                                                        provider=backend.provider,
+                                                        headers=backend.headers(api_key),
+                                                        json=backend.payload(payload))
+                attrs['status'] = resp.status_code
+                resp.raise_for_status()
+                data = resp.json()
+        except Exception as e:
+            backend.failed(e)
+            raise
+        backend.succeeded(time.perf_counter() - started)
+        return data
+
+    def _submit(self, backend: LLMBackend, payload: Dict[str, Any], api_key: Optional[str],
+                stage: str, deadline: Optional[float] = None) -> concurrent.futures.Future:
+        context = contextvars.copy_context()
+        return _hedge_pool.submit(context.run, self._attempt, backend, payload, api_key, stage, deadline)
+
+    def complete(self, payload: Dict[str, Any], api_key: Optional[str] = None, stage: str = 'llm',
+                 deadline: Optional[float] = None) -> Dict[str, Any]:
+        """Blocking chat completion; returns the decoded response body.
+
+        Once deadline has passed, the last backend's error is raised instead
+        of falling back to the next one.
+        """
+        candidates = self.candidates()
+        if not self.hedge or len(candidates) == 1:
+            error = None
+            for backend in candidates:
+                if error is not None and expired(deadline):
+                    break
+                try:
+                    return self._attempt(backend, payload, api_key, stage, deadline)
+                except (requests.exceptions.RequestException, ValueError, CircuitOpen, Overloaded) as e:
+                    error = e
+                    log.warning("LLM backend %s failed: %s", backend.name, e)
+            raise error
+
+        running = {}
+        started = 0
+        error = None
+        while True:
+            if not running:
+                if started >= len(candidates) or (error is not None and expired(deadline)):
+                    raise error
+                running[self._submit(candidates[started], payload, api_key, stage, deadline)] = started
+                started += 1
+            delay = self._next_delay(candidates, started, len(running), deadline)
+            done, _ = concurrent.futures.wait(running, timeout=delay, return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                running[self._submit(candidates[started], payload, api_key, stage, deadline)] = started
+                started += 1
+                continue
+            for future in done:
+                index = running.pop(future)
+                try:
+                    data = future.result()
+                except Exception as e:
+                    error = e
+                    log.warning("LLM backend %s failed: %s", candidates[index].name, e)
+                    continue
+                if started > 1:
+                    LLM_HEDGES.inc(winner='primary' if index == 0 else 'hedge')
+                for other in running:
+                    other.cancel()
+                return data
+
+    async def complete_async(self, payload: Dict[str, Any], api_key: Optional[str] = None,
+                             stage: str = 'llm', deadline: Optional[float] = None) -> Dict[str, Any]:
+        """Asyncio counterpart of complete; must run on async_upstream.engine"""
+        candidates = self.candidates()
+        running = {}
+        started = 0
+        error = None
+        try:
+            while True:
+                if not running:
+                    if started >= len(candidates) or (error is not None and expired(deadline)):
+                        raise error
+                    task = asyncio.ensure_future(self._attempt_async(candidates[started], payload, api_key, stage,
+                                                                     deadline))
+                    running[task] = started
+                    started += 1
+                delay = self._next_delay(candidates, started, len(running), deadline)
+                done, _ = await asyncio.wait(running, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    task = asyncio.ensure_future(self._attempt_async(candidates[started], payload, api_key, stage,
+                                                                     deadline))
+                    running[task] = started
+                    started += 1
+                    continue
+                for task in done:
+                    index = running.pop(task)
+                    if task.exception() is not None:
+                        error = task.exception()
+                        log.warning("LLM backend %s failed: %s", candidates[index].name, error)
+                        continue
+                    if self.hedge and started > 1:
+                        LLM_HEDGES.inc(winner='primary' if index == 0 else 'hedge')
+                    return task.result()
+        finally:
+            for task in running:
+                task.cancel()
+
+    @contextmanager
+    def stream(self, payload: Dict[str, Any], api_key: Optional[str] = None,
+               deadline: Optional[float] = None) -> Iterator[Tuple[LLMBackend, Any]]:
+        """Open a streamed completion on the first backend that accepts it.
+
+        Fallback only happens before the first byte, and not once deadline
+        has passed; a stream that breaks midway is reported to its backend's
+        breaker and re-raised.
+        """
+        error = None
+        for backend in self.candidates():
+            if error is not None and expired(deadline):
+                break
+            stack = ExitStack()
+            try:
+                backend.breaker.check()
+                stack.enter_context(async_upstream.ceiling.hold(backend.provider))
+                resp = stack.enter_context(upstream.client.post(backend.url, backend.timeout, deadline=deadline,
+                                                                headers=backend.headers(api_key),
+                                                                json=backend.payload(payload), stream=True))
+                resp.raise_for_status()
+            except (requests.exceptions.RequestException, CircuitOpen, Overloaded) as e:
+                stack.close()
+                backend.failed(e)
+                error = e
+                log.warning("LLM backend %s failed: %s", backend.name, e)
+                continue
+            started = time.perf_counter()
+            with stack:
+                try:
+                    yield backend, resp
+                except Exception as e:
+                    backend.failed(e)
+                    raise
+            backend.succeeded(time.perf_counter() - started)
+            return
+        raise error
+
+    def stats(self) -> Dict[str, Any]:
+        return {"hedge": self.hedge,
+                "hedged": {winner: LLM_HEDGES.value(winner=winner) for winner in ('primary', 'hedge')},
+                "backends": {backend.name: backend.stats() for backend in self.backends}}
+
+
+def backends_from_env(default_url: str, default_model: str, default_timeout: float,
+                      config: str = LLM_BACKENDS) -> List[LLMBackend]:
+    """Backends from LLM_BACKENDS (a JSON list of objects), or just Groq at default_url.
+
+    Each object takes name, url and model, and optionally api_key_env (the
+    variable holding its key, GROQ_API_KEY by default, "" for none), timeout
+    and provider (the async_upstream limiter it queues under, its name by default).
+    """
+    if not config:
+        return [LLMBackend('groq', default_url, default_model, timeout=default_timeout)]
+    backends = []
+    for i, entry in enumerate(json.loads(config)):
+        backends.append(LLMBackend(
+            name=entry.get('name') or f"backend{i}",
+            url=entry.get('url') or default_url,
+            model=entry.get('model') or default_model,
+            api_key_env=entry.get('api_key_env', 'GROQ_API_KEY'),
+            timeout=float(entry.get('timeout', default_timeout)),
+            provider=entry.get('provider')
+        ))
+    return backends
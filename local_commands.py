@@ -0,0 +1,100 @@
+from typing import Any, Dict, List, Optional
+import re
+
+import metrics
+
+TURN_INPUTS = metrics.Counter('vardovia_turn_inputs_total', 'Player inputs by how they were answered',
+                              ('path', 'command'))
+
+HELP_TEXT = (
+    "Type what you want to do in plain English, like 'search the room', 'open the door' or 'talk to the guard'. "
+    "These answer instantly without using a turn: inventory, health, danger, time, location, objectives, "
+    "people (who is here) and help."
+)
+
+# Whole-input patterns only: "inventory" is a status check, "hide the note in my inventory" is a turn.
+COMMANDS = (
+    ('inventory', r"i|inv|inventory|items|(check|show|open|view|look at|look in) (my )?(inventory|items|bag|pockets)"
+                  r"|what (do i have|am i carrying|is in my (inventory|pockets|bag))( with me)?"),
+    ('health', r"health|hp|status|stats|(check|show) (my )?(health|status|stats)|how (am i|do i feel)( doing)?"),
+    ('danger', r"danger|danger level|how dangerous is it( here)?|what is the danger( level)?( here)?"),
+    ('time', r"time|clock|what time is it|what'?s the time|what is the time"),
+    ('location', r"where am i|location|what is this place"),
+    ('objectives', r"objectives?|goals?|quests?|tasks?|(show|list|check) (my )?(objectives|goals|quests|tasks)"
+                   r"|what are my (objectives|goals|quests|tasks)"),
+    ('npcs', r"npcs?|people|characters|who is (here|around)|who'?s (here|around)|who else is here"),
+    ('help', r"help|commands|what can i (do|type)"),
+)
+_PATTERNS = [(name, re.compile(f"(?:{pattern})")) for name, pattern in COMMANDS]
+
+
+def normalize(text: str) -> str:
+    return " ".join(re.sub(r"[?!.]+$", "", text.strip().lower()).split())
+
+
+def match_command(text: str) -> Optional[str]:
+    """Name of the local command the whole input asks for, if any"""
+    if text.strip() == "?":
+        return 'help'
+    text = normalize(text)
+    for name, pattern in _PATTERNS:
+        if pattern.fullmatch(text):
+            return name
+    return None
+
+
+def _label(item: Any) -> str:
+    if isinstance(item, dict):
+        name = item.get('name') or item.get('title') or item.get('description') or ''
+        details = item.get('state') or item.get('status') or item.get('attitude')
+        return f"{name} ({details})" if name and isinstance(details, str) else str(name or item)
+    return str(item)
+
+
+def _listing(items: Any) -> List[str]:
+    if isinstance(items, list):
+        return [_label(item) for item in items]
+    return [_label(items)] if items else []
+
+
+def answer(command: str, state: Dict[str, Any]) -> str:
+    """Reply to a local command from the current state, without changing it"""
+    if command == 'inventory':
+        items = _listing(state.get('inventory'))
+        return f"You are carrying: {', '.join(items)}." if items else "You aren't carrying anything."
+    if command == 'health':
+        return f"Health: {state.get('health', '??')}/100. Danger: {state.get('danger', '??')}/10."
+    if command == 'danger':
+        return f"Danger: {state.get('danger', '??')}/10."
+    if command == 'time':
+        return f"It is {state.get('time', 'hard to tell what time it is')}."
+    if command == 'location':
+        return f"You are in the {state.get('location', 'dark')}." if state.get('location') else "You aren't sure where you are."
+    if command == 'objectives':
+        objectives = _listing(state.get('objectives'))
+        return "Objectives: " + "; ".join(objectives) + "." if objectives else "You have no clear objective yet. Find a way out."
+    if command == 'npcs':
+        npcs = _listing(state.get('npcs'))
+        return "Here with you: " + ", ".join(npcs) + "." if npcs else "There is no one else here."
+    return HELP_TEXT
+
+
+def route(text: str, state: Dict[str, Any]) -> Optional[str]:
+    """Answer text locally if it is a status command; None means it needs a model turn.
+
+    Every input passes through here once, so TURN_INPUTS gives the fast-path share.
+    """
+    command = match_command(text)
+    if command is None:
+        TURN_INPUTS.inc(path='model', command='')
+        return None
+    TURN_INPUTS.inc(path='local', command=command)
+    return answer(command, state)
+
+
+def stats() -> Dict[str, Any]:
+    counts = {name: TURN_INPUTS.value(path='local', command=name) for name, _ in COMMANDS}
+    local = sum(counts.values())
+    total = local + TURN_INPUTS.value(path='model', command='')
+    return {"inputs": total, "local": local, "local_fraction": round(local / total, 4) if total else 0.0,
+            "commands": counts}
@@ -0,0 +1,142 @@
+from typing import Optional
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import shutil
+import time
+
+import metrics
+
+LOG_DIR = os.getenv('LOG_DIR', 'logs')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_CONSOLE_LEVEL = os.getenv('LOG_CONSOLE_LEVEL', 'WARNING').upper()
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 50 * 1024 * 1024))
+LOG_ROTATE_SECONDS = int(os.getenv('LOG_ROTATE_SECONDS', 24 * 60 * 60))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 14))
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', 0.1))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+
+ROOT_LOGGER = 'vardovia'
+RECORD_FIELDS = ('ip', 'session', 'action', 'status', 'latency_ms', 'trace_id', 'endpoint', 'method')
+
+LOG_DROPPED = metrics.Counter('vardovia_log_records_dropped_total', 'Log records dropped because the log queue was full')
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the record's structured fields at top level"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in RECORD_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DebugSampler(logging.Filter):
+    """Let through only a fraction of DEBUG records; other levels always pass"""
+
+    def __init__(self, rate: float = LOG_DEBUG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never block the caller: records that don't fit in the queue are counted and dropped"""
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+class RotatingCompressedFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotate when the file exceeds max_bytes or is older than interval seconds, gzipping old files"""
+
+    def __init__(self, filename: str, max_bytes: int = LOG_MAX_BYTES, interval: int = LOG_ROTATE_SECONDS,
+                 backup_count: int = LOG_BACKUP_COUNT):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.interval = interval
+        self.opened_at = time.time()
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self._compress
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.interval and time.time() - self.opened_at >= self.interval:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        super().doRollover()
+        self.opened_at = time.time()
+
+    @staticmethod
+    def _compress(source: str, dest: str):
+        with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+
+def configure(filename: str = 'app.log', console: bool = True, level: str = LOG_LEVEL) -> str:
+    """Route the 'vardovia' loggers through a queue to a background writer thread.
+
+    Records are written as JSON lines to LOG_DIR/filename; WARNING and above
+    (LOG_CONSOLE_LEVEL) are echoed to stderr when console is set. Returns the
+    log file path. Calling it again is a no-op.
+    """
+    global _listener
+    os.makedirs(LOG_DIR, mode=0o755, exist_ok=True)
+    path = os.path.abspath(os.path.join(LOG_DIR, filename))
+    if _listener is not None:
+        return path
+
+    file_handler = RotatingCompressedFileHandler(path)
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(LOG_CONSOLE_LEVEL)
+        console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s - %(message)s'))
+        handlers.append(console_handler)
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(DebugSampler())
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return path
+
+
+def shutdown():
+    """Flush queued records; call before exiting"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(name: Optional[str] = None) -> logging.Logger:
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}" if name else ROOT_LOGGER)
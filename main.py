@@ -1,69 +1,73 @@
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+import argparse
+import asyncio
 import requests
+import base64
 import json
 import textwrap
 import time
 import sys
-import requests
+import threading
 import urllib.parse
 
 import os
 from dotenv import load_dotenv
 
+import async_upstream
+import game_state
+import image_cache
+import image_store
+import local_commands
+import log_pipeline
+import metrics
+import state_repair
+import structured_output
+from session_journal import JOURNAL_DIR, SessionJournal
+from session_store import is_valid_session_id
+import upstream
+from game_state import GameState
+from llm_router import LLMRouter, backends_from_env
+from turn_budget import DeadlineExceeded, TurnBudget
+from upstream import CircuitBreaker, CircuitOpen
+from prompt_builder import PromptAssembler, StorySummarizer, compact_story, needs_compaction, SUMMARY_TOKEN_BUDGET
+
 load_dotenv()
 
 ENABLE_IMAGE_GENERATION = True
 
 GROQ_API_KEY = os.getenv('GROQ_API_KEY')
 STABILITY_API_KEY = os.getenv('STABILITY_API_KEY')
-GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
+GROQ_API_URL = os.getenv('GROQ_API_URL', "https://api.groq.com/openai/v1/chat/completions")
+STABILITY_API_URL = os.getenv('STABILITY_API_URL', "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image")
 MODEL = "llama-3.1-8b-instant"
 TIMEOUT = 20
+IMAGE_TIMEOUT = 60
+IMAGE_DOWNLOAD_MODE = os.getenv('IMAGE_DOWNLOAD_MODE', 'binary').lower()
+IMAGE_CHUNK_SIZE = 64 * 1024
+STATE_DELTA_MODE = os.getenv('STATE_DELTA_MODE', '0').lower() in ('1', 'true', 'yes')
+RESPONSE_MODE = structured_output.RESPONSE_MODE
+TURN_RESPONSE_FORMAT = structured_output.response_format(RESPONSE_MODE)
+CLI_JOURNAL_DIR = os.getenv('CLI_JOURNAL_DIR', os.path.join(JOURNAL_DIR, 'cli'))
+
+scene_image_cache = image_cache.ImageCache(variants=image_store.make_variants)
+llm = LLMRouter(backends_from_env(GROQ_API_URL, MODEL, TIMEOUT))
+stability_breaker = CircuitBreaker('stability')
+log = log_pipeline.get_logger('main')
 
 
 def advance_time(time_str: str, minutes: int) -> str:
-    h, m = map(int, time_str.split(":"))
-    total = h * 60 + m + minutes
-    total %= 24 * 60
-    return f"{total//60:02d}:{total%60:02d}"
+    return game_state.format_clock(game_state.parse_clock(time_str) + minutes)
 
 
 def minimal_sanity_check(state_blob: Dict[str, Any]) -> Tuple[bool, str]:
-    if not isinstance(state_blob, dict):
-        return False, "state not a dict"
-    if 'player_name' not in state_blob or not isinstance(state_blob.get('player_name'), str):
-        return False, "missing or invalid player_name"
-    if 'location' not in state_blob or not isinstance(state_blob.get('location'), str):
-        return False, "missing or invalid location"
-    if 'inventory' not in state_blob or not isinstance(state_blob.get('inventory'), list):
-        return False, "missing or invalid inventory"
-    if 'health' not in state_blob or not isinstance(state_blob.get('health'), (int, float)):
-        return False, "missing or invalid health"
-    if 'danger' not in state_blob or not isinstance(state_blob.get('danger'), (int, float)):
-        return False, "missing or invalid danger"
-    h = state_blob.get('health')
-    if h < 0 or h > 1000:
-        return False, "health out of bounds"
-    d = state_blob.get('danger')
-    if d < 0 or d > 100:
-        return False, "danger out of bounds"
-    if 'time' not in state_blob or not isinstance(state_blob.get('time'), str):
-        return False, "missing or invalid time"
+    try:
+        GameState.from_dict(state_blob)
+    except game_state.InvalidState as e:
+        return False, str(e)
     return True, "ok"
 
 
-def generate_image(prompt, aspect_ratio="16:9", api_key=None):
-    """Generate an image using Stability AI API and save it as output.png"""
-    if api_key is None:
-        api_key = STABILITY_API_KEY
-        
-    import requests
-    import base64
-    import os
-    import sys
-    
-    print(f"Generating image with prompt: {prompt}")
-    
+def stability_request_body(prompt, aspect_ratio="16:9"):
     if aspect_ratio == "16:9":
         width, height = 1344, 768
     elif aspect_ratio == "4:3":
@@ -72,16 +76,8 @@ def generate_image(prompt, aspect_ratio="16:9", api_key=None):
         width = height = 1024
     else:
         width, height = 1216, 832
-    
-    url = "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image"
-    
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
-    
-    body = {
+
+    return {
         "steps": 40,
         "width": width,
         "height": height,
@@ -90,66 +86,133 @@ def generate_image(prompt, aspect_ratio="16:9", api_key=None):
         "samples": 1,
         "text_prompts": [{"text": prompt, "weight": 1}],
     }
-    
+
+
+def generate_image(prompt, aspect_ratio="16:9", api_key=None, deadline=None):
+    """Generate an image using Stability AI API, reusing the cached file for identical requests.
+
+    deadline, when given (the turn's, as a time.monotonic() value), bounds the
+    request with its retries.
+    """
+    body = stability_request_body(prompt, aspect_ratio)
+    key = image_cache.cache_key(STABILITY_API_URL, body)
+    with metrics.span('image_generation'):
+        return scene_image_cache.get_or_create(key, lambda path: request_stability_image(body, path, api_key, deadline))
+
+
+def stability_headers(api_key=None):
+    return {
+        "Content-Type": "application/json",
+        "Accept": "image/png" if IMAGE_DOWNLOAD_MODE == 'binary' else "application/json",
+        "Authorization": f"Bearer {api_key or STABILITY_API_KEY}"
+    }
+
+
+def record_stability_outcome(status):
+    """Feed the Stability breaker: errors, 429 and 5xx count as failures; any other answer means it is up"""
+    if status is None or status == 429 or status >= 500:
+        stability_breaker.record_failure()
+    else:
+        stability_breaker.record_success()
+
+
+def request_stability_image(body, output_path, api_key=None, deadline=None):
+    """Call Stability AI for one image and write it to output_path"""
     try:
-        print("Sending request to Stability AI...")
-        response = requests.post(url, headers=headers, json=body, timeout=60)
-        print(f"Response status: {response.status_code}")
-        
-        if response.status_code == 200:
-            data = response.json()
-            print("Got response from Stability AI")
-            
-            if "artifacts" in data and data["artifacts"]:
-                import time
-                timestamp = int(time.time() * 1000)  
-                
-                static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-                os.makedirs(static_dir, exist_ok=True)
-                
-                filename = f"output_{timestamp}.png"
-                output_path = os.path.join(static_dir, filename)
-                
-                print(f"Saving image to: {output_path}")
-                
-                img_data = base64.b64decode(data["artifacts"][0]["base64"])
-                with open(output_path, "wb") as f:
-                    f.write(img_data)
-                
-                os.chmod(output_path, 0o644)
-                
-                if os.path.exists(output_path):
-                    file_size = os.path.getsize(output_path)
-                    file_mode = oct(os.stat(output_path).st_mode)[-3:]
-                    print(f"Image saved successfully. Size: {file_size} bytes, Permissions: {file_mode}")
-                    print(f"File exists and is readable: {os.access(output_path, os.R_OK)}")
-                    
-                    web_path = f"/static/{filename}"
-                    print(f"Web path for image: {web_path}")
-                    return True, web_path
-                else:
-                    print("Error: File was not created")
-                    return False, "Failed to save image"
-            else:
-                print("No artifacts in response")
-                return False, "No image data in response"
-        else:
-            error_msg = f"API Error: {response.status_code}"
-            try:
-                error_data = response.json()
-                if 'message' in error_data:
-                    error_msg += f" - {error_data['message']}"
-                print(f"API Error: {error_msg}")
-            except:
-                error_msg += f" - {response.text}"
-                print(f"API Error (raw): {error_msg}")
-            return False, error_msg
-            
+        stability_breaker.check()
+    except CircuitOpen as e:
+        log.info("Skipping image: %s", e)
+        return False, str(e)
+    log.info("Generating image with prompt: %s", body['text_prompts'][0]['text'])
+    status = None
+    try:
+        with metrics.span('image_request') as attrs:
+            response = upstream.client.post(STABILITY_API_URL, IMAGE_TIMEOUT, deadline=deadline,
+                                            headers=stability_headers(api_key), json=body, stream=True)
+            status = attrs['status'] = response.status_code
+            with response:
+                return save_stability_response(response, output_path)
     except Exception as e:
-        import traceback
-        print(f"Exception in generate_image: {str(e)}")
-        print(traceback.format_exc())
+        status = None
+        log.exception("Exception in generate_image: %s", e)
         return False, f"Error: {str(e)}"
+    finally:
+        record_stability_outcome(status)
+
+
+async def generate_image_async(prompt, aspect_ratio="16:9", api_key=None, deadline=None):
+    """Asyncio counterpart of generate_image; must run on async_upstream.engine"""
+    body = stability_request_body(prompt, aspect_ratio)
+    key = image_cache.cache_key(STABILITY_API_URL, body)
+    with metrics.span('image_generation'):
+        return await scene_image_cache.get_or_create_async(
+            key, lambda path: request_stability_image_async(body, path, api_key, deadline))
+
+
+async def request_stability_image_async(body, output_path, api_key=None, deadline=None):
+    try:
+        stability_breaker.check()
+    except CircuitOpen as e:
+        log.info("Skipping image: %s", e)
+        return False, str(e)
+    log.info("Generating image with prompt: %s", body['text_prompts'][0]['text'])
+    status = None
+    try:
+        with metrics.span('image_request') as attrs:
+            response = await async_upstream.client.post(STABILITY_API_URL, IMAGE_TIMEOUT, deadline=deadline,
+                                                        provider='stability', headers=stability_headers(api_key),
+                                                        json=body, save_type='image/',
+                                                        save_to=output_path if IMAGE_DOWNLOAD_MODE == 'binary' else None)
+            status = attrs['status'] = response.status_code
+        if response.saved_bytes is not None:
+            return True, output_path
+        return await asyncio.to_thread(save_stability_response, response, output_path)
+    except Exception as e:
+        status = None
+        log.exception("Exception in generate_image: %s", e)
+        return False, f"Error: {str(e)}"
+    finally:
+        record_stability_outcome(status)
+
+
+def save_stability_response(response, output_path):
+    """Write the image in a Stability AI response to output_path.
+
+    output_path is the image cache's temp file, written in place; the cache
+    renames it once the write succeeded. Raw image bodies are streamed to
+    disk in IMAGE_CHUNK_SIZE pieces, so memory stays flat whatever the image
+    size; JSON bodies carry it base64 encoded and are decoded in one go.
+    """
+    log.debug("Stability AI response status: %s", response.status_code)
+
+    if response.status_code == 200:
+        if response.headers.get('Content-Type', '').startswith('image/'):
+            with metrics.span('image_save') as attrs:
+                attrs['bytes'] = image_store.write_chunks(response.iter_content(IMAGE_CHUNK_SIZE), output_path)
+            return True, output_path
+        data = response.json()
+        if "artifacts" in data and data["artifacts"]:
+            log.debug("Saving image to: %s", output_path)
+
+            with metrics.span('image_decode'):
+                img_data = base64.b64decode(data["artifacts"][0]["base64"])
+            with metrics.span('image_save', bytes=len(img_data)):
+                image_store.write_chunks((img_data,), output_path)
+            return True, output_path
+        else:
+            log.error("No artifacts in Stability AI response")
+            return False, "No image data in response"
+    else:
+        error_msg = f"API Error: {response.status_code}"
+        try:
+            error_data = response.json()
+            if 'message' in error_data:
+                error_msg += f" - {error_data['message']}"
+            log.error("Stability AI error: %s", error_msg)
+        except:
+            error_msg += f" - {response.text}"
+            log.error("Stability AI error (raw): %s", error_msg)
+        return False, error_msg
 
 
 SYSTEM_PROMPT = textwrap.dedent(r"""
@@ -254,26 +317,126 @@ Answer format is strict. If you cannot produce valid JSON on the first line, ins
 output a single-line error starting with `ERROR_JSON:` and a short reason.
 """)
 
+DELTA_SYSTEM_PROMPT = SYSTEM_PROMPT + textwrap.dedent(r"""
+DELTA STATE MODE (this replaces the GAME_STATE_JSON line required by rules 1 and 6):
+- The first non-empty line MUST begin with `GAME_STATE_DELTA: ` followed by a compact JSON object
+  holding ONLY the fields that changed compared to PREVIOUS_STATE_JSON. Leave unchanged fields out.
+- Always include "time", since time moves forward every turn.
+- Objects such as flags are merged key by key; set a key to null to remove it.
+- For inventory, npcs and objectives give either the complete new array, or
+  {"add": [...], "remove": [...]}. NPCs are matched by "name"; adding an NPC that is already present updates it.
+  Give [] to empty one of these arrays.
 
-def call_groq(previous_state_json: str, story_log: list, player_action: str, api_key: str = None) -> str:
-    if api_key is None:
-        api_key = GROQ_API_KEY
-        
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
+   Example:
+   GAME_STATE_DELTA: {"location":"Boiler Room","time":"21:55","inventory":{"add":["rusty key"],"remove":["crumpled note"]},"flags":{"door_open":true}}
+""")
+
+
+STRUCTURED_SYSTEM_PROMPT = SYSTEM_PROMPT + textwrap.dedent(r"""
+STRUCTURED OUTPUT MODE (this replaces the answer format of rules 1 and 6 and the [IMAGE_PROMPT: ...] block):
+- Answer with exactly one JSON object and nothing else:
+  {"state": {...the complete new game state, as described in rule 2...},
+   "narration": "the narration text",
+   "image_prompt": "the image generation prompt, or null"}
+- Put any model error in the narration; never answer with ERROR_JSON.
+""")
+
+
+if structured_output.is_structured(RESPONSE_MODE):
+    prompt_assembler = PromptAssembler(STRUCTURED_SYSTEM_PROMPT)
+else:
+    prompt_assembler = PromptAssembler(DELTA_SYSTEM_PROMPT if STATE_DELTA_MODE else SYSTEM_PROMPT)
+
+
+def build_messages(previous_state_json: str, story_log: list, player_action: str, story_summary: str = "",
+                   prompt_stats: Optional[dict] = None) -> List[Dict[str, str]]:
+    messages, stats = prompt_assembler.build(previous_state_json, story_log, player_action, story_summary)
+    if prompt_stats is not None:
+        prompt_stats.update(stats)
+    return messages
+
+
+def groq_request(previous_state_json: str, story_log: list, player_action: str, story_summary: str = "",
+                 prompt_stats: Optional[dict] = None) -> Dict[str, Any]:
+    """Payload for one turn's chat completion; the router fills in each backend's model"""
+    messages = build_messages(previous_state_json, story_log, player_action, story_summary, prompt_stats)
+    payload = {"model": MODEL, "messages": messages, "max_tokens": 600, "temperature": 0.3}
+    if TURN_RESPONSE_FORMAT is not None:
+        payload["response_format"] = TURN_RESPONSE_FORMAT
+    return payload
+
+
+def completion_text(data: Dict[str, Any]) -> str:
+    metrics.record_token_usage(data.get("usage"))
+    return data["choices"][0]["message"]["content"]
+
+
+def call_groq(previous_state_json: str, story_log: list, player_action: str, api_key: str = None,
+              story_summary: str = "", prompt_stats: Optional[dict] = None, deadline: Optional[float] = None) -> str:
+    payload = groq_request(previous_state_json, story_log, player_action, story_summary, prompt_stats)
+    return completion_text(llm.complete(payload, api_key, deadline=deadline))
+
+
+async def call_groq_async(previous_state_json: str, story_log: list, player_action: str, api_key: str = None,
+                          story_summary: str = "", prompt_stats: Optional[dict] = None,
+                          deadline: Optional[float] = None) -> str:
+    """Asyncio counterpart of call_groq; must run on async_upstream.engine, where calls
+    wait for a Groq slot or fail fast with async_upstream.Overloaded"""
+    payload = groq_request(previous_state_json, story_log, player_action, story_summary, prompt_stats)
+    return completion_text(await llm.complete_async(payload, api_key, deadline=deadline))
+
+
+def call_groq_stream(previous_state_json: str, story_log: list, player_action: str, api_key: str = None,
+                     story_summary: str = "", prompt_stats: Optional[dict] = None,
+                     deadline: Optional[float] = None) -> Iterator[str]:
+    """Like call_groq, but yields the completion text piece by piece as it is generated"""
+    payload = dict(groq_request(previous_state_json, story_log, player_action, story_summary, prompt_stats),
+                   stream=True)
+    started = time.perf_counter()
+    usage = None
+    with metrics.span('llm', stream=True) as attrs:
+        with llm.stream(payload, api_key, deadline) as (backend, resp):
+            attrs.update(model=backend.model, backend=backend.name, status=resp.status_code)
+            resp.encoding = 'utf-8'
+            for line in resp.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                chunk = line[len("data:"):].strip()
+                if chunk == "[DONE]":
+                    break
+                event = json.loads(chunk)
+                usage = event.get("usage") or event.get("x_groq", {}).get("usage") or usage
+                if not event.get("choices"):
+                    continue
+                delta = event["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    if 'first_token_ms' not in attrs:
+                        attrs['first_token_ms'] = round((time.perf_counter() - started) * 1000, 2)
+                    yield delta
+    metrics.record_token_usage(usage)
+
+
+def call_groq_summary(story_summary: str, narrations: list, api_key: str = None) -> str:
+    """Ask the model to fold older narrations into the rolling story summary"""
     messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "system", "content": "STORY_SO_FAR:\n" + "\n".join(story_log)},
-        {"role": "system", "content": f"PREVIOUS_STATE_JSON: {previous_state_json}"},
-        {"role": "user", "content": f"Player action: {player_action}\n\nRespond in the exact required format."}
+        {"role": "system", "content": (
+            "You maintain the running summary of a text adventure. Merge the previous summary and the new "
+            f"story events into one compact past-tense summary under {SUMMARY_TOKEN_BUDGET * 3 // 4} words. "
+            "Keep names, items, promises, injuries and locations. Output only the summary."
+        )},
+        {"role": "user", "content": f"PREVIOUS_SUMMARY:\n{story_summary or '(none)'}\n\nNEW_EVENTS:\n" + "\n".join(narrations)}
     ]
-    payload = {"model": MODEL, "messages": messages, "max_tokens": 600, "temperature": 0.3}
-    resp = requests.post(GROQ_API_URL, headers=headers, json=payload, timeout=TIMEOUT)
-    resp.raise_for_status()
-    data = resp.json()
-    return data["choices"][0]["message"]["content"]  
+    payload = {"model": MODEL, "messages": messages, "max_tokens": SUMMARY_TOKEN_BUDGET, "temperature": 0.2}
+    return completion_text(llm.complete(payload, api_key, stage='llm_summary'))
+
+
+def parse_state_line(first: str) -> Dict[str, Any]:
+    if first.startswith("ERROR_JSON:"):
+        raise ValueError(f"model-error: {first}")
+    if not first.startswith("GAME_STATE_JSON:"):
+        raise ValueError("missing GAME_STATE_JSON prefix")
+    json_part = first[len("GAME_STATE_JSON:"):].strip()
+    return json.loads(json_part)
 
 
 def parse_model_response(raw: str) -> Tuple[Dict[str, Any], str]:  
@@ -283,13 +446,7 @@ def parse_model_response(raw: str) -> Tuple[Dict[str, Any], str]:
         i += 1  
     if i >= len(lines):  
         raise ValueError("empty response")  
-    first = lines[i].strip()  
-    if first.startswith("ERROR_JSON:"):  
-        raise ValueError(f"model-error: {first}")  
-    if not first.startswith("GAME_STATE_JSON:"):  
-        raise ValueError("missing GAME_STATE_JSON prefix")  
-    json_part = first[len("GAME_STATE_JSON:"):].strip()  
-    state_obj = json.loads(json_part)  
+    state_obj = parse_state_line(lines[i].strip())
     j = i + 1  
     if j < len(lines) and lines[j].strip() != "":  
         narration = "\n".join(lines[j:]).strip()  
@@ -298,6 +455,254 @@ def parse_model_response(raw: str) -> Tuple[Dict[str, Any], str]:
     return state_obj, narration  
 
 
+IMAGE_PROMPT_OPEN = "[IMAGE_PROMPT:"
+
+
+def split_image_prompt(raw: str) -> Tuple[str, Optional[str]]:
+    """Remove the [IMAGE_PROMPT: ...] block from a reply; returns (text, prompt or None)"""
+    if IMAGE_PROMPT_OPEN not in raw:
+        return raw, None
+    before_prompt, after_prompt = raw.split(IMAGE_PROMPT_OPEN, 1)
+    if ']' not in after_prompt:
+        return raw, None
+    prompt_part, after = after_prompt.split(']', 1)
+    text = "\n\n".join(part for part in (before_prompt.strip(), after.strip()) if part)
+    return text, prompt_part.strip() or None
+
+
+def parse_text_reply(raw: str, previous_state: Dict[str, Any]) -> Tuple[Dict[str, Any], str, Optional[str], List[str]]:
+    """The GAME_STATE_JSON / [IMAGE_PROMPT: ...] text protocol, repaired leniently"""
+    text, image_prompt = split_image_prompt(raw)
+    state_obj, narration, repairs = state_repair.resolve_turn(text, previous_state)
+    return state_obj, narration, image_prompt, repairs
+
+
+def parse_structured_reply(raw: str, previous_state: Dict[str, Any]) -> Tuple[Dict[str, Any], str, Optional[str], List[str]]:
+    """A structured-output reply in one pass; a reply that isn't one (a backend that
+    ignored response_format, say) goes through the text protocol parser instead"""
+    try:
+        state_obj, narration, image_prompt = structured_output.parse_reply(raw)
+    except structured_output.StructuredReplyError as e:
+        log.warning("Structured reply unreadable (%s), trying the text protocol", e)
+        try:
+            parsed = parse_text_reply(raw, previous_state)
+        except state_repair.StateRepairError:
+            structured_output.record(RESPONSE_MODE, 'failed')
+            raise
+        structured_output.record(RESPONSE_MODE, 'fallback')
+        return parsed
+    state_obj, repairs = state_repair.repair_state(state_obj, previous_state)
+    state_repair.record_repairs(repairs)
+    structured_output.record(RESPONSE_MODE, 'parsed')
+    return state_obj, narration, image_prompt, repairs
+
+
+def parse_reply(raw: str, previous_state: Dict[str, Any]) -> Tuple[Dict[str, Any], str, Optional[str], List[str]]:
+    """(state, narration, image_prompt, repairs) in the configured RESPONSE_MODE"""
+    if structured_output.is_structured(RESPONSE_MODE):
+        return parse_structured_reply(raw, previous_state)
+    try:
+        parsed = parse_text_reply(raw, previous_state)
+    except state_repair.StateRepairError:
+        structured_output.record('text', 'failed')
+        raise
+    structured_output.record('text', 'parsed')
+    return parsed
+
+
+def resolve_model_reply(raw: str, previous_state: Dict[str, Any]) -> Tuple[GameState, str, Optional[str], List[str]]:
+    """Parse, repair and check a single reply; raises StateRepairError if it is unusable"""
+    with metrics.span('parse', mode=RESPONSE_MODE) as attrs:
+        state_obj, narration, image_prompt, repairs = parse_reply(raw, previous_state)
+        attrs['repairs'] = len(repairs)
+    with metrics.span('sanity_check') as attrs:
+        try:
+            state = GameState.from_dict(state_obj)
+        except game_state.InvalidState as e:
+            attrs['ok'] = False
+            raise state_repair.StateRepairError(str(e)) from None
+        attrs['ok'] = True
+    return state, narration, image_prompt, repairs
+
+
+def resolve_model_turn(request_response, previous_state: Dict[str, Any]) -> Tuple[GameState, str, Optional[str], List[str]]:
+    """Turn a model reply into (GameState, narration, image_prompt, repairs).
+
+    Malformed state is repaired locally against previous_state; request_response
+    is called again for a corrected reply only when that is impossible. Raises
+    StateRepairError if the second reply cannot be used either.
+    """
+    try:
+        return resolve_model_reply(request_response(), previous_state)
+    except state_repair.StateRepairError as e:
+        log.warning("Model state could not be repaired (%s). Requesting correction from model...", e)
+        state_repair.record_outcome('reprompted')
+    try:
+        return resolve_model_reply(request_response(), previous_state)
+    except state_repair.StateRepairError:
+        state_repair.record_outcome('failed')
+        raise
+
+
+async def resolve_model_turn_async(request_response, previous_state: Dict[str, Any]) -> Tuple[GameState, str, Optional[str], List[str]]:
+    """resolve_model_turn for a coroutine function request_response"""
+    try:
+        return resolve_model_reply(await request_response(), previous_state)
+    except state_repair.StateRepairError as e:
+        log.warning("Model state could not be repaired (%s). Requesting correction from model...", e)
+        state_repair.record_outcome('reprompted')
+    try:
+        return resolve_model_reply(await request_response(), previous_state)
+    except state_repair.StateRepairError:
+        state_repair.record_outcome('failed')
+        raise
+
+
+class ResponseStreamParser:
+    """Incremental counterpart of parse_model_response for streamed completions.
+
+    feed() takes raw text chunks and returns a list of (kind, value) events:
+    ("state", dict) once the GAME_STATE_JSON line is complete, ("narration", str)
+    for narration text as it arrives, and ("image_prompt", str) as soon as the
+    [IMAGE_PROMPT: ...] block closes. Text that might be the start of that block
+    is held back until it can be told apart from ordinary narration. The state
+    goes through state_repair against previous_state before it is emitted.
+    """
+
+    def __init__(self, previous_state: Optional[Dict[str, Any]] = None):
+        self.previous_state = previous_state
+        self.state = None
+        self.repairs = []
+        self.image_prompt = None
+        self.narration_parts = []
+        self._buffer = ""
+        self._in_prompt = False
+        self._leading = True
+
+    @property
+    def narration(self) -> str:
+        return "".join(self.narration_parts).strip()
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        self._buffer += chunk
+        events = []
+        if self.state is None:
+            stripped = self._buffer.lstrip()
+            newline = stripped.find("\n")
+            if newline == -1:
+                return events
+            brace = stripped.find("{", 0, newline)
+            if brace == -1:
+                end = newline
+            else:
+                end = state_repair.scan_object(stripped, brace)[0]
+                if end == -1:
+                    return events
+            self._set_state(stripped[:end])
+            self._buffer = stripped[end:]
+            events.append(("state", self.state))
+        self._drain(events, final=False)
+        return events
+
+    def finish(self) -> List[Tuple[str, Any]]:
+        events = []
+        if self.state is None:
+            self._buffer = self._set_state(self._buffer)
+            events.append(("state", self.state))
+        self._drain(events, final=True)
+        return events
+
+    def _set_state(self, text: str) -> str:
+        try:
+            state, rest, repairs = state_repair.parse_response(text, self.previous_state)
+        except state_repair.StateRepairError:
+            structured_output.record('text', 'failed')
+            raise
+        structured_output.record('text', 'parsed')
+        self.state, state_repairs = state_repair.repair_state(state, self.previous_state)
+        self.repairs = repairs + state_repairs
+        state_repair.record_repairs(self.repairs)
+        return rest
+
+    def _drain(self, events: List[Tuple[str, Any]], final: bool):
+        while self._buffer:
+            if self._in_prompt:
+                end = self._buffer.find("]")
+                if end == -1:
+                    if final:
+                        self._buffer = ""
+                    return
+                self.image_prompt = self._buffer[:end].strip()
+                self._buffer = self._buffer[end + 1:]
+                self._in_prompt = False
+                events.append(("image_prompt", self.image_prompt))
+                continue
+            start = self._buffer.find(IMAGE_PROMPT_OPEN) if self.image_prompt is None else -1
+            if start != -1:
+                text, self._buffer = self._buffer[:start], self._buffer[start + len(IMAGE_PROMPT_OPEN):]
+                self._in_prompt = True
+            elif final or self.image_prompt is not None:
+                text, self._buffer = self._buffer, ""
+            else:
+                hold = self._partial_prompt_suffix()
+                text, self._buffer = self._buffer[:len(self._buffer) - hold], self._buffer[len(self._buffer) - hold:]
+            self._emit(events, text)
+            if not self._in_prompt:
+                return
+
+    def _partial_prompt_suffix(self) -> int:
+        start = self._buffer.rfind("[")
+        if start != -1 and IMAGE_PROMPT_OPEN.startswith(self._buffer[start:]):
+            return len(self._buffer) - start
+        return 0
+
+    def _emit(self, events: List[Tuple[str, Any]], text: str):
+        if self._leading:
+            text = text.lstrip()
+            if not text:
+                return
+            self._leading = False
+        if text:
+            self.narration_parts.append(text)
+            events.append(("narration", text))
+
+
+class StructuredStreamParser:
+    """ResponseStreamParser's interface for structured-output streams.
+
+    Narration sits inside a JSON string, so nothing is emitted until the
+    stream ends; finish() then parses the whole reply in one pass and returns
+    the state, narration and image_prompt events together.
+    """
+
+    def __init__(self, previous_state: Optional[Dict[str, Any]] = None):
+        self.previous_state = previous_state
+        self.state = None
+        self.repairs = []
+        self.image_prompt = None
+        self.narration = ""
+        self._chunks = []
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        self._chunks.append(chunk)
+        return []
+
+    def finish(self) -> List[Tuple[str, Any]]:
+        self.state, self.narration, self.image_prompt, self.repairs = parse_structured_reply(
+            "".join(self._chunks), self.previous_state)
+        events = [("state", self.state), ("narration", self.narration)]
+        if self.image_prompt:
+            events.append(("image_prompt", self.image_prompt))
+        return events
+
+
+def stream_parser(previous_state: Optional[Dict[str, Any]] = None):
+    """The incremental parser for RESPONSE_MODE"""
+    if structured_output.is_structured(RESPONSE_MODE):
+        return StructuredStreamParser(previous_state)
+    return ResponseStreamParser(previous_state)
+
+
 def pretty_print_state(s: Dict[str, Any]):  
     loc = s.get('location', 'Unknown')  
     inv = s.get('inventory', [])  
@@ -307,22 +712,108 @@ def pretty_print_state(s: Dict[str, Any]):
     print(f"\n[Location: {loc}] [Time: {t}] [Health: {health}] [Danger: {danger}] [Inventory: {len(inv)} items]\n")  
 
 
-def main():  
-    bootstrap_state = {  
-        "player_name": "Arsen Dvorak",  
-        "location": "Basement",  
-        "inventory": ["wristwatch", "crumpled note"],  
-        "health": 90,  
-        "danger": 1,  
-        "time": "21:40",  
-        "flags": {"initialized": False}  
-    }  
-
-    state = bootstrap_state  
-    previous_state_json = json.dumps(bootstrap_state, separators=(',',':'))  
-
-    story_log = []
+BOOTSTRAP_STATE = {
+    "player_name": "Arsen Dvorak",
+    "location": "Basement",
+    "inventory": ["wristwatch", "crumpled note"],
+    "health": 90,
+    "danger": 1,
+    "time": "21:40",
+    "flags": {"initialized": False}
+}
+
+
+def take_turn(state: Union[GameState, Dict[str, Any]], story_log: list, story_summary: str, player_action: str,
+              image_generator=generate_image, budget: Optional[TurnBudget] = None) -> Dict[str, Any]:
+    """Play one model turn from state without touching the story; raises StateRepairError.
+
+    image_generator(prompt, deadline=monotonic time) -> (success, url or message)
+    renders the scene, or None skips it. The model calls share budget (a new
+    TURN_DEADLINE one by default) and raise DeadlineExceeded once it is spent;
+    the image is skipped when too little of it is left or the Stability breaker
+    is open. Returns the new state as a dict and as a GameState (clock
+    advanced), narration, image, repairs, every raw response, the prompt stats
+    and the budget report.
+    """
+    budget = budget or TurnBudget()
+    current = state if isinstance(state, GameState) else GameState.from_dict(state)
+    previous_state = current.to_dict()
+    prompt_stats = {}
+    responses = []
+
+    def request_response():
+        try:
+            responses.append(call_groq(
+                previous_state_json=current.json_text(),
+                story_log=story_log,
+                player_action=player_action,
+                api_key=GROQ_API_KEY,
+                story_summary=story_summary,
+                prompt_stats=prompt_stats,
+                deadline=budget.allot('llm')
+            ))
+        except Exception:
+            budget.check('llm')
+            raise
+        return responses[-1]
+
+    new_state, narration, image_prompt, repairs = resolve_model_turn(request_response, previous_state)
+    budget.finished('llm')
+    image = None
+    if image_prompt and image_generator is not None:
+        image = {"prompt": image_prompt, "url": None}
+        if not stability_breaker.available():
+            budget.skip('image', 'circuit_open')
+        elif budget.allows('image'):
+            success, message = image_generator(image_prompt, deadline=budget.deadline)
+            image["url"] = message if success else None
+            budget.finished('image')
+
+    new_state = new_state.advanced(5)
+    return {"state": new_state.to_dict(), "game_state": new_state, "narration": narration, "image": image,
+            "repairs": repairs, "responses": responses, "prompt_stats": prompt_stats, "budget": budget.to_dict()}
+
+
+def cli_scene_image(prompt: str, deadline: Optional[float] = None) -> Tuple[bool, Optional[str]]:
+    print("\nGenerating scene image...")
+    success, message = generate_image(prompt, deadline=deadline)
+    if not success and message:
+        print(message)
+    return success, message
+
+
+def main(resume: Optional[str] = None):
+    log_pipeline.configure('cli.log', console=False)
+    state = json.loads(json.dumps(BOOTSTRAP_STATE))
+
+    story = {"story_log": [], "story_summary": "", "state_version": 0}
+    story_lock = threading.Lock()
     MAX_STORY_LOG = 8
+    summarizer = StorySummarizer(call_groq_summary)
+    journal = SessionJournal(CLI_JOURNAL_DIR)
+
+    save_id = None
+    if resume:
+        save_id = journal.latest('cli-') if resume == 'latest' else resume
+        restored = journal.load(save_id, MAX_STORY_LOG) if is_valid_session_id(save_id) else None
+        if restored is None:
+            print(f"No saved game found for '{resume}', starting a new one.")
+            save_id = None
+        else:
+            state = restored.get('state', state)
+            for key in story:
+                story[key] = restored.get(key, story[key])
+    if save_id is None:
+        save_id = f"cli-{time.strftime('%Y%m%d-%H%M%S')}"
+    try:
+        game = GameState.from_dict(state)
+    except game_state.InvalidState:
+        state, _ = state_repair.repair_state(state, BOOTSTRAP_STATE)
+        game = GameState.from_dict(state)
+
+    def apply_summary(summarized, new_summary):
+        with story_lock:
+            compact_story(story, summarized, new_summary)
 
     print("\n╔════════════════════════════════════════════════════════════╗")
     print("║                 ESCAPE FROM VARDOVIA                ║")
@@ -332,7 +823,10 @@ def main():
     print("After publishing an exposé, you were captured and imprisoned in a secret facility.")
     print("You've just woken up in a dark basement, your head pounding from the drugs they gave you.")
     print("\nType your actions in simple English. For example: 'search the room', 'open the door', 'talk to the guard'")
-    print("Type 'inventory' to check your items, or 'quit' to exit.\n")
+    print("Type 'inventory' to check your items, 'help' for more commands, or 'quit' to exit.\n")
+    print(f"Your game is saved as '{save_id}'. Continue it later with: python main.py --resume {save_id}")
+    if story["story_log"]:
+        print("\n" + story["story_log"][-1])
 
     while True:
         print("\n" + "=" * 50)
@@ -344,54 +838,48 @@ def main():
             print("Thanks for playing!")
             break
 
-        try:
-            response = call_groq(
-                previous_state_json=json.dumps(state),
-                story_log=story_log,
-                player_action=player_action,
-                api_key=GROQ_API_KEY
-            )
-
-            if '[IMAGE_PROMPT:' in response and ']' in response:
-                before_prompt, after_prompt = response.split('[IMAGE_PROMPT:', 1)
-                prompt_part, after = after_prompt.split(']', 1)
-
-                clean_response = before_prompt.strip() + after.strip()
-                state_obj, narration = parse_model_response(clean_response)
-
-                print("\nGenerating scene image...")
-                success, message = generate_image(prompt_part.strip())
-                if not success and message:
-                    print(message)
-            else:
-                state_obj, narration = parse_model_response(response)
-
-            ok, reason = minimal_sanity_check(state_obj)
-            if not ok:
-                print(f"State failed sanity check: {reason}. Requesting correction from model...")
-                response = call_groq(
-                    previous_state_json=json.dumps(state),
-                    story_log=story_log,
-                    player_action=player_action,
-                    api_key=GROQ_API_KEY
-                )
-                state_obj, narration = parse_model_response(response)
-                ok, reason = minimal_sanity_check(state_obj)
-                if not ok:
-                    print("Model correction failed. Aborting turn.")
-                    continue
-
-            state_obj["time"] = advance_time(
-                state_obj.get("time", "00:00"),
-                5
-            )
+        reply = local_commands.route(player_action, state)
+        if reply is not None:
+            print("\n" + reply)
+            continue
 
-            previous_state_json = json.dumps(state_obj, separators=(',', ':'))
+        try:
+            with story_lock:
+                story_log = list(story["story_log"])
+                story_summary = story["story_summary"]
+            try:
+                turn = take_turn(game, story_log, story_summary, player_action, cli_scene_image)
+            except state_repair.StateRepairError:
+                print("Model correction failed. Aborting turn.")
+                continue
+            except DeadlineExceeded as e:
+                log.warning("Turn abandoned: %s", e)
+                print("The story engine took too long to answer. Try again.")
+                continue
+            state_obj, narration, prompt_stats = turn["state"], turn["narration"], turn["prompt_stats"]
             print("\n" + narration + "\n")
-
-            story_log.append(narration)
-            if len(story_log) > MAX_STORY_LOG:
-                story_log = story_log[-MAX_STORY_LOG:]
+            skipped = turn["budget"]["skipped"].get('image')
+            if skipped:
+                print("(No scene image this turn: " + ("the image service is unavailable" if skipped == 'circuit_open'
+                                                       else "out of time") + ")")
+
+            with story_lock:
+                story["story_log"].append(narration)
+                if len(story["story_log"]) > MAX_STORY_LOG:
+                    story["story_log"] = story["story_log"][-MAX_STORY_LOG:]
+                if needs_compaction(story["story_log"], prompt_stats):
+                    summarizer.schedule("cli", story["story_summary"], story["story_log"], apply_summary)
+                story["state_version"] += 1
+                journal.record(save_id, {
+                    "state_version": story["state_version"],
+                    "action": player_action,
+                    "response": turn["responses"][-1],
+                    "narration": narration,
+                    "image": turn["image"],
+                    "repairs": turn["repairs"],
+                    "prompt_stats": prompt_stats,
+                    "budget": turn["budget"]
+                }, dict(story, state=state_obj), state_json=turn["game_state"].to_json())
 
             flags = state_obj.get('flags', {}) or {}
             if flags.get('escaped'):
@@ -401,17 +889,27 @@ def main():
                 print("You have died. Game over.")
                 break
 
-            state = state_obj
+            state, game = state_obj, turn["game_state"]
 
         except requests.exceptions.RequestException as e:
+            log.warning("Network/API error: %s", e)
             print(f"Network/API error: {e}")
             time.sleep(1)
         except KeyboardInterrupt:
+            journal.flush()
+            log_pipeline.shutdown()
             print("\nSession interrupted. Goodbye.")
             sys.exit(0)
         except Exception as e:
+            log.exception("Unexpected error: %s", e)
             print(f"Unexpected error: {e}")
 
+    journal.flush()
+    log_pipeline.shutdown()
+
 
-if __name__ == '__main__':  
-    main()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Escape from Vardovia")
+    parser.add_argument('--resume', nargs='?', const='latest', metavar='SAVE_ID',
+                        help="continue a saved game (the most recent one if no id is given)")
+    main(resume=parser.parse_args().resume)
@@ -0,0 +1,220 @@
+from typing import Any, Dict, List, Optional, Tuple
+from contextlib import contextmanager
+import contextvars
+import threading
+import time
+import uuid
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, float('inf'))
+TRACE_HEADER = 'X-Trace-Id'
+
+_registry = []
+
+
+def _label_key(labelnames: Tuple[str, ...], labels: Dict[str, Any]) -> Tuple[str, ...]:
+    return tuple(str(labels.get(name, '')) for name in labelnames)
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    le = f'le="{_format_value(bound)}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram('vardovia_stage_seconds', 'Time spent in each stage of a turn', ('stage',))
+STAGE_ERRORS = Counter('vardovia_stage_errors_total', 'Stages that raised an exception', ('stage',))
+UPSTREAM_SECONDS = Histogram('vardovia_upstream_request_seconds', 'Latency of single upstream HTTP attempts', ('host',))
+UPSTREAM_RESPONSES = Counter('vardovia_upstream_responses_total', 'Upstream HTTP attempts by status code', ('host', 'status'))
+LLM_TOKENS = Counter('vardovia_llm_tokens_total', 'Tokens reported by the LLM provider', ('kind',))
+HTTP_REQUESTS = Counter('vardovia_http_requests_total', 'HTTP requests served', ('endpoint', 'method', 'status'))
+HTTP_SECONDS = Histogram('vardovia_http_request_seconds', 'HTTP request latency until the response is returned', ('endpoint',))
+
+
+class Trace:
+    """Spans recorded while handling one player action"""
+
+    def __init__(self, trace_id: Optional[str] = None):
+        self.id = trace_id or uuid.uuid4().hex
+        self.started = time.perf_counter()
+        self.spans = []
+        self.attrs = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float, attrs: Dict[str, Any]):
+        with self._lock:
+            self.spans.append(dict(attrs, stage=stage, ms=round(seconds * 1000, 2)))
+
+    def annotate(self, **attrs):
+        with self._lock:
+            self.attrs.update(attrs)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.attrs, trace_id=self.id, spans=list(self.spans),
+                        elapsed_ms=round((time.perf_counter() - self.started) * 1000, 2))
+
+
+_current_trace = contextvars.ContextVar('vardovia_trace', default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def start_trace(trace_id: Optional[str] = None):
+    """Begin a trace in the current context; returns (trace, token) for end_trace"""
+    trace = Trace(trace_id)
+    return trace, _current_trace.set(trace)
+
+
+def end_trace(token):
+    _current_trace.reset(token)
+
+
+def iterate_in_context(generator):
+    """Step a generator inside the context current at call time, so a streamed
+    response keeps its request's trace after the view function has returned"""
+    context = contextvars.copy_context()
+
+    def steps():
+        try:
+            while True:
+                try:
+                    item = context.run(next, generator)
+                except StopIteration:
+                    return
+                yield item
+        finally:
+            context.run(generator.close)
+
+    return steps()
+
+
+def is_valid_trace_id(trace_id: Optional[str]) -> bool:
+    return bool(trace_id) and len(trace_id) <= 64 and all(c.isalnum() or c in '-_.' for c in trace_id)
+
+
+@contextmanager
+def span(stage: str, **attrs):
+    """Time a stage into STAGE_SECONDS and the current trace; yields a dict for extra attributes"""
+    started = time.perf_counter()
+    try:
+        yield attrs
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage)
+        attrs['error'] = True
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - started, **attrs)
+
+
+def record_stage(stage: str, seconds: float, **attrs):
+    """Record a stage timed by the caller, e.g. work accumulated over many small steps"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(stage, seconds, attrs)
+
+
+def record_token_usage(usage: Optional[Dict[str, Any]]):
+    if not usage:
+        return
+    for kind in ('prompt_tokens', 'completion_tokens'):
+        if usage.get(kind):
+            LLM_TOKENS.inc(usage[kind], kind=kind[:-len('_tokens')])
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.annotate(prompt_tokens=usage.get('prompt_tokens'), completion_tokens=usage.get('completion_tokens'))
@@ -0,0 +1,196 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import math
+import os
+import queue
+import re
+import threading
+
+import log_pipeline
+
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 3000))
+SUMMARY_TOKEN_BUDGET = int(os.getenv('SUMMARY_TOKEN_BUDGET', 300))
+SUMMARY_KEEP_RECENT = int(os.getenv('SUMMARY_KEEP_RECENT', 4))
+SUMMARY_BATCH = int(os.getenv('SUMMARY_BATCH', 4))
+CHARS_PER_TOKEN = 4
+
+log = log_pipeline.get_logger('prompt_builder')
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token for English prose)"""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text: str, tokens: int) -> str:
+    limit = tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    return text[len(text) - limit:]
+
+
+def fallback_summary(summary: str, narrations: List[str], tokens: int = SUMMARY_TOKEN_BUDGET) -> str:
+    """Local summary used when the model is unavailable: first sentence of each narration"""
+    sentences = []
+    for narration in narrations:
+        first = re.split(r'(?<=[.!?])\s', narration.strip(), maxsplit=1)[0]
+        if first:
+            sentences.append(first)
+    merged = " ".join(part for part in [summary.strip()] + sentences if part)
+    return truncate_to_tokens(merged, tokens)
+
+
+class PromptAssembler:
+    """Assemble the chat messages for a turn within a token budget.
+
+    Messages are ordered from most to least stable (system prompt, story
+    summary, recent narrations, previous state, player action) so that
+    provider-side prompt caching can reuse the longest possible prefix.
+    Recent narrations fill whatever budget is left, newest first; the ones
+    that don't fit are reported so they can be folded into the summary.
+    """
+
+    def __init__(self, system_prompt: str, budget: int = PROMPT_TOKEN_BUDGET):
+        self.system_prompt = system_prompt
+        self.system_tokens = estimate_tokens(system_prompt)
+        self.budget = budget
+
+    def build(self, previous_state_json: str, story_log: List[str], player_action: str,
+              story_summary: str = "") -> Tuple[List[Dict[str, str]], Dict[str, int]]:
+        state_content = f"PREVIOUS_STATE_JSON: {previous_state_json}"
+        action_content = f"Player action: {player_action}\n\nRespond in the exact required format."
+        summary = truncate_to_tokens(story_summary, SUMMARY_TOKEN_BUDGET) if story_summary else ""
+
+        fixed = self.system_tokens + estimate_tokens(state_content) + estimate_tokens(action_content)
+        summary_tokens = estimate_tokens(summary)
+        remaining = self.budget - fixed - summary_tokens
+
+        recent = []
+        story_tokens = 0
+        for narration in reversed(story_log):
+            cost = estimate_tokens(narration) + 1
+            if cost > remaining - story_tokens:
+                break
+            recent.append(narration)
+            story_tokens += cost
+        recent.reverse()
+
+        story_content = "STORY_SO_FAR:\n"
+        if summary:
+            story_content += f"(Earlier: {summary})\n"
+        story_content += "\n".join(recent)
+
+        messages = [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "system", "content": story_content},
+            {"role": "system", "content": state_content},
+            {"role": "user", "content": action_content}
+        ]
+        stats = {
+            "budget": self.budget,
+            "system_tokens": self.system_tokens,
+            "summary_tokens": summary_tokens,
+            "story_tokens": story_tokens,
+            "state_tokens": estimate_tokens(state_content),
+            "action_tokens": estimate_tokens(action_content),
+            "narrations_included": len(recent),
+            "narrations_dropped": len(story_log) - len(recent),
+        }
+        stats["total_tokens"] = (stats["system_tokens"] + stats["summary_tokens"] + stats["story_tokens"]
+                                 + stats["state_tokens"] + stats["action_tokens"])
+        record_prompt_stats(stats)
+        return messages, stats
+
+
+def needs_compaction(story_log: List[str], prompt_stats: Optional[Dict[str, int]] = None) -> bool:
+    if prompt_stats and prompt_stats.get("narrations_dropped"):
+        return True
+    return len(story_log) >= SUMMARY_KEEP_RECENT + SUMMARY_BATCH
+
+
+def compact_story(story: Dict[str, Any], summarized: List[str], new_summary: str):
+    """Fold summarized narrations out of story['story_log'] into story['story_summary']"""
+    story_log = story.setdefault('story_log', [])
+    for narration in summarized:
+        if story_log and story_log[0] == narration:
+            del story_log[0]
+    story['story_summary'] = new_summary
+
+
+class StorySummarizer:
+    """Background worker that refreshes rolling "story so far" summaries.
+
+    Jobs are keyed (one per session/game) so a slow summary never queues up
+    twice, and the request path never waits on the model: it just keeps using
+    the previous summary until the new one is applied.
+    """
+
+    def __init__(self, summarize: Callable[[str, List[str]], str], max_queue: int = 256):
+        self.summarize = summarize
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._work, name="story-summarizer", daemon=True)
+        self._thread.start()
+
+    def schedule(self, key: str, story_summary: str, story_log: List[str],
+                 apply: Callable[[List[str], str], None], keep_recent: int = SUMMARY_KEEP_RECENT) -> bool:
+        narrations = list(story_log[:max(0, len(story_log) - keep_recent)])
+        if not narrations:
+            return False
+        with self._lock:
+            if key in self._pending:
+                return False
+            try:
+                self._queue.put_nowait((key, story_summary, narrations, apply))
+            except queue.Full:
+                return False
+            self._pending.add(key)
+        return True
+
+    def summarize_now(self, story_summary: str, narrations: List[str]) -> str:
+        """The new summary, computed in the calling thread; falls back to a local one if the model fails"""
+        try:
+            new_summary = self.summarize(story_summary, narrations)
+        except Exception:
+            new_summary = None
+        if not new_summary:
+            new_summary = fallback_summary(story_summary, narrations)
+        return truncate_to_tokens(new_summary.strip(), SUMMARY_TOKEN_BUDGET)
+
+    def _work(self):
+        while True:
+            key, story_summary, narrations, apply = self._queue.get()
+            try:
+                apply(narrations, self.summarize_now(story_summary, narrations))
+            except Exception as e:
+                log.warning("Story summary for %s failed: %s", key, e)
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+
+_stats_lock = threading.Lock()
+_prompt_totals = {"turns": 0, "total_tokens": 0, "max_tokens": 0, "narrations_dropped": 0}
+_last_prompt_stats = {}
+
+
+def record_prompt_stats(stats: Dict[str, int]):
+    global _last_prompt_stats
+    with _stats_lock:
+        _prompt_totals["turns"] += 1
+        _prompt_totals["total_tokens"] += stats["total_tokens"]
+        _prompt_totals["max_tokens"] = max(_prompt_totals["max_tokens"], stats["total_tokens"])
+        _prompt_totals["narrations_dropped"] += stats["narrations_dropped"]
+        _last_prompt_stats = dict(stats)
+
+
+def prompt_stats_summary() -> Dict[str, Any]:
+    with _stats_lock:
+        turns = _prompt_totals["turns"]
+        return {
+            "turns": turns,
+            "avg_tokens": round(_prompt_totals["total_tokens"] / turns, 1) if turns else 0,
+            "max_tokens": _prompt_totals["max_tokens"],
+            "narrations_dropped": _prompt_totals["narrations_dropped"],
+            "last": dict(_last_prompt_stats),
+        }
@@ -0,0 +1,315 @@
+from typing import Any, Callable, Dict, List, Optional
+import glob
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+
+import log_pipeline
+from game_state import splice
+
+JOURNAL_DIR = os.getenv('JOURNAL_DIR', 'journal')
+JOURNAL_SNAPSHOT_EVERY = int(os.getenv('JOURNAL_SNAPSHOT_EVERY', 20))
+JOURNAL_FLUSH_INTERVAL = float(os.getenv('JOURNAL_FLUSH_INTERVAL', 0.25))
+JOURNAL_BATCH_SIZE = 256
+
+_ENTRY = 'entry'
+_SNAPSHOT = 'snapshot'
+_DELETE = 'delete'
+_FLUSH = 'flush'
+
+log = log_pipeline.get_logger('session_journal')
+
+
+def replay(data: Dict[str, Any], entry: Dict[str, Any], max_story_log: Optional[int] = None):
+    """Apply one journal entry to session data"""
+    if entry.get('state') is not None:
+        data['state'] = entry['state']
+    if 'state_version' in entry:
+        data['state_version'] = entry['state_version']
+    if entry.get('narration'):
+        story_log = data.setdefault('story_log', [])
+        story_log.append(entry['narration'])
+        if max_story_log is not None and len(story_log) > max_story_log:
+            del story_log[:-max_story_log]
+
+
+class SessionJournal:
+    """Append-only per-session turn log with periodic snapshots.
+
+    record() only serializes and enqueues; a background writer groups pending
+    entries into one append and one fsync per session per batch. Every
+    snapshot_every turns a snapshot of the whole session replaces the log,
+    which is then truncated, so load() reads the snapshot and replays at most
+    snapshot_every entries and no journal grows past that.
+
+    Saves are separate: save() copies a session under a new random id into
+    saves/, where load() (which rebuilds live sessions) never looks.
+    """
+
+    def __init__(self, directory: str = JOURNAL_DIR, snapshot_every: int = JOURNAL_SNAPSHOT_EVERY,
+                 flush_interval: float = JOURNAL_FLUSH_INTERVAL):
+        self.directory = os.path.abspath(directory)
+        self.snapshot_every = snapshot_every
+        self.flush_interval = flush_interval
+        self.saves_directory = os.path.join(self.directory, 'saves')
+        os.makedirs(self.saves_directory, exist_ok=True)
+        self._queue = queue.Queue()
+        self._since_snapshot = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._written = threading.Condition(self._lock)
+        self._stats = {"entries": 0, "snapshots": 0, "batches": 0, "fsyncs": 0, "bytes": 0, "errors": 0}
+        self._writer = threading.Thread(target=self._write_loop, name="session-journal", daemon=True)
+        self._writer.start()
+
+    def _journal_path(self, sid: str) -> str:
+        return os.path.join(self.directory, f"{sid}.jsonl")
+
+    def _snapshot_path(self, sid: str) -> str:
+        return os.path.join(self.directory, f"{sid}.snapshot.json")
+
+    def _save_path(self, save_id: str) -> str:
+        return os.path.join(self.saves_directory, f"{save_id}.json")
+
+    def _enqueue(self, kind: str, sid: str, payload: Any):
+        with self._lock:
+            self._pending[sid] = self._pending.get(sid, 0) + 1
+        self._queue.put((kind, sid, payload))
+
+    def record(self, sid: str, entry: Dict[str, Any], session: Optional[Dict[str, Any]] = None,
+               state_json: Optional[bytes] = None):
+        """Queue a turn; session is the data after the turn and is snapshotted when one is due.
+
+        state_json is the turn's state already encoded (GameState.to_json()),
+        written as the entry's "state" without serializing it again.
+        """
+        entry = dict(entry, ts=round(time.time(), 3))
+        if state_json is None:
+            line = json.dumps(entry, separators=(',', ':')).encode('utf-8') + b"\n"
+        else:
+            line = splice(entry, 'state', state_json) + b"\n"
+        self._enqueue(_ENTRY, sid, line)
+        with self._lock:
+            count = self._since_snapshot.get(sid, 0) + 1
+            due = session is not None and count >= self.snapshot_every
+            self._since_snapshot[sid] = 0 if due else count
+        if due:
+            self.snapshot(sid, session)
+
+    def snapshot(self, sid: str, session: Dict[str, Any]):
+        blob = json.dumps(session, separators=(',', ':')).encode('utf-8')
+        with self._lock:
+            self._since_snapshot[sid] = 0
+        self._enqueue(_SNAPSHOT, sid, blob)
+
+    def delete(self, sid: str):
+        with self._lock:
+            self._since_snapshot.pop(sid, None)
+        self._enqueue(_DELETE, sid, None)
+
+    def flush(self, sid: Optional[str] = None, timeout: float = 5.0) -> bool:
+        """Wait until everything queued so far (for sid only, if given) is on disk"""
+        if sid is not None:
+            with self._written:
+                return self._written.wait_for(lambda: not self._pending.get(sid), timeout)
+        done = threading.Event()
+        self._queue.put((_FLUSH, None, done))
+        return done.wait(timeout)
+
+    def save(self, session: Dict[str, Any]) -> str:
+        """Write a copy of session under a new unguessable id and return it"""
+        save_id = f"save-{secrets.token_urlsafe(18)}"
+        blob = json.dumps(session, separators=(',', ':')).encode('utf-8')
+        _write_atomic(self._save_path(save_id), blob)
+        return save_id
+
+    def load_save(self, save_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._save_path(save_id), 'rb') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def exists(self, sid: str) -> bool:
+        return os.path.exists(self._journal_path(sid)) or os.path.exists(self._snapshot_path(sid))
+
+    def load(self, sid: str, max_story_log: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """Rebuild session data from the latest snapshot plus the entries after it"""
+        if not self.exists(sid):
+            return None
+        self.flush(sid)
+        data, offset = None, 0
+        try:
+            with open(self._snapshot_path(sid), 'rb') as f:
+                snapshot = json.load(f)
+            data, offset = snapshot['data'], snapshot['offset']
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        entries = self.entries(sid, offset)
+        if data is None and not entries:
+            return None
+        data = data if data is not None else {}
+        for entry in entries:
+            replay(data, entry, max_story_log)
+        return data
+
+    def entries(self, sid: str, offset: int = 0) -> List[Dict[str, Any]]:
+        """Journal entries from a byte offset on; a torn final line is skipped"""
+        try:
+            with open(self._journal_path(sid), 'rb') as f:
+                f.seek(offset)
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return []
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+        return entries
+
+    def sweep(self, max_age: float, keep: Optional[Callable[[str], bool]] = None) -> int:
+        """Delete the journals and snapshots of sessions not written for max_age seconds.
+
+        keep(sid) spares sessions still live elsewhere; leftover temp files
+        that old are removed too. Returns how many sessions were dropped.
+        """
+        cutoff = time.time() - max_age
+        written = {}
+        for entry in os.scandir(self.directory):
+            try:
+                if not entry.is_file():
+                    continue
+                mtime = entry.stat().st_mtime
+                if entry.name.endswith('.tmp'):
+                    if mtime < cutoff:
+                        os.remove(entry.path)
+                    continue
+            except FileNotFoundError:
+                continue
+            for suffix in ('.jsonl', '.snapshot.json'):
+                if entry.name.endswith(suffix):
+                    sid = entry.name[:-len(suffix)]
+                    written[sid] = max(written.get(sid, 0.0), mtime)
+                    break
+        swept = 0
+        for sid, mtime in written.items():
+            if mtime < cutoff and not (keep is not None and keep(sid)):
+                self.delete(sid)
+                swept += 1
+        if swept:
+            log.info("Swept the journals of %d expired sessions", swept)
+        return swept
+
+    def latest(self, prefix: str = '') -> Optional[str]:
+        """Id of the most recently written journal whose id starts with prefix"""
+        paths = glob.glob(os.path.join(self.directory, f"{glob.escape(prefix)}*.jsonl"))
+        if not paths:
+            return None
+        return os.path.basename(max(paths, key=os.path.getmtime))[:-len('.jsonl')]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats, pending=self._queue.qsize())
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < JOURNAL_BATCH_SIZE and batch[-1][0] != _FLUSH:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except OSError as e:
+                log.error("Session journal write failed: %s", e)
+                with self._lock:
+                    self._stats["errors"] += 1
+            finally:
+                with self._written:
+                    for kind, sid, _ in batch:
+                        if kind != _FLUSH:
+                            left = self._pending.get(sid, 1) - 1
+                            if left > 0:
+                                self._pending[sid] = left
+                            else:
+                                self._pending.pop(sid, None)
+                    self._written.notify_all()
+                for kind, _, payload in batch:
+                    if kind == _FLUSH:
+                        payload.set()
+
+    def _write_batch(self, batch):
+        pending = {}
+        for kind, sid, payload in batch:
+            if kind == _ENTRY:
+                pending.setdefault(sid, []).append(payload)
+            elif kind == _SNAPSHOT:
+                self._append(sid, pending.pop(sid, []))
+                self._write_snapshot(sid, payload)
+            elif kind == _DELETE:
+                pending.pop(sid, None)
+                for path in (self._journal_path(sid), self._snapshot_path(sid)):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+        for sid, lines in pending.items():
+            self._append(sid, lines)
+        with self._lock:
+            self._stats["batches"] += 1
+
+    def _append(self, sid: str, lines: List[bytes]):
+        if not lines:
+            return
+        blob = b"".join(lines)
+        with open(self._journal_path(sid), 'ab') as f:
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        with self._lock:
+            self._stats["entries"] += len(lines)
+            self._stats["fsyncs"] += 1
+            self._stats["bytes"] += len(blob)
+
+    def _write_snapshot(self, sid: str, blob: bytes):
+        """Replace the log with a snapshot of the session, truncating the log.
+
+        The snapshot goes into place first, recording the log's length as its
+        offset, so a crash before the truncation just replays nothing past it;
+        once the log is truncated the snapshot is rewritten with offset 0 for
+        the entries appended next. A crash at any point loses no turn and
+        replays none twice.
+        """
+        path, journal_path = self._snapshot_path(sid), self._journal_path(sid)
+        try:
+            length = os.path.getsize(journal_path)
+        except FileNotFoundError:
+            length = 0
+        _write_atomic(path, b'{"offset":%d,"data":' % length + blob + b'}')
+        fsyncs = 1
+        if length:
+            with open(journal_path, 'r+b') as f:
+                f.truncate(0)
+                os.fsync(f.fileno())
+            _write_atomic(path, b'{"offset":0,"data":' + blob + b'}')
+            fsyncs += 2
+        with self._lock:
+            self._stats["snapshots"] += 1
+            self._stats["fsyncs"] += fsyncs
+
+
+def _write_atomic(path: str, blob: bytes):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,307 @@
+from typing import Any, Callable, Dict, List, Optional
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import os
+import secrets
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SESSION_COOKIE = 'vardovia_session'
+SESSION_HEADER = 'X-Session-Id'
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'memory')
+SESSION_DIR = os.getenv('SESSION_DIR', 'sessions')
+SESSION_TTL = int(os.getenv('SESSION_TTL', 6 * 60 * 60))
+MAX_SESSION_BYTES = int(os.getenv('MAX_SESSION_BYTES', 256 * 1024))
+MAX_TOTAL_SESSION_BYTES = int(os.getenv('MAX_TOTAL_SESSION_BYTES', 128 * 1024 * 1024))
+SWEEP_INTERVAL = 60
+
+
+class SessionTooLarge(ValueError):
+    pass
+
+
+def is_valid_session_id(sid: Optional[str]) -> bool:
+    return bool(sid) and len(sid) <= 64 and all(c.isalnum() or c in '-_' for c in sid)
+
+
+def _notify(on_evict: Optional[Callable[[str], None]], evicted: List[str]):
+    if on_evict is not None:
+        for sid in evicted:
+            on_evict(sid)
+
+
+class MemoryBackend:
+    """In-process LRU backend with a global byte cap and idle-TTL eviction.
+
+    on_evict(sid), when set, is called (outside the lock) for every session
+    dropped by TTL or LRU eviction, but not for explicit deletes.
+    """
+
+    def __init__(self, max_total_bytes: int = MAX_TOTAL_SESSION_BYTES, ttl: int = SESSION_TTL):
+        self.max_total_bytes = max_total_bytes
+        self.ttl = ttl
+        self.on_evict = None
+        self._items = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def load(self, sid: str) -> Optional[bytes]:
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(sid)
+            if item is None:
+                return None
+            blob, last_access = item
+            if now - last_access <= self.ttl:
+                self._items[sid] = (blob, now)
+                self._items.move_to_end(sid)
+                return blob
+            self._drop(sid)
+        _notify(self.on_evict, [sid])
+        return None
+
+    def save(self, sid: str, blob: bytes):
+        evicted = []
+        with self._lock:
+            if sid in self._items:
+                self._drop(sid)
+            self._items[sid] = (blob, time.monotonic())
+            self._total += len(blob)
+            while self._total > self.max_total_bytes and len(self._items) > 1:
+                evicted.append(next(iter(self._items)))
+                self._drop(evicted[-1])
+        _notify(self.on_evict, evicted)
+
+    def delete(self, sid: str):
+        with self._lock:
+            self._drop(sid)
+
+    def __contains__(self, sid: str) -> bool:
+        with self._lock:
+            return sid in self._items
+
+    def evict_expired(self) -> int:
+        cutoff = time.monotonic() - self.ttl
+        evicted = []
+        with self._lock:
+            while self._items:
+                sid, (_, last_access) = next(iter(self._items.items()))
+                if last_access > cutoff:
+                    break
+                self._drop(sid)
+                evicted.append(sid)
+        _notify(self.on_evict, evicted)
+        return len(evicted)
+
+    @contextmanager
+    def lock(self, sid: str):
+        yield
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"sessions": len(self._items), "bytes": self._total}
+
+    def _drop(self, sid: str):
+        item = self._items.pop(sid, None)
+        if item is not None:
+            self._total -= len(item[0])
+
+
+class FileBackend:
+    """Out-of-process backend: one JSON file per session in a shared directory.
+
+    Every worker process pointing at the same directory sees the same sessions.
+    The file mtime doubles as the last-access time for TTL and LRU eviction;
+    on_evict works as in MemoryBackend.
+    """
+
+    def __init__(self, directory: str = SESSION_DIR, max_total_bytes: int = MAX_TOTAL_SESSION_BYTES,
+                 ttl: int = SESSION_TTL):
+        self.directory = os.path.abspath(directory)
+        self.max_total_bytes = max_total_bytes
+        self.ttl = ttl
+        self.on_evict = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, sid: str) -> str:
+        return os.path.join(self.directory, f"{sid}.json")
+
+    def load(self, sid: str) -> Optional[bytes]:
+        path = self._path(sid)
+        try:
+            if time.time() - os.stat(path).st_mtime > self.ttl:
+                self.delete(sid)
+                _notify(self.on_evict, [sid])
+                return None
+            with open(path, 'rb') as f:
+                blob = f.read()
+            os.utime(path)
+            return blob
+        except FileNotFoundError:
+            return None
+
+    def save(self, sid: str, blob: bytes):
+        path = self._path(sid)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_path, path)
+
+    def delete(self, sid: str):
+        for path in (self._path(sid), self._path(sid) + '.lock'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def __contains__(self, sid: str) -> bool:
+        return os.path.exists(self._path(sid))
+
+    def evict_expired(self) -> int:
+        cutoff = time.time() - self.ttl
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.name[:-len('.json')]))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for mtime, size, sid in entries:
+            if mtime > cutoff and total <= self.max_total_bytes:
+                break
+            self.delete(sid)
+            total -= size
+            evicted.append(sid)
+        _notify(self.on_evict, evicted)
+        return len(evicted)
+
+    @contextmanager
+    def lock(self, sid: str):
+        if fcntl is None:
+            yield
+            return
+        with open(self._path(sid) + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def stats(self) -> Dict[str, int]:
+        sessions = total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                sessions += 1
+                total += entry.stat().st_size
+        return {"sessions": sessions, "bytes": total}
+
+
+class SessionStore:
+    """Session-keyed game state with per-session locking and size caps.
+
+    restore(sid) is consulted for sessions the backend doesn't have, e.g. to
+    bring games back from the journal after a restart; on_evict(sid) is called
+    when the backend expires or evicts one, e.g. to delete that journal, and
+    on_sweep() with every periodic sweep, for data of sessions the backend no
+    longer knows about.
+    """
+
+    def __init__(self, backend, max_session_bytes: int = MAX_SESSION_BYTES, factory=None, restore=None,
+                 on_evict=None, on_sweep=None):
+        self.backend = backend
+        self.max_session_bytes = max_session_bytes
+        self.factory = factory or dict
+        self.restore = restore
+        self.on_evict = on_evict
+        self.on_sweep = on_sweep
+        backend.on_evict = self._evicted
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    @staticmethod
+    def new_session_id() -> str:
+        return secrets.token_urlsafe(24)
+
+    def _session_lock(self, sid: str) -> threading.Lock:
+        with self._locks_guard:
+            lock = self._locks.get(sid)
+            if lock is None:
+                lock = self._locks[sid] = threading.Lock()
+            return lock
+
+    def load(self, sid: str) -> Dict[str, Any]:
+        blob = self.backend.load(sid)
+        if blob is None:
+            restored = self.restore(sid) if self.restore else None
+            return restored if restored is not None else self.factory()
+        return json.loads(blob)
+
+    def save(self, sid: str, data: Dict[str, Any]):
+        blob = self._encode(data)
+        story_log = data.get('story_log')
+        while len(blob) > self.max_session_bytes and story_log:
+            del story_log[0]
+            blob = self._encode(data)
+        if len(blob) > self.max_session_bytes:
+            raise SessionTooLarge(f"session {sid} is {len(blob)} bytes, limit {self.max_session_bytes}")
+        self.backend.save(sid, blob)
+
+    def delete(self, sid: str):
+        self.backend.delete(sid)
+        with self._locks_guard:
+            self._locks.pop(sid, None)
+
+    def _evicted(self, sid: str):
+        if self.on_evict is not None:
+            self.on_evict(sid)
+
+    @contextmanager
+    def session(self, sid: str):
+        """Lock the session, yield its data dict and persist it on clean exit"""
+        self._maybe_sweep()
+        with self._session_lock(sid), self.backend.lock(sid):
+            data = self.load(sid)
+            yield data
+            self.save(sid, data)
+
+    def _maybe_sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        self.backend.evict_expired()
+        if self.on_sweep is not None:
+            self.on_sweep()
+        with self._locks_guard:
+            for sid, lock in list(self._locks.items()):
+                if not lock.locked() and sid not in self.backend:
+                    del self._locks[sid]
+
+    def stats(self) -> Dict[str, int]:
+        return self.backend.stats()
+
+    @staticmethod
+    def _encode(data: Dict[str, Any]) -> bytes:
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def create_store(factory=None, restore=None, on_evict=None, on_sweep=None) -> SessionStore:
+    if SESSION_BACKEND == 'file':
+        backend = FileBackend()
+    elif SESSION_BACKEND == 'memory':
+        backend = MemoryBackend()
+    else:
+        raise ValueError(f"unknown SESSION_BACKEND: {SESSION_BACKEND}")
+    return SessionStore(backend, factory=factory, restore=restore, on_evict=on_evict, on_sweep=on_sweep)
@@ -0,0 +1,111 @@
+from typing import Any, Dict, List, Optional
+import copy
+import json
+
+DELTA_PREFIX = "GAME_STATE_DELTA:"
+LIST_OPS = ("add", "remove")
+
+
+def _name(item: Any) -> Optional[str]:
+    return item.get("name") if isinstance(item, dict) else None
+
+
+def _matches(item: Any, target: Any) -> bool:
+    if item == target:
+        return True
+    name = _name(item)
+    if name is None:
+        return False
+    return target == name or _name(target) == name
+
+
+def _is_list_ops(value: Any) -> bool:
+    return isinstance(value, dict) and bool(value) and set(value) <= set(LIST_OPS)
+
+
+def apply_list_ops(items: List[Any], ops: Dict[str, Any]) -> List[Any]:
+    """Apply {"add": [...], "remove": [...]} to a list.
+
+    Removals match by equality, or by "name" for NPC-style objects. Added
+    objects whose name is already present replace that entry in place.
+    """
+    result = [item for item in items
+              if not any(_matches(item, target) for target in ops.get("remove") or [])]
+    for item in ops.get("add") or []:
+        name = _name(item)
+        for i, existing in enumerate(result):
+            if name is not None and _name(existing) == name:
+                result[i] = copy.deepcopy(item)
+                break
+        else:
+            if item not in result:
+                result.append(copy.deepcopy(item))
+    return result
+
+
+def apply_delta(state: Dict[str, Any], delta: Dict[str, Any]) -> Dict[str, Any]:
+    """Merge a delta into a copy of state.
+
+    Objects merge key by key and null deletes a key (RFC 7386 merge patch);
+    lists are either replaced wholesale or changed with list ops.
+    """
+    merged = copy.deepcopy(state)
+    for key, value in delta.items():
+        current = merged.get(key)
+        if value is None:
+            merged.pop(key, None)
+        elif isinstance(current, list) and _is_list_ops(value):
+            merged[key] = apply_list_ops(current, value)
+        elif isinstance(current, dict) and isinstance(value, dict):
+            merged[key] = apply_delta(current, value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+def _size(value: Any) -> int:
+    return len(json.dumps(value, separators=(',', ':')))
+
+
+def diff_list(old: List[Any], new: List[Any]) -> Optional[Dict[str, Any]]:
+    """List ops turning old into new, or None if they can't reproduce new exactly"""
+    new_names = {_name(item) for item in new} - {None}
+    ops = {}
+    remove = [item for item in old if item not in new and _name(item) not in new_names]
+    add = [item for item in new if item not in old]
+    if remove:
+        ops["remove"] = [_name(item) or item for item in remove]
+    if add:
+        ops["add"] = add
+    if not ops or apply_list_ops(old, ops) != new:
+        return None
+    return ops
+
+
+def diff_states(old: Dict[str, Any], new: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """The smallest delta that apply_delta turns old into new with.
+
+    None when new sets a merged key to null: in a delta null means "delete",
+    so the caller has to send the full state instead.
+    """
+    delta = {}
+    for key, value in new.items():
+        if key in old and old[key] == value:
+            continue
+        previous = old.get(key)
+        if value is None:
+            return None
+        if isinstance(previous, dict) and isinstance(value, dict):
+            nested = diff_states(previous, value)
+            if nested is None:
+                return None
+            delta[key] = nested
+        elif isinstance(previous, list) and isinstance(value, list):
+            ops = diff_list(previous, value)
+            delta[key] = ops if ops is not None and _size(ops) < _size(value) else value
+        else:
+            delta[key] = value
+    for key in old:
+        if key not in new:
+            delta[key] = None
+    return delta
@@ -0,0 +1,297 @@
+from typing import Any, Dict, List, Optional, Tuple
+import ast
+import json
+import re
+
+import metrics
+from state_delta import DELTA_PREFIX, apply_delta
+
+STATE_PREFIX = "GAME_STATE_JSON:"
+ERROR_PREFIX = "ERROR_JSON:"
+HEALTH_RANGE = (0, 100)
+DANGER_RANGE = (0, 10)
+DEFAULT_TIME = "21:40"
+
+REQUIRED_DEFAULTS = {
+    "player_name": "Arsen Dvorak",
+    "location": "Unknown",
+    "inventory": [],
+    "health": 90,
+    "danger": 1,
+    "time": DEFAULT_TIME,
+    "flags": {},
+}
+LIST_KEYS = ("inventory", "npcs", "objectives")
+
+STATE_TURNS = metrics.Counter('vardovia_state_turns_total',
+                              'Model states by outcome: clean, repaired, reprompted or failed', ('outcome',))
+STATE_REPAIRS = metrics.Counter('vardovia_state_repairs_total', 'Individual repairs applied to model output', ('kind',))
+
+
+class StateRepairError(ValueError):
+    pass
+
+
+def record_outcome(outcome: str):
+    STATE_TURNS.inc(outcome=outcome)
+
+
+def scan_object(text: str, start: int) -> Tuple[int, List[str], Optional[str]]:
+    """Find the end of the JSON-ish object starting at text[start].
+
+    Returns (end, open_brackets, open_quote): end is the index just past the
+    matching close brace, or -1 if the text is truncated, in which case the
+    still-open brackets and string quote are returned so they can be closed.
+    """
+    stack = []
+    quote = None
+    escaped = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if quote:
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == quote:
+                quote = None
+            continue
+        if c in '"\'':
+            quote = c
+        elif c in '{[':
+            stack.append(c)
+        elif c in '}]':
+            if stack:
+                stack.pop()
+            if not stack:
+                return i + 1, [], None
+    return -1, stack, quote
+
+
+def _close_truncated(fragment: str, stack: List[str], quote: Optional[str]) -> str:
+    if quote:
+        fragment += quote
+    fragment = re.sub(r',?\s*("[^"]*"|\'[^\']*\')\s*:\s*$', '', fragment)
+    fragment = re.sub(r'[,:]\s*$', '', fragment)
+    for opener in reversed(stack):
+        fragment += '}' if opener == '{' else ']'
+    return fragment
+
+
+def _loads_lenient(candidate: str, repairs: List[str]) -> Any:
+    try:
+        return json.loads(candidate)
+    except ValueError:
+        pass
+    without_commas = re.sub(r',\s*([}\]])', r'\1', candidate)
+    if without_commas != candidate:
+        try:
+            value = json.loads(without_commas)
+            repairs.append("trailing_comma")
+            return value
+        except ValueError:
+            pass
+    literal = re.sub(r'\btrue\b', 'True', without_commas)
+    literal = re.sub(r'\bfalse\b', 'False', literal)
+    literal = re.sub(r'\bnull\b', 'None', literal)
+    try:
+        value = ast.literal_eval(literal)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        raise StateRepairError("state JSON could not be repaired")
+    repairs.append("single_quotes")
+    return value
+
+
+def extract_state(text: str, repairs: List[str]) -> Tuple[Dict[str, Any], str]:
+    """Pull the first object out of text, tolerating prose after it and truncation"""
+    start = text.find('{')
+    if start == -1:
+        raise StateRepairError("no JSON object found")
+    end, stack, quote = scan_object(text, start)
+    if end == -1:
+        candidate = _close_truncated(text[start:], stack, quote)
+        rest = ""
+        repairs.append("truncated")
+    else:
+        candidate = text[start:end]
+        rest = text[end:]
+    state = _loads_lenient(candidate, repairs)
+    if not isinstance(state, dict):
+        raise StateRepairError("state is not an object")
+    return state, rest
+
+
+def parse_response(raw: str, previous: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, Any], str, List[str]]:
+    """Lenient counterpart of parse_model_response: returns (state, narration, repairs).
+
+    A GAME_STATE_DELTA reply is merged into previous to give the full state.
+    """
+    repairs = []
+    text = raw.strip()
+    if not text:
+        raise StateRepairError("empty response")
+    if text.startswith(ERROR_PREFIX):
+        raise StateRepairError(f"model-error: {text.splitlines()[0]}")
+    prefix, prefix_at = STATE_PREFIX, text.find(STATE_PREFIX)
+    delta_at = text.find(DELTA_PREFIX)
+    if delta_at != -1 and (prefix_at == -1 or delta_at < prefix_at):
+        prefix, prefix_at = DELTA_PREFIX, delta_at
+    if prefix_at == -1:
+        repairs.append("missing_prefix")
+        body = text
+    else:
+        if text[:prefix_at].strip():
+            repairs.append("leading_text")
+        body = text[prefix_at + len(prefix):]
+    state, narration = _parse_body(body, repairs)
+    if prefix == DELTA_PREFIX:
+        state = apply_delta(previous or {}, _cleared_lists(state))
+    return state, narration, repairs
+
+
+def _cleared_lists(delta: Dict[str, Any]) -> Dict[str, Any]:
+    """delta with an explicit null for a list key read as clearing it, since a missing key is refilled from previous"""
+    return {key: [] if value is None and key in LIST_KEYS else value for key, value in delta.items()}
+
+
+def _parse_body(body: str, repairs: List[str]) -> Tuple[Dict[str, Any], str]:
+    first_line = body.lstrip().split('\n', 1)[0]
+    if first_line.startswith('{') and first_line.rstrip().endswith('}'):
+        try:
+            state = json.loads(first_line)
+            narration = body.lstrip()[len(first_line):]
+            if isinstance(state, dict):
+                return state, _clean_narration(narration)
+        except ValueError:
+            pass
+    state, rest = extract_state(body, repairs)
+    if rest.split('\n', 1)[0].strip():
+        repairs.append("trailing_prose")
+    return state, _clean_narration(rest)
+
+
+def _clean_narration(text: str) -> str:
+    text = text.strip()
+    if text.startswith('```'):
+        text = text[3:].strip()
+    return text
+
+
+def normalize_time(value: Any) -> Optional[str]:
+    """Coerce common time spellings to 24-hour HH:MM, or None if hopeless"""
+    if not isinstance(value, str):
+        return None
+    match = re.match(r'^\s*(\d{1,2})\s*[:.h]\s*(\d{1,2})\s*(am|pm|a\.m\.|p\.m\.)?\s*$', value.lower())
+    if not match:
+        match = re.match(r'^\s*(\d{1,2})()\s*(am|pm|a\.m\.|p\.m\.)\s*$', value.lower())
+        if not match:
+            return None
+    hours = int(match.group(1))
+    minutes = int(match.group(2) or 0)
+    suffix = (match.group(3) or '').replace('.', '')
+    if suffix == 'pm' and hours < 12:
+        hours += 12
+    elif suffix == 'am' and hours == 12:
+        hours = 0
+    if hours > 23 or minutes > 59:
+        return None
+    return f"{hours:02d}:{minutes:02d}"
+
+
+def _number(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        match = re.search(r'-?\d+(\.\d+)?', value)
+        if match:
+            number = float(match.group(0))
+            return int(number) if number.is_integer() else number
+    return None
+
+
+def _as_list(value: Any) -> Optional[list]:
+    if isinstance(value, list):
+        return value
+    if isinstance(value, tuple):
+        return list(value)
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(',') if item.strip()]
+    if isinstance(value, dict):
+        if value and all(isinstance(item, dict) for item in value.values()):
+            return [dict(item, name=item.get('name', key)) for key, item in value.items()]
+        return [value] if value else []
+    return None
+
+
+def repair_state(state: Dict[str, Any], previous: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, Any], List[str]]:
+    """Fill, coerce and clamp a model state so it passes minimal_sanity_check"""
+    previous = previous or {}
+    repaired = dict(state)
+    repairs = []
+
+    def fallback(key):
+        value = previous.get(key, REQUIRED_DEFAULTS.get(key))
+        return json.loads(json.dumps(value)) if isinstance(value, (list, dict)) else value
+
+    for key in REQUIRED_DEFAULTS:
+        if repaired.get(key) is None:
+            repaired[key] = fallback(key)
+            repairs.append(f"missing_{key}")
+    for key in ("npcs", "objectives"):
+        if key not in repaired and key in previous:
+            repaired[key] = fallback(key)
+            repairs.append(f"missing_{key}")
+
+    for key in ("player_name", "location"):
+        if not isinstance(repaired[key], str) or not repaired[key].strip():
+            repaired[key] = fallback(key)
+            repairs.append(f"invalid_{key}")
+
+    for key in LIST_KEYS:
+        if key in repaired and not isinstance(repaired[key], list):
+            coerced = _as_list(repaired[key])
+            repaired[key] = coerced if coerced is not None else (fallback(key) or [])
+            repairs.append(f"coerced_{key}")
+
+    if not isinstance(repaired["flags"], dict):
+        repaired["flags"] = fallback("flags") if isinstance(previous.get("flags"), dict) else {}
+        repairs.append("coerced_flags")
+
+    for key, (low, high) in (("health", HEALTH_RANGE), ("danger", DANGER_RANGE)):
+        value = repaired[key]
+        number = _number(value)
+        if number is None:
+            number = _number(fallback(key))
+            repairs.append(f"invalid_{key}")
+        elif number is not value:
+            repairs.append(f"coerced_{key}")
+        clamped = min(max(number, low), high)
+        if clamped != number:
+            repairs.append(f"clamped_{key}")
+        repaired[key] = clamped
+
+    normalized = normalize_time(repaired["time"])
+    if normalized is None:
+        normalized = normalize_time(previous.get("time")) or DEFAULT_TIME
+        repairs.append("invalid_time")
+    elif normalized != repaired["time"]:
+        repairs.append("normalized_time")
+    repaired["time"] = normalized
+    return repaired, repairs
+
+
+def record_repairs(repairs: List[str]):
+    for kind in repairs:
+        STATE_REPAIRS.inc(kind=kind)
+    record_outcome("repaired" if repairs else "clean")
+
+
+def resolve_turn(raw: str, previous: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, Any], str, List[str]]:
+    """Parse and repair one model reply; raises StateRepairError only when a re-prompt is needed"""
+    state, narration, repairs = parse_response(raw, previous)
+    state, state_repairs = repair_state(state, previous)
+    repairs.extend(state_repairs)
+    record_repairs(repairs)
+    return state, narration, repairs
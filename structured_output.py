@@ -0,0 +1,90 @@
+from typing import Any, Dict, Optional, Tuple
+import json
+import os
+
+import metrics
+
+RESPONSE_MODE = os.getenv('RESPONSE_MODE', 'text').lower()
+STRUCTURED_MODES = ('json_schema', 'json_object')
+
+TURN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "state": {
+            "type": "object",
+            "properties": {
+                "player_name": {"type": "string"},
+                "location": {"type": "string"},
+                "inventory": {"type": "array", "items": {"type": "string"}},
+                "health": {"type": "integer", "minimum": 0, "maximum": 100},
+                "danger": {"type": "integer", "minimum": 1, "maximum": 10},
+                "time": {"type": "string", "pattern": "^[0-2][0-9]:[0-5][0-9]$"},
+                "flags": {"type": "object"},
+                "npcs": {"type": "array"},
+                "objectives": {"type": "array"},
+            },
+            "required": ["player_name", "location", "inventory", "health", "danger", "time", "flags"],
+        },
+        "narration": {"type": "string"},
+        "image_prompt": {"type": ["string", "null"]},
+    },
+    "required": ["state", "narration", "image_prompt"],
+}
+
+MODEL_REPLIES = metrics.Counter('vardovia_model_replies_total', 'Model turn replies by response mode and parse outcome',
+                                ('mode', 'outcome'))
+
+
+class StructuredReplyError(ValueError):
+    pass
+
+
+def is_structured(mode: str = RESPONSE_MODE) -> bool:
+    return mode in STRUCTURED_MODES
+
+
+def response_format(mode: str = RESPONSE_MODE) -> Optional[Dict[str, Any]]:
+    """The chat API's response_format for mode; None for the text protocol"""
+    if mode == 'json_schema':
+        return {"type": "json_schema", "json_schema": {"name": "game_turn", "schema": TURN_SCHEMA}}
+    if mode == 'json_object':
+        return {"type": "json_object"}
+    if mode != 'text':
+        raise ValueError(f"unknown RESPONSE_MODE: {mode}")
+    return None
+
+
+def parse_reply(raw: str) -> Tuple[Dict[str, Any], str, Optional[str]]:
+    """(state, narration, image_prompt) from one structured reply, in a single json.loads"""
+    try:
+        reply = json.loads(raw)
+    except ValueError as e:
+        raise StructuredReplyError(f"reply is not JSON: {e}") from None
+    if not isinstance(reply, dict):
+        raise StructuredReplyError("reply is not an object")
+    state, narration, image_prompt = reply.get('state'), reply.get('narration'), reply.get('image_prompt')
+    if not isinstance(state, dict):
+        raise StructuredReplyError("state is missing or not an object")
+    if not isinstance(narration, str):
+        raise StructuredReplyError("narration is missing or not a string")
+    if image_prompt is not None and not isinstance(image_prompt, str):
+        raise StructuredReplyError("image_prompt is not a string")
+    return state, narration.strip(), (image_prompt or "").strip() or None
+
+
+def record(mode: str, outcome: str):
+    """outcome: parsed (first try), fallback (structured parse failed, text protocol parser succeeded) or failed"""
+    MODEL_REPLIES.inc(mode=mode, outcome=outcome)
+
+
+def stats() -> Dict[str, Any]:
+    modes = {}
+    for mode in ('text',) + STRUCTURED_MODES:
+        counts = {outcome: MODEL_REPLIES.value(mode=mode, outcome=outcome)
+                  for outcome in ('parsed', 'fallback', 'failed')}
+        total = sum(counts.values())
+        if not total and mode != RESPONSE_MODE:
+            continue
+        modes[mode] = dict(counts, replies=total,
+                           parse_failure_rate=round((counts['fallback'] + counts['failed']) / total, 4) if total else 0.0)
+    return {"mode": RESPONSE_MODE, "modes": modes}
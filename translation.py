@@ -0,0 +1,216 @@
+from typing import Any, Dict, List, Optional, Tuple
+import concurrent.futures
+import contextvars
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import requests
+
+import log_pipeline
+import metrics
+import upstream
+from upstream import CircuitBreaker, CircuitOpen
+
+TRANSLATE_BACKEND = os.getenv('TRANSLATE_BACKEND', 'google')
+TRANSLATE_URL = os.getenv('TRANSLATE_URL', 'https://translate.googleapis.com/translate_a/single')
+TRANSLATE_TIMEOUT = float(os.getenv('TRANSLATE_TIMEOUT', 10))
+TRANSLATE_CONCURRENCY = int(os.getenv('TRANSLATE_CONCURRENCY', 8))
+TRANSLATION_CACHE_PATH = os.getenv('TRANSLATION_CACHE_PATH', 'translations.sqlite3')
+TRANSLATION_CACHE_MAX_ROWS = int(os.getenv('TRANSLATION_CACHE_MAX_ROWS', 100000))
+TRANSLATION_CACHE_MAX_AGE_DAYS = float(os.getenv('TRANSLATION_CACHE_MAX_AGE_DAYS', 30))
+TRANSLATE_MAX_BATCH = 200
+TRANSLATE_MAX_CHARS = 5000
+
+TRANSLATIONS = metrics.Counter('vardovia_translations_total', 'Strings translated by where the answer came from',
+                               ('outcome',))
+
+LANGUAGE_CODE = re.compile(r"[a-z]{2,3}(-[A-Za-z]{2,4})?")
+
+log = log_pipeline.get_logger('translation')
+
+
+def is_valid_language(code: Optional[str], allow_auto: bool = False) -> bool:
+    return bool(code) and (bool(LANGUAGE_CODE.fullmatch(code)) or (allow_auto and code == 'auto'))
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class GoogleTranslator:
+    """The public translate.googleapis.com endpoint the page used to call from the browser.
+
+    It takes one string per request, so a batch is fanned out over a small
+    pool of pooled connections; one breaker stops a dead endpoint from holding
+    every batch up to the timeout. Only failures that say the endpoint is
+    unhealthy count against it, not a rejected request or an odd reply.
+    """
+
+    name = 'google'
+
+    def __init__(self, url: str = TRANSLATE_URL, timeout: float = TRANSLATE_TIMEOUT,
+                 concurrency: int = TRANSLATE_CONCURRENCY):
+        self.url = url
+        self.timeout = timeout
+        self.breaker = CircuitBreaker('translate')
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='translate')
+
+    def _translate_one(self, text: str, source: str, target: str) -> str:
+        self.breaker.check()
+        try:
+            resp = upstream.client.get(self.url, self.timeout, max_retries=1, params={
+                "client": "gtx", "sl": source, "tl": target, "dt": "t", "q": text})
+            resp.raise_for_status()
+            translated = "".join(part[0] for part in resp.json()[0] if part and part[0])
+        except (requests.exceptions.RequestException, ValueError, TypeError, IndexError, KeyError) as e:
+            if upstream.is_backend_failure(e):
+                self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return translated
+
+    def translate(self, texts: List[str], source: str, target: str) -> List[Optional[str]]:
+        """Translations in order; None where one failed"""
+        futures = [self._pool.submit(contextvars.copy_context().run, self._translate_one, text, source, target)
+                   for text in texts]
+        results = []
+        for text, future in zip(texts, futures):
+            try:
+                results.append(future.result())
+            except (requests.exceptions.RequestException, ValueError, TypeError, IndexError, KeyError,
+                    CircuitOpen) as e:
+                log.warning("Translation to %s failed: %s", target, e)
+                results.append(None)
+        return results
+
+
+class LocalTranslator:
+    """Offline stand-in: tags each string with the target language instead of translating it"""
+
+    name = 'local'
+
+    def translate(self, texts: List[str], source: str, target: str) -> List[Optional[str]]:
+        return [f"[{target}] {text}" for text in texts]
+
+
+class TranslationCache:
+    """Translations kept in SQLite, keyed by (sha256 of the text, source, target).
+
+    One connection shared under a lock; WAL mode lets several worker
+    processes use the same file. Each hit stamps the row as used; writes
+    drop rows unused for max_age and then the least recently used beyond
+    max_rows, so the file stays bounded (a row holds at most
+    TRANSLATE_MAX_CHARS of text).
+    """
+
+    def __init__(self, path: str = TRANSLATION_CACHE_PATH, max_rows: int = TRANSLATION_CACHE_MAX_ROWS,
+                 max_age: float = TRANSLATION_CACHE_MAX_AGE_DAYS * 24 * 60 * 60):
+        self.path = path
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS translations ("
+                             "text_hash TEXT NOT NULL, source TEXT NOT NULL, target TEXT NOT NULL, "
+                             "translation TEXT NOT NULL, created REAL NOT NULL, used REAL NOT NULL, "
+                             "PRIMARY KEY (text_hash, source, target))")
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(translations)")]
+            if 'used' not in columns:
+                self._db.execute("ALTER TABLE translations ADD COLUMN used REAL NOT NULL DEFAULT 0")
+                self._db.execute("UPDATE translations SET used = created")
+            self._db.execute("CREATE INDEX IF NOT EXISTS translations_used ON translations (used)")
+
+    def get_many(self, hashes: List[str], source: str, target: str) -> Dict[str, str]:
+        found = {}
+        with self._lock, self._db:
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._db.execute(
+                    f"SELECT text_hash, translation FROM translations WHERE source = ? AND target = ? "
+                    f"AND text_hash IN ({placeholders})", (source, target, *chunk)).fetchall()
+                if rows:
+                    self._db.execute(
+                        f"UPDATE translations SET used = ? WHERE source = ? AND target = ? "
+                        f"AND text_hash IN ({','.join('?' * len(rows))})",
+                        (time.time(), source, target, *(digest for digest, _ in rows)))
+                found.update(rows)
+        return found
+
+    def put_many(self, items: List[Tuple[str, str]], source: str, target: str):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?, ?)",
+                                 [(digest, source, target, translation, now, now) for digest, translation in items])
+            self._prune(now)
+
+    def _prune(self, now: float):
+        """Drop expired rows, then the least recently used beyond max_rows; caller holds the lock"""
+        evicted = self._db.execute("DELETE FROM translations WHERE used < ?", (now - self.max_age,)).rowcount
+        excess = self._db.execute("SELECT COUNT(*) FROM translations").fetchone()[0] - self.max_rows
+        if excess > 0:
+            evicted += self._db.execute("DELETE FROM translations WHERE rowid IN "
+                                        "(SELECT rowid FROM translations ORDER BY used LIMIT ?)", (excess,)).rowcount
+        if evicted:
+            self.evicted += evicted
+            log.info("Evicted %d cached translations", evicted)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+
+
+class TranslationService:
+    """Batched translation in front of a backend, answering repeats from the cache.
+
+    Narration is the same for every player who reaches a scene, so after the
+    first player switches language the rest are served from SQLite. Failed
+    strings come back untranslated and are not cached.
+    """
+
+    def __init__(self, backend, cache: TranslationCache):
+        self.backend = backend
+        self.cache = cache
+
+    def translate(self, texts: List[str], source: str, target: str) -> Tuple[List[str], int]:
+        """(translations in the order of texts, how many came from the cache)"""
+        if source == target:
+            return list(texts), 0
+        hashes = {text: text_hash(text) for text in texts if text.strip()}
+        with metrics.span('translate', backend=self.backend.name, target=target, strings=len(hashes)) as attrs:
+            known = self.cache.get_many(list(set(hashes.values())), source, target)
+            missing = [text for text, digest in hashes.items() if digest not in known]
+            attrs['cached'] = len(hashes) - len(missing)
+            TRANSLATIONS.inc(len(hashes) - len(missing), outcome='cached')
+            if missing:
+                fresh = [(text, translated) for text, translated
+                         in zip(missing, self.backend.translate(missing, source, target)) if translated is not None]
+                self.cache.put_many([(hashes[text], translated) for text, translated in fresh], source, target)
+                known.update((hashes[text], translated) for text, translated in fresh)
+                TRANSLATIONS.inc(len(fresh), outcome='translated')
+                TRANSLATIONS.inc(len(missing) - len(fresh), outcome='failed')
+        translations = [known.get(hashes.get(text), text) for text in texts]
+        return translations, attrs['cached']
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.backend.name, "cache_path": self.cache.path, "cached_entries": len(self.cache),
+                "max_entries": self.cache.max_rows, "evicted": self.cache.evicted,
+                "strings": {outcome: TRANSLATIONS.value(outcome=outcome)
+                            for outcome in ('cached', 'translated', 'failed')}}
+
+
+def create_service(backend: str = TRANSLATE_BACKEND, cache_path: str = TRANSLATION_CACHE_PATH) -> TranslationService:
+    if backend == 'google':
+        translator = GoogleTranslator()
+    elif backend == 'local':
+        translator = LocalTranslator()
+    else:
+        raise ValueError(f"unknown TRANSLATE_BACKEND: {backend}")
+    return TranslationService(translator, TranslationCache(cache_path))
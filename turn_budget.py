@@ -0,0 +1,114 @@
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+import os
+import time
+
+import metrics
+
+TURN_DEADLINE = float(os.getenv('TURN_DEADLINE', 30))
+TURN_IMAGE_MIN_BUDGET = float(os.getenv('TURN_IMAGE_MIN_BUDGET', 8))
+
+STAGE_MIN_BUDGETS = {'image': TURN_IMAGE_MIN_BUDGET}
+
+DEADLINE_OVERRUNS = metrics.Counter('vardovia_turn_deadline_overruns_total',
+                                    'Turns that ran out of their deadline, by the stage running at the time', ('stage',))
+STAGES_SKIPPED = metrics.Counter('vardovia_turn_stages_skipped_total',
+                                 'Optional turn stages skipped or abandoned, by reason', ('stage', 'reason'))
+
+SKIP_REASONS = ('deadline', 'circuit_open', 'queue_full', 'expired')
+
+
+class DeadlineExceeded(Exception):
+    """The turn's deadline passed while a required stage still had work to do"""
+
+    def __init__(self, stage: str):
+        super().__init__(f"turn deadline exceeded during {stage}")
+        self.stage = stage
+
+
+class TurnBudget:
+    """One turn's overall deadline, handed out stage by stage.
+
+    Required stages (the model call) are handed the absolute deadline, which
+    bounds their timeouts, retries and fallbacks, and raise DeadlineExceeded
+    once it has passed, whatever error they failed with. Optional
+    stages (the scene image) only start with at least their minimum budget
+    left; otherwise they are recorded as skipped and the turn goes on
+    text-only.
+    """
+
+    def __init__(self, seconds: float = TURN_DEADLINE):
+        self.seconds = seconds
+        self.started = time.monotonic()
+        self.deadline = self.started + seconds
+        self.overruns = []
+        self.skipped = {}
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check(self, stage: str):
+        """Raise DeadlineExceeded, counting the overrun against stage, if no time is left"""
+        if self.remaining() <= 0:
+            self.overrun(stage)
+            raise DeadlineExceeded(stage)
+
+    def allot(self, stage: str) -> float:
+        """The deadline (a time.monotonic() value) a required stage must finish by"""
+        self.check(stage)
+        return self.deadline
+
+    def iterate(self, stage: str, chunks: Iterable[Any]) -> Iterator[Any]:
+        """Yield from a streamed stage, raising DeadlineExceeded between chunks once the deadline passes.
+
+        A stage that fails after the deadline (a timeout cut to fit it, or a
+        retry or fallback given up for lack of time) is reported as
+        DeadlineExceeded too.
+        """
+        try:
+            for chunk in chunks:
+                self.check(stage)
+                yield chunk
+        except Exception:
+            self.check(stage)
+            raise
+
+    def allows(self, stage: str) -> bool:
+        """Whether an optional stage still fits; records the skip when it doesn't"""
+        if self.remaining() < STAGE_MIN_BUDGETS.get(stage, 0.0):
+            self.skip(stage, 'deadline')
+            return False
+        return True
+
+    def finished(self, stage: str):
+        """Count an overrun against stage if it only finished after the deadline"""
+        if self.remaining() <= 0:
+            self.overrun(stage)
+
+    def skip(self, stage: str, reason: str):
+        self.skipped[stage] = reason
+        STAGES_SKIPPED.inc(stage=stage, reason=reason)
+
+    def overrun(self, stage: str):
+        if stage not in self.overruns:
+            self.overruns.append(stage)
+            DEADLINE_OVERRUNS.inc(stage=stage)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"deadline_s": self.seconds, "elapsed_s": round(self.elapsed(), 3),
+                "remaining_s": round(self.remaining(), 3), "overruns": list(self.overruns),
+                "skipped": dict(self.skipped)}
+
+
+def stats(breakers: Optional[List[Any]] = None) -> Dict[str, Any]:
+    """Configured budgets, overrun and skip counts, and the state of the given circuit breakers"""
+    skipped = {}
+    for stage in STAGE_MIN_BUDGETS:
+        counts = {reason: STAGES_SKIPPED.value(stage=stage, reason=reason) for reason in SKIP_REASONS}
+        skipped[stage] = {reason: count for reason, count in counts.items() if count}
+    return {"deadline_s": TURN_DEADLINE, "min_budget_s": dict(STAGE_MIN_BUDGETS),
+            "overruns": {stage: DEADLINE_OVERRUNS.value(stage=stage) for stage in ('llm', 'image')},
+            "skipped": skipped,
+            "breakers": {breaker.name: breaker.stats() for breaker in breakers or ()}}
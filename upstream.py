@@ -0,0 +1,233 @@
+from typing import Any, Dict, Optional
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+UPSTREAM_POOL_HOSTS = int(os.getenv('UPSTREAM_POOL_HOSTS', 10))
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', 20))
+UPSTREAM_MAX_RETRIES = int(os.getenv('UPSTREAM_MAX_RETRIES', 3))
+UPSTREAM_BACKOFF_BASE = float(os.getenv('UPSTREAM_BACKOFF_BASE', 0.5))
+UPSTREAM_BACKOFF_MAX = float(os.getenv('UPSTREAM_BACKOFF_MAX', 8))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+UPSTREAM_MAX_RETRY_AFTER = float(os.getenv('UPSTREAM_MAX_RETRY_AFTER', 30))
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', 5))
+BREAKER_RESET_SECONDS = float(os.getenv('BREAKER_RESET_SECONDS', 30))
+
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+_BREAKER_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+BREAKER_STATE = metrics.Gauge('vardovia_circuit_state', 'Circuit breaker state (0 closed, 1 half open, 2 open)', ('name',))
+BREAKER_REJECTED = metrics.Counter('vardovia_circuit_rejected_total', 'Calls refused by an open circuit breaker', ('name',))
+
+
+def backoff_delay(attempt: int, base: float = UPSTREAM_BACKOFF_BASE, cap: float = UPSTREAM_BACKOFF_MAX) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def retry_after_seconds(response: requests.Response) -> Optional[float]:
+    """Seconds requested by a Retry-After header (delta-seconds or HTTP-date), if any"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def time_left(deadline: Optional[float]) -> Optional[float]:
+    """Seconds until deadline (a time.monotonic() value); None when there is no deadline"""
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def expired(deadline: Optional[float]) -> bool:
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def fits(deadline: Optional[float], seconds: float) -> bool:
+    """Whether waiting seconds still leaves time before deadline"""
+    left = time_left(deadline)
+    return left is None or seconds < left
+
+
+def capped(seconds: float, deadline: Optional[float]) -> float:
+    """seconds, cut down to the time left before deadline"""
+    left = time_left(deadline)
+    return seconds if left is None else max(0.0, min(seconds, left))
+
+
+def is_backend_failure(error: BaseException) -> bool:
+    """Whether error means the backend is down or overloaded, rather than that this request was bad"""
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                              requests.exceptions.ChunkedEncodingError))
+
+
+class CircuitOpen(Exception):
+    """The circuit breaker for an upstream is open; the call was not attempted"""
+
+    def __init__(self, name: str, retry_after: float = 0.0):
+        super().__init__(f"{name} is unavailable (circuit open)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Stops calling an upstream after `failures` consecutive failures.
+
+    Once open, calls are refused for reset_seconds; then one trial call is let
+    through (half open). Its success closes the breaker, its failure reopens it
+    for another reset_seconds.
+    """
+
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES, reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+        BREAKER_STATE.set(0, name=name)
+
+    def _set_state(self, state: str):
+        self.state = state
+        BREAKER_STATE.set(_BREAKER_STATE_VALUES[state], name=self.name)
+
+    def retry_after(self) -> float:
+        """Seconds until a call would be let through; 0 if one would be now"""
+        if self.state == CLOSED:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_seconds - time.monotonic())
+
+    def available(self) -> bool:
+        return self.retry_after() == 0
+
+    def allow(self) -> bool:
+        """Whether to make a call now; claims the trial call when the breaker is due to half open"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_seconds:
+                BREAKER_REJECTED.inc(name=self.name)
+                return False
+            self.opened_at = time.monotonic()
+            self._set_state(HALF_OPEN)
+            return True
+
+    def check(self):
+        """allow(), raising CircuitOpen instead of returning False"""
+        if not self.allow():
+            raise CircuitOpen(self.name, self.retry_after())
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            if self.state != CLOSED:
+                self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failures:
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "consecutive_failures": self.consecutive_failures,
+                "retry_after": round(self.retry_after(), 2)}
+
+
+class UpstreamClient:
+    """Keep-alive HTTP client shared by every outbound call to Groq and Stability.
+
+    A single requests.Session keeps one connection pool per host, so turns
+    reuse warm TCP/TLS connections instead of handshaking every time. Failed
+    connections and 429/5xx responses are retried with jittered exponential
+    backoff, honoring Retry-After when the upstream sends it (a wait longer
+    than UPSTREAM_MAX_RETRY_AFTER returns the response instead). Read timeouts
+    are not retried: the upstream may still be billing for that request.
+
+    With a deadline (a time.monotonic() value), each attempt's timeouts are
+    cut to the time left, and a retry whose wait would not leave any is given
+    up: the last error is raised or the last response returned.
+    """
+
+    def __init__(self, pool_hosts: int = UPSTREAM_POOL_HOSTS, pool_size: int = UPSTREAM_POOL_SIZE,
+                 max_retries: int = UPSTREAM_MAX_RETRIES, connect_timeout: float = UPSTREAM_CONNECT_TIMEOUT):
+        self.max_retries = max_retries
+        self.connect_timeout = connect_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method: str, url: str, read_timeout: float, max_retries: Optional[int] = None,
+                deadline: Optional[float] = None, **kwargs) -> requests.Response:
+        retries = self.max_retries if max_retries is None else max_retries
+        host = urlsplit(url).netloc
+        attempt = 0
+        while True:
+            if expired(deadline):
+                raise requests.exceptions.Timeout(f"deadline passed before calling {url}")
+            timeout = (capped(self.connect_timeout, deadline), capped(read_timeout, deadline))
+            started = time.perf_counter()
+            error = None
+            try:
+                with metrics.span('upstream_request', host=host, attempt=attempt) as attrs:
+                    response = self.session.request(method, url, timeout=timeout, **kwargs)
+                    attrs['status'] = response.status_code
+            except requests.exceptions.RequestException as e:
+                error = e
+            metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - started, host=host)
+            if error is not None:
+                metrics.UPSTREAM_RESPONSES.inc(host=host, status=type(error).__name__)
+                if not isinstance(error, requests.exceptions.ConnectionError) or attempt >= retries:
+                    raise error
+                delay = backoff_delay(attempt)
+                if not fits(deadline, delay):
+                    raise error
+                time.sleep(delay)
+                attempt += 1
+                continue
+            metrics.UPSTREAM_RESPONSES.inc(host=host, status=response.status_code)
+            if response.status_code not in RETRY_STATUSES or attempt >= retries:
+                return response
+            delay = retry_after_seconds(response)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            elif delay > UPSTREAM_MAX_RETRY_AFTER:
+                return response
+            if not fits(deadline, delay):
+                return response
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def post(self, url: str, read_timeout: float, **kwargs) -> requests.Response:
+        return self.request('POST', url, read_timeout, **kwargs)
+
+    def get(self, url: str, read_timeout: float, **kwargs) -> requests.Response:
+        return self.request('GET', url, read_timeout, **kwargs)
+
+
+client = UpstreamClient()
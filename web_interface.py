@@ -1,30 +1,45 @@
-from flask import Flask, render_template, request, jsonify, send_file, send_from_directory
+from flask import Flask, Response, render_template, request, jsonify, make_response, send_from_directory, g, stream_with_context
+import asyncio
 import os
 import json
+import math
+import mimetypes
 import time
-import sys
 import logging
-from datetime import datetime
 from pathlib import Path
 from dotenv import load_dotenv
-from main import call_groq, parse_model_response, pretty_print_state, minimal_sanity_check, ENABLE_IMAGE_GENERATION
+from main import llm, call_groq_async, call_groq_stream, call_groq_summary, resolve_model_turn_async, pretty_print_state, generate_image_async, stream_parser, scene_image_cache, stability_breaker, BOOTSTRAP_STATE, ENABLE_IMAGE_GENERATION
+import state_repair
+from state_repair import StateRepairError
+from state_delta import diff_states
+from game_state import GameState, InvalidState, StateCache, splice
+from prompt_builder import StorySummarizer, compact_story, needs_compaction, prompt_stats_summary
+from image_jobs import ImageJobQueue, QueueFull, FINISHED
+from image_cache import IMAGE_RETENTION_DAYS
+import image_store
+import assets
+import local_commands
+from session_journal import SessionJournal
+from session_store import create_store, is_valid_session_id, SESSION_COOKIE, SESSION_HEADER, SESSION_TTL
+import admission
+from admission import RateLimited
+import async_upstream
+from async_upstream import Overloaded
+import structured_output
+import turn_budget
+from turn_budget import DeadlineExceeded, TurnBudget
+import translation
+from translation import TRANSLATE_MAX_BATCH, TRANSLATE_MAX_CHARS
+import log_pipeline
+import metrics
 
 load_dotenv()
 
 app = Flask(__name__, static_url_path='', static_folder='static')
 
-log_dir = Path('logs')
-log_dir.mkdir(exist_ok=True, mode=0o755)
-log_file = log_dir / 'access.log'
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler()
-    ]
-)
+log_file = log_pipeline.configure('access.log')
+log = log_pipeline.get_logger('web')
+access_log = log_pipeline.get_logger('access')
 
 def get_client_ip():
     """Get the client's IP address, handling proxy headers"""
@@ -35,151 +50,683 @@ def get_client_ip():
     return ip
 
 def log_action(ip, action, status='success'):
-    """Log user action with IP and timestamp"""
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    log_entry = f"{timestamp} - IP: {ip} - Action: {action} - Status: {status}"
-    logging.info(log_entry)
+    """Log user action with IP, session and the request's latency so far"""
+    trace = metrics.current_trace()
+    access_log.log(logging.INFO if status in ('success', 'local', 'coalesced') else logging.WARNING, action, extra={
+        "ip": ip,
+        "session": g.get('session_id'),
+        "action": action,
+        "status": status,
+        "latency_ms": round((time.perf_counter() - trace.started) * 1000, 2) if trace else None,
+        "trace_id": trace.id if trace else None
+    })
 
 static_dir = Path('static')
 static_dir.mkdir(exist_ok=True, mode=0o755)
 
 static_abs_path = os.path.abspath('static')
-print(f"Static files directory: {static_abs_path}")
-print(f"Logging to: {os.path.abspath(log_file)}")
+log.info("Static files directory: %s", static_abs_path)
+log.info("Logging to: %s", log_file)
+
+image_store.remove_legacy_outputs(static_abs_path, IMAGE_RETENTION_DAYS * 24 * 60 * 60)
+
+try:
+    page = assets.build(directory=os.path.join(static_abs_path, 'dist'))
+except (OSError, ValueError) as e:
+    log.exception("Asset build failed, serving the unbundled template: %s", e)
+    page = None
 
 @app.route('/static/<path:filename>')
 def static_files(filename):
-    try:
-        print(f"Serving static file: {filename}")
-        file_path = os.path.join(static_abs_path, filename)
-        print(f"Full path: {file_path}")
-        if not os.path.isfile(file_path):
-            print(f"File not found: {file_path}")
-            return "File not found", 404
-        if not os.access(file_path, os.R_OK):
-            print(f"Permission denied for file: {file_path}")
-            return "Permission denied", 403
-        return send_file(file_path)
-    except Exception as e:
-        print(f"Error serving static file {filename}: {str(e)}")
-        return str(e), 500
-
-current_state = {
-    "player_name": "Arsen Dvorak",
-    "location": "Basement",
-    "inventory": ["wristwatch", "crumpled note"],
-    "health": 90,
-    "danger": 1,
-    "time": "night",
-    "flags": {"initialized": False}
-}
-
-previous_state_json = json.dumps(current_state, separators=(',', ':'))
-
-story_log = []
+    """Serve static files with ETag/304, Range support and long-lived caching for hashed files"""
+    accept_encoding = request.headers.get('Accept-Encoding', '')
+    coding, path = assets.precompressed(filename, accept_encoding, static_abs_path)
+    response = send_from_directory(static_abs_path, path, conditional=True, etag=True)
+    if filename.startswith('dist/') and filename.endswith(assets.COMPRESSIBLE):
+        response.vary.add('Accept-Encoding')
+    if coding:
+        response.headers['Content-Encoding'] = coding
+        response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    return image_store.cache_headers(response, filename)
+
+INITIAL_STATE = BOOTSTRAP_STATE
+
 MAX_STORY_LOG = 20
 
+def new_session_data():
+    """Fresh per-session game data"""
+    return {
+        "state": json.loads(json.dumps(INITIAL_STATE)),
+        "story_log": [],
+        "story_summary": "",
+        "state_version": 0,
+        "image_generation": ENABLE_IMAGE_GENERATION
+    }
+
+def restore_session(session_id):
+    """Rebuild a session from its journal, e.g. after a restart"""
+    data = journal.load(session_id, MAX_STORY_LOG)
+    if data is None:
+        return None
+    session = new_session_data()
+    session.update(data)
+    return session
+
+def forget_session(session_id):
+    """Drop what is kept for a session beyond the store: its journal, cached state and image job"""
+    image_jobs.cancel_session(session_id)
+    journal.delete(session_id)
+    states.discard(session_id)
+
+def sweep_journals():
+    """Delete the journals of sessions that expired while not in the store, e.g. across a restart"""
+    journal.sweep(SESSION_TTL, keep=lambda session_id: session_id in sessions.backend)
+
+journal = SessionJournal()
+sessions = create_store(factory=new_session_data, restore=restore_session, on_evict=forget_session,
+                        on_sweep=sweep_journals)
+sweep_journals()
+states = StateCache()
+image_jobs = ImageJobQueue(lambda prompt, deadline=None: async_upstream.engine.run(generate_image_async(prompt, deadline=deadline)))
+translator = translation.create_service()
+summarizer = StorySummarizer(call_groq_summary)
+MAX_IMAGE_WAIT = 30
+
+def get_session_id():
+    """Get the caller's session id from the header or cookie, minting one if needed"""
+    if 'session_id' in g:
+        return g.session_id
+    sid = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+    if not is_valid_session_id(sid):
+        sid = sessions.new_session_id()
+        g.new_session_id = sid
+    g.session_id = sid
+    return sid
+
+@app.after_request
+def set_session_cookie(response):
+    sid = g.pop('new_session_id', None)
+    if sid:
+        response.set_cookie(SESSION_COOKIE, sid, max_age=SESSION_TTL, httponly=True, samesite='Lax')
+    return response
+
+@app.before_request
+def begin_trace():
+    """Start a trace for the request, continuing the caller's X-Trace-Id if it sent one"""
+    trace_id = request.headers.get(metrics.TRACE_HEADER)
+    g.trace, g.trace_token = metrics.start_trace(trace_id if metrics.is_valid_trace_id(trace_id) else None)
+
+@app.after_request
+def finish_trace(response):
+    trace = g.get('trace')
+    if trace is not None:
+        response.headers[metrics.TRACE_HEADER] = trace.id
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        elapsed = time.perf_counter() - trace.started
+        metrics.HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        metrics.HTTP_SECONDS.observe(elapsed, endpoint=endpoint)
+        access_log.info("%s %s %s", request.method, request.path, response.status_code, extra={
+            "ip": get_client_ip(),
+            "session": g.get('session_id'),
+            "endpoint": endpoint,
+            "method": request.method,
+            "status": response.status_code,
+            "latency_ms": round(elapsed * 1000, 2),
+            "trace_id": trace.id
+        })
+    return response
+
+@app.teardown_request
+def end_trace(exc):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        metrics.end_trace(token)
+
+def log_turn_timings(trace):
+    """Log the stage breakdown of one turn against its trace id"""
+    spans = " ".join(f"{span['stage']}={span['ms']}ms" for span in trace.to_dict()['spans'])
+    log.info("Turn timings: %s", spans, extra={"trace_id": trace.id, "session": g.get('session_id')})
+
+def remember_narration(session, session_id, narration, prompt_stats):
+    """Append a narration to the session's story and fold old ones into the summary in the background"""
+    story_log = session['story_log']
+    story_log.append(narration)
+    if len(story_log) > MAX_STORY_LOG:
+        story_log[:] = story_log[-MAX_STORY_LOG:]
+    if needs_compaction(story_log, prompt_stats):
+        def apply(summarized, new_summary):
+            if session_id not in sessions.backend:
+                return
+            with sessions.session(session_id) as current:
+                compact_story(current, summarized, new_summary)
+        summarizer.schedule(session_id, session.get('story_summary', ''), story_log, apply)
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    """The built page, precompressed; revalidated on every load since it names the current bundles"""
+    if page is None:
+        return render_template('index.html')
+    coding, body = page.negotiate(request.headers.get('Accept-Encoding', ''))
+    response = Response(body, mimetype='text/html')
+    response.set_etag(page.etag + (f"-{coding}" if coding else ""))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    if coding:
+        response.headers['Content-Encoding'] = coding
+    return response.make_conditional(request)
 
 @app.route('/api/settings/image_generation', methods=['POST'])
 def toggle_image_generation():
-    """Update image generation setting"""
-    global ENABLE_IMAGE_GENERATION
+    """Update image generation setting for the caller's session"""
     data = request.get_json()
-    if data is not None and 'enabled' in data:
-        ENABLE_IMAGE_GENERATION = bool(data['enabled'])
-        print(f"Image generation {'enabled' if ENABLE_IMAGE_GENERATION else 'disabled'}")
-    return jsonify({"enabled": ENABLE_IMAGE_GENERATION})
+    with sessions.session(get_session_id()) as session:
+        if data is not None and 'enabled' in data:
+            session['image_generation'] = bool(data['enabled'])
+            log.info("Image generation %s", 'enabled' if session['image_generation'] else 'disabled')
+        enabled = session['image_generation']
+    return jsonify({"enabled": enabled})
 
 @app.route('/api/settings', methods=['GET'])
 def get_settings():
     """Get current settings"""
-    return jsonify({"image_generation": ENABLE_IMAGE_GENERATION})
+    with sessions.session(get_session_id()) as session:
+        enabled = session['image_generation']
+    return jsonify({"image_generation": enabled})
 
 @app.route('/api/action', methods=['POST'])
-def handle_action():
-    global current_state, previous_state_json, story_log, ENABLE_IMAGE_GENERATION
-    
+async def handle_action():
+    """Play one turn; a repeat of an action still in flight for the session gets that turn's response"""
     client_ip = get_client_ip()
-    
+    session_id = get_session_id()
+    data = request.get_json(silent=True) or {}
+    player_action = data.get('action')
+    if not isinstance(player_action, str) or not player_action.strip():
+        return await play_turn(client_ip, session_id)
+
+    local = local_reply(session_id, player_action)
+    if local is not None:
+        log_action(client_ip, player_action.strip(), "local")
+        return jsonify(dict(local, image_job_id=None))
+
+    key = admission.action_key(session_id, player_action, data.get('known_state_version'))
+    leader, flight = admission.actions.join(key)
+    if not leader:
+        log_action(client_ip, player_action.strip(), "coalesced")
+        try:
+            body, status, headers = await asyncio.wrap_future(flight)
+        except asyncio.CancelledError:
+            return jsonify({"error": "Error processing your request"}), 500
+        return Response(body, status=status, headers=dict(headers, **{'X-Coalesced': '1'}),
+                        mimetype='application/json')
     try:
-        data = request.get_json()
-        if not data:
-            log_action(client_ip, "No data provided", "error")
-            return jsonify({"error": "No data provided"}), 400
-            
-        player_action = data.get('action', '').strip()
-        if not player_action:
-            log_action(client_ip, "Empty action", "error")
-            return jsonify({"error": "No action provided"}), 400
-            
-        log_action(client_ip, player_action)
-            
-        image_generation_enabled = data.get('image_generation_enabled', ENABLE_IMAGE_GENERATION)
-        
-        print(f"Processing action: {player_action}")
+        response = make_response(await play_turn(client_ip, session_id))
+        retry_after = response.headers.get('Retry-After')
+        flight.set_result((response.get_data(), response.status_code,
+                           {'Retry-After': retry_after} if retry_after else {}))
+        return response
+    finally:
+        admission.actions.release(key, flight)
+
+async def play_turn(client_ip, session_id):
+    try:
+        admission.admit((admission.ip_limiter, client_ip), (admission.session_limiter, session_id))
+    except RateLimited as e:
+        log_action(client_ip, str(e), "rate_limited")
+        return retry_later({"error": "You're acting too quickly, please wait a moment"}, 429, e.retry_after)
+
+    try:
+        with sessions.session(session_id) as session:
+            return await run_action(session, session_id, client_ip)
+    except Exception as e:
+        log_action(client_ip, f"Server error: {str(e)}", "error")
+        return jsonify({"error": str(e)}), 500
+
+def local_reply(session_id, player_action):
+    """Answer a status command from the session's state without a turn, or None if it needs the model"""
+    data = sessions.load(session_id)
+    reply = local_commands.route(player_action, data['state'])
+    if reply is None:
+        return None
+    return {"narration": reply, "local": True, "state_version": data.get('state_version', 0)}
+
+def retry_later(payload, status, retry_after):
+    response = jsonify(payload)
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response, status
+
+async def run_action(session, session_id, client_ip):
+    """Play one turn against the locked session data; the LLM wait happens on the shared upstream loop"""
+    story_log = session['story_log']
+    data = request.get_json()
+    if not data:
+        log_action(client_ip, "No data provided", "error")
+        return jsonify({"error": "No data provided"}), 400
+
+    player_action = data.get('action', '').strip()
+    if not player_action:
+        log_action(client_ip, "Empty action", "error")
+        return jsonify({"error": "No action provided"}), 400
+
+    log_action(client_ip, player_action)
+
+    image_generation_enabled = data.get('image_generation_enabled', session['image_generation'])
+    previous_state = session['state']
+    base_version = session.get('state_version', 0)
+
+    log.debug("Processing action: %s", player_action)
+    budget = TurnBudget()
+    previous_state_json = state_json_text(session_id, base_version, previous_state)
+    prompt_stats = {}
+    responses = []
+
+    async def request_response():
         try:
-            response = call_groq(
+            response = await async_upstream.engine.call(call_groq_async(
                 previous_state_json=previous_state_json,
                 story_log=story_log,
                 player_action=player_action,
-                api_key=os.getenv('GROQ_API_KEY')
-            )
-            if not response:
-                raise ValueError("Empty response from API")
-            print(f"API Response: {response[:200]}...")
-        except Exception as e:
-            print(f"Error in call_groq: {str(e)}", file=sys.stderr)
-            log_action(client_ip, f"Error in call_groq: {str(e)}", "error")
-            return jsonify({"error": f"Error processing your request: {str(e)}"}), 500
-            
-        image_url = None
-        if image_generation_enabled and ENABLE_IMAGE_GENERATION and '[IMAGE_PROMPT:' in response and ']' in response:
-            before_prompt, after_prompt = response.split('[IMAGE_PROMPT:', 1)
-            prompt_part, after = after_prompt.split(']', 1)
-            clean_response = before_prompt.strip() + after.strip()
-            from main import generate_image
-            try:
-                success, image_path = generate_image(prompt_part.strip())
-                if success and image_path:
-                    image_url = image_path
-                else:
-                    print("Image generation failed")
-            except Exception as e:
-                print(f"Error generating image: {str(e)}")
-        else:
-            clean_response = response
-        state_obj, narration = parse_model_response(clean_response)
-        story_log.append(narration)
-        if len(story_log) > MAX_STORY_LOG:
-            story_log[:] = story_log[-MAX_STORY_LOG:]
-        current_state = state_obj
-        previous_state_json = json.dumps(state_obj, separators=(',', ':'))
-        return jsonify({
+                api_key=os.getenv('GROQ_API_KEY'),
+                story_summary=session.get('story_summary', ''),
+                prompt_stats=prompt_stats,
+                deadline=budget.allot('llm')
+            ))
+        except Exception:
+            budget.check('llm')
+            raise
+        if not response:
+            raise ValueError("Empty response from API")
+        log.debug("API Response: %s...", response[:200])
+        responses.append(response)
+        return response
+
+    try:
+        new_state, narration, image_prompt, repairs = await resolve_model_turn_async(request_response, session['state'])
+    except Overloaded as e:
+        log_action(client_ip, f"Shed: {str(e)}", "overloaded")
+        return retry_later({"error": "The story engine is busy right now, please try again in a moment"}, 503,
+                           e.retry_after)
+    except DeadlineExceeded as e:
+        log_action(client_ip, f"Deadline: {str(e)}", "deadline")
+        return jsonify({"error": "The story engine took too long to answer, please try again",
+                        "budget": budget.to_dict()}), 504
+    except StateRepairError as e:
+        log_action(client_ip, f"Unusable model state: {str(e)}", "error")
+        return jsonify({"error": "The story engine returned an unreadable turn, please try again"}), 502
+    except Exception as e:
+        log.exception("Error in call_groq: %s", e)
+        log_action(client_ip, f"Error in call_groq: {str(e)}", "error")
+        return jsonify({"error": f"Error processing your request: {str(e)}"}), 500
+    if repairs:
+        log.info("Repaired model state: %s", ', '.join(repairs))
+    budget.finished('llm')
+
+    image_job = None
+    if image_generation_enabled and ENABLE_IMAGE_GENERATION and image_prompt:
+        image_job = submit_image(session_id, image_prompt, budget)
+    if image_job is None:
+        image_jobs.cancel_session(session_id)
+    remember_narration(session, session_id, narration, prompt_stats)
+    state_obj = new_state.to_dict()
+    session['state'] = state_obj
+    session['state_version'] = base_version + 1
+    states.put(session_id, base_version + 1, new_state)
+    trace = metrics.current_trace()
+    log_turn_timings(trace)
+    journal_turn(session_id, session, player_action, responses[-1], narration, image_prompt, image_job, repairs, trace,
+                 new_state)
+    with metrics.span('serialize'):
+        payload = {
             "narration": narration,
-            "state": state_obj,
-            "image_url": image_url
-        })
+            **state_payload(data.get('known_state_version'), base_version, previous_state, state_obj),
+            "image_url": None,
+            "image_job_id": image_job.id if image_job else None,
+            "prompt_stats": prompt_stats,
+            "timings": trace.to_dict(),
+            "budget": budget.to_dict(),
+            "image_service": stability_breaker.state
+        }
+        if payload.pop('state', None) is None:
+            return jsonify(payload)
+        return Response(splice(payload, 'state', new_state.to_json()), mimetype='application/json')
+
+def submit_image(session_id, prompt, budget):
+    """Queue the scene image unless the Stability breaker is open or the turn's budget is too low; None if skipped"""
+    if not stability_breaker.available():
+        budget.skip('image', 'circuit_open')
+        return None
+    if not budget.allows('image'):
+        return None
+    try:
+        return image_jobs.submit(session_id, prompt, deadline=budget.deadline)
+    except QueueFull:
+        log.warning("Image queue full, skipping scene image")
+        budget.skip('image', 'queue_full')
+        return None
+
+def state_json_text(session_id, version, state):
+    """The prompt's PREVIOUS_STATE_JSON, reusing the bytes cached when this state was made"""
+    cached = states.get(session_id, version, state)
+    if cached is None:
+        return json.dumps(state, separators=(',', ':'))
+    return cached.json_text()
+
+def journal_turn(session_id, session, player_action, response, narration, image_prompt, image_job, repairs, trace,
+                 state=None):
+    """Queue the finished turn for the session journal; the write happens in the background.
+
+    state, a GameState, supplies the entry's state from its cached bytes.
+    """
+    entry = {
+        "state_version": session['state_version'],
+        "action": player_action,
+        "response": response,
+        "narration": narration,
+        "image": {"job_id": image_job.id, "prompt": image_prompt} if image_job else None,
+        "repairs": repairs,
+        "timings": trace.to_dict() if trace else None
+    }
+    if state is None:
+        journal.record(session_id, dict(entry, state=session['state']), session)
+    else:
+        journal.record(session_id, entry, session, state_json=state.to_json())
+
+def state_payload(known_version, base_version, previous_state, state):
+    """The new state for the browser: a delta if it holds base_version, the full state otherwise.
+
+    A state with a value set to null also goes out in full, since null in a delta deletes the key.
+    """
+    if known_version is not None and known_version == base_version:
+        delta = diff_states(previous_state, state)
+        if delta is not None:
+            return {"state_delta": delta, "base_version": base_version, "state_version": base_version + 1}
+    return {"state": state, "state_version": base_version + 1}
+
+def sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def state_event(known_version, base_version, previous_state, state):
+    payload = state_payload(known_version, base_version, previous_state, state)
+    if 'state_delta' in payload:
+        return sse('state_delta', payload)
+    return sse('state', payload['state'])
+
+@app.route('/api/action/stream', methods=['POST'])
+def handle_action_stream():
+    """Play one turn, streaming state, narration and the image job as Server-Sent Events"""
+    client_ip = get_client_ip()
+    session_id = get_session_id()
+    data = request.get_json(silent=True)
+    if not data:
+        log_action(client_ip, "No data provided", "error")
+        return jsonify({"error": "No data provided"}), 400
+
+    player_action = data.get('action', '').strip()
+    if not player_action:
+        log_action(client_ip, "Empty action", "error")
+        return jsonify({"error": "No action provided"}), 400
+
+    local = local_reply(session_id, player_action)
+    if local is not None:
+        log_action(client_ip, player_action, "local")
+        return Response(sse('narration', {"text": local['narration']}) + sse('done', dict(local, image_job_id=None)),
+                        mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    try:
+        admission.admit((admission.ip_limiter, client_ip), (admission.session_limiter, session_id))
+    except RateLimited as e:
+        log_action(client_ip, str(e), "rate_limited")
+        return retry_later({"error": "You're acting too quickly, please wait a moment"}, 429, e.retry_after)
+
+    log_action(client_ip, player_action)
+
+    def events():
+        with sessions.session(session_id) as session:
+            image_generation_enabled = data.get('image_generation_enabled', session['image_generation'])
+            yield from stream_action(session, session_id, client_ip, player_action, image_generation_enabled,
+                                     data.get('known_state_version'))
+
+    return Response(stream_with_context(metrics.iterate_in_context(events())), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def stream_action(session, session_id, client_ip, player_action, image_generation_enabled, known_version=None):
+    """Generate the SSE events for one streamed turn against the locked session data"""
+    story_log = session['story_log']
+    previous_state = session['state']
+    base_version = session.get('state_version', 0)
+    parser = stream_parser(previous_state)
+    raw_chunks = []
+    image_job = None
+    prompt_stats = {}
+    parse_seconds = 0.0
+    budget = TurnBudget()
+
+    log.debug("Processing streamed action: %s", player_action)
+    try:
+        chunks = call_groq_stream(
+            previous_state_json=state_json_text(session_id, base_version, previous_state),
+            story_log=story_log,
+            player_action=player_action,
+            api_key=os.getenv('GROQ_API_KEY'),
+            story_summary=session.get('story_summary', ''),
+            prompt_stats=prompt_stats,
+            deadline=budget.allot('llm')
+        )
+        for chunk in budget.iterate('llm', chunks):
+            raw_chunks.append(chunk)
+            started = time.perf_counter()
+            parsed = parser.feed(chunk)
+            parse_seconds += time.perf_counter() - started
+            for kind, value in parsed:
+                if kind == 'state':
+                    yield state_event(known_version, base_version, previous_state, value)
+                elif kind == 'narration':
+                    yield sse('narration', {"text": value})
+                elif kind == 'image_prompt' and image_generation_enabled and ENABLE_IMAGE_GENERATION:
+                    image_job = submit_image(session_id, value, budget)
+                    if image_job is not None:
+                        yield sse('image', {"image_job_id": image_job.id})
+        started = time.perf_counter()
+        parsed = parser.finish()
+        metrics.record_stage('parse', parse_seconds + time.perf_counter() - started)
+        for kind, value in parsed:
+            if kind == 'state':
+                yield state_event(known_version, base_version, previous_state, value)
+            elif kind == 'narration':
+                yield sse('narration', {"text": value})
+    except GeneratorExit:
+        image_jobs.cancel_session(session_id)
+        raise
+    except Overloaded as e:
+        log_action(client_ip, f"Shed: {str(e)}", "overloaded")
+        error = sse('error', {"error": "The story engine is busy right now, please try again in a moment",
+                              "retry_after": e.retry_after})
+    except DeadlineExceeded as e:
+        log_action(client_ip, f"Deadline: {str(e)}", "deadline")
+        error = sse('error', {"error": "The story engine took too long to answer, please try again",
+                              "budget": budget.to_dict()})
+    except StateRepairError as e:
+        state_repair.record_outcome('failed')
+        log_action(client_ip, f"Unusable model state: {str(e)}", "error")
+        error = sse('error', {"error": "The story engine returned an unreadable turn, please try again"})
     except Exception as e:
-        log_action(client_ip, f"Server error: {str(e)}", "error")
-        return jsonify({"error": str(e)}), 500
+        log.exception("Error in call_groq_stream: %s", e)
+        log_action(client_ip, f"Error in call_groq_stream: {str(e)}", "error")
+        error = sse('error', {"error": f"Error processing your request: {str(e)}"})
+    else:
+        error = None
+    if error is not None:
+        image_jobs.cancel_session(session_id)
+        yield error
+        return
+
+    with metrics.span('sanity_check') as attrs:
+        try:
+            new_state = GameState.from_dict(parser.state)
+        except InvalidState as e:
+            new_state = None
+            log.warning("State failed sanity check: %s", e)
+        attrs['ok'] = new_state is not None
+    if new_state is None:
+        image_jobs.cancel_session(session_id)
+        state_repair.record_outcome('failed')
+        log_action(client_ip, "Unusable model state after streaming", "error")
+        yield sse('error', {"error": "The story engine returned an unreadable turn, please try again"})
+        return
+    if image_job is None:
+        image_jobs.cancel_session(session_id)
+    narration = parser.narration
+    remember_narration(session, session_id, narration, prompt_stats)
+    session['state'] = new_state.to_dict()
+    session['state_version'] = base_version + 1
+    states.put(session_id, base_version + 1, new_state)
+    trace = metrics.current_trace()
+    log_turn_timings(trace)
+    journal_turn(session_id, session, player_action, "".join(raw_chunks), narration, parser.image_prompt, image_job,
+                 parser.repairs, trace, new_state)
+    yield sse('done', {
+        "narration": narration,
+        "state_version": base_version + 1,
+        "image_job_id": image_job.id if image_job else None,
+        "prompt_stats": prompt_stats,
+        "timings": trace.to_dict(),
+        "budget": budget.to_dict(),
+        "image_service": stability_breaker.state
+    })
 
 @app.route('/api/state', methods=['GET'])
 def get_state():
-    return jsonify(current_state)
+    with sessions.session(get_session_id()) as session:
+        state = session['state']
+        version = session.get('state_version', 0)
+    response = jsonify(state)
+    response.headers['X-State-Version'] = str(version)
+    return response
+
+@app.route('/api/image/<job_id>', methods=['GET'])
+def image_status(job_id):
+    """Report an image job, long-polling up to ?wait= seconds for it to finish"""
+    job = image_jobs.get(job_id)
+    if job is None or job.session_id != get_session_id():
+        return jsonify({"error": "Unknown image job"}), 404
+    wait = min(max(request.args.get('wait', 0, type=float), 0), MAX_IMAGE_WAIT)
+    if wait and job.status not in FINISHED:
+        image_jobs.wait(job_id, wait)
+    payload = job.to_dict()
+    if job.image_url:
+        payload['variants'] = image_store.variant_urls(job.image_url, static_abs_path)
+    return jsonify(payload)
+
+@app.route('/api/session', methods=['DELETE'])
+def reset_session():
+    """Drop the caller's game so the next action starts fresh"""
+    session_id = get_session_id()
+    sessions.delete(session_id)
+    forget_session(session_id)
+    return jsonify({"ok": True})
 
-@app.route('/static/output.png')
-def serve_image():
+@app.route('/api/save', methods=['POST'])
+def save_game():
+    """Copy the caller's game to disk and return the id it can be loaded with.
+
+    The save id is minted for the copy and is not the session id, so sharing
+    it lets others load the game but not play on as the saver.
+    """
+    with sessions.session(get_session_id()) as session:
+        saved = json.loads(json.dumps(session))
+    return jsonify({"save_id": journal.save(saved), "state_version": saved.get('state_version', 0)})
+
+@app.route('/api/load', methods=['POST'])
+def load_game():
+    """Replace the caller's game with a saved one (their own journal if no save_id is given)"""
+    session_id = get_session_id()
+    data = request.get_json(silent=True) or {}
+    save_id = data.get('save_id')
+    if save_id is not None and not is_valid_session_id(save_id):
+        return jsonify({"error": "Invalid save id"}), 400
+    if save_id is None:
+        restored = restore_session(session_id)
+    else:
+        saved = journal.load_save(save_id)
+        restored = dict(new_session_data(), **saved) if saved is not None else None
+    if restored is None:
+        return jsonify({"error": "Save not found"}), 404
+    image_jobs.cancel_session(session_id)
+    states.discard(session_id)
+    with sessions.session(session_id) as session:
+        session.clear()
+        session.update(restored)
+        if save_id is not None:
+            journal.snapshot(session_id, session)
+    return jsonify({
+        "state": restored['state'],
+        "state_version": restored.get('state_version', 0),
+        "story_log": restored.get('story_log', [])
+    })
+
+@app.route('/api/translate', methods=['POST'])
+def translate_texts():
+    """Translate a batch of strings in one call; strings translated before come from the cache"""
+    data = request.get_json(silent=True) or {}
+    texts = data.get('texts')
+    source = data.get('source') or 'auto'
+    target = data.get('target')
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        return jsonify({"error": "texts must be a list of strings"}), 400
+    if len(texts) > TRANSLATE_MAX_BATCH or any(len(text) > TRANSLATE_MAX_CHARS for text in texts):
+        return jsonify({"error": f"At most {TRANSLATE_MAX_BATCH} strings of {TRANSLATE_MAX_CHARS} characters"}), 413
+    if not translation.is_valid_language(source, allow_auto=True) or not translation.is_valid_language(target):
+        return jsonify({"error": "Invalid language code"}), 400
     try:
-        return send_from_directory('static', 'output.png', mimetype='image/png')
-    except FileNotFoundError:
-        try:
-            return send_file('output.png', mimetype='image/png')
-        except FileNotFoundError:
-            print("Image not found in both static and root directories", file=sys.stderr)
-            return "Image not found", 404
+        admission.admit((admission.translate_limiter, get_client_ip()))
+    except RateLimited as e:
+        return retry_later({"error": "Too many translation requests, please wait a moment"}, 429, e.retry_after)
+    translations, cached = translator.translate(texts, source, target)
+    return jsonify({"translations": translations, "cached": cached})
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Stage timings, upstream statuses and token counts in Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/stats/prompt', methods=['GET'])
+def get_prompt_stats():
+    return jsonify(prompt_stats_summary())
+
+@app.route('/api/stats/images', methods=['GET'])
+def get_image_stats():
+    return jsonify({"cache": scene_image_cache.stats(), "jobs": image_jobs.stats()})
+
+@app.route('/api/stats/upstream', methods=['GET'])
+def get_upstream_stats():
+    return jsonify(async_upstream.stats())
+
+@app.route('/api/stats/llm', methods=['GET'])
+def get_llm_stats():
+    return jsonify(llm.stats())
+
+@app.route('/api/stats/commands', methods=['GET'])
+def get_command_stats():
+    return jsonify(local_commands.stats())
+
+@app.route('/api/stats/admission', methods=['GET'])
+def get_admission_stats():
+    return jsonify(admission.stats())
+
+@app.route('/api/stats/replies', methods=['GET'])
+def get_reply_stats():
+    return jsonify(structured_output.stats())
+
+@app.route('/api/stats/deadline', methods=['GET'])
+def get_deadline_stats():
+    return jsonify(turn_budget.stats([stability_breaker] + [backend.breaker for backend in llm.backends]))
+
+@app.route('/api/stats/translate', methods=['GET'])
+def get_translation_stats():
+    return jsonify(translator.stats())
+
+@app.route('/api/session/stats', methods=['GET'])
+def session_stats():
+    return jsonify(dict(sessions.stats(), journal=journal.stats()))
 
 if __name__ == '__main__':
     os.makedirs('static', exist_ok=True)